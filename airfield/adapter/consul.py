@@ -1,29 +1,38 @@
 """Wrapper for consul interactions."""
 
+import base64
 import json
+from os.path import join
+from urllib import request
 from urllib.error import URLError, HTTPError
 from consul_kv import Connection
 from ..settings import config
 from ..util import metrics
 from ..util.logging import logger
-from ..util.exception import TechnicalException
+from ..util.exception import TechnicalException, KVWatchGapException
+
+
+_error_metric = metrics.Counter("airfield_consul_request_errors", "Number of errors encountered with consul", [])
+
+# Consul rejects transactions with more operations or a larger request body (txn_max_req_len)
+TXN_MAX_OPS = 64
+TXN_MAX_BYTES = 512 * 1024
 
 
 class ConsulAdapter(object):
     def __init__(self):
         logger.info('Initializing ConsulAdapter')
         self._con = Connection(endpoint=config.CONSUL_ENDPOINT)
-        self._error_metric = metrics.Counter("airfield_consul_request_errors", "Number of errors encountered with consul", [])
 
     def get_key(self, key):
         key = self._build_key(key)
         try:
-            return json.loads(self._con.get(key)[key])
+            return self._con.get(key)[key]
         except URLError as e:
             if isinstance(e, HTTPError) and e.code == 404:
                 return None
             logger.error(e)
-            self._error_metric.inc()
+            _error_metric.inc()
             raise TechnicalException("Consul server cannot be reached.")
 
     def get_keys(self, key):
@@ -31,34 +40,146 @@ class ConsulAdapter(object):
         try:
             result = self._con.get(key, recurse=True)
             for sub_key, sub_value in result.items():
-                yield sub_key, json.loads(sub_value)
+                yield sub_key, sub_value
         except URLError as e:
             if isinstance(e, HTTPError) and e.code == 404:
                 return
             logger.error(e)
-            self._error_metric.inc()
+            _error_metric.inc()
+            raise TechnicalException("Consul server cannot be reached.")
+
+    def get_key_names(self, key):
+        """Returns the keys below the key without reading their values"""
+        url = "{}/?keys=true".format(join(self._con.endpoint, 'kv/', self._build_key(key)))
+        try:
+            with request.urlopen(url, timeout=self._con.timeout) as response:
+                return json.loads(response.read().decode("utf-8"))
+        except URLError as e:
+            if isinstance(e, HTTPError) and e.code == 404:
+                return list()
+            logger.error(e)
+            _error_metric.inc()
             raise TechnicalException("Consul server cannot be reached.")
 
+    def get_key_with_index(self, key):
+        key = self._build_key(key)
+        try:
+            entry = self._con.get_cas(key).get(key)
+        except URLError as e:
+            if isinstance(e, HTTPError) and e.code == 404:
+                return None, None
+            logger.error(e)
+            _error_metric.inc()
+            raise TechnicalException("Consul server cannot be reached.")
+        if entry is None:
+            return None, None
+        return entry
+
     def put_key(self, key, value):
         key = self._build_key(key)
         try:
-            self._con.put(key, json.dumps(value))
+            self._con.put(key, value)
+        except URLError as e:
+            logger.error(e)
+            _error_metric.inc()
+            raise TechnicalException("Consul server cannot be reached.")
+
+    def put_key_cas(self, key, value, index):
+        key = self._build_key(key)
+        # consul_kv neither sends cas=0 nor returns the result of the swap, so the request is done directly.
+        # With cas=0 consul only creates the key if it does not exist yet.
+        url = "{}?cas={}".format(join(self._con.endpoint, 'kv/', key), index or 0)
+        try:
+            req = request.Request(url=url, data=value.encode("utf-8"), method='PUT')
+            with request.urlopen(req, timeout=self._con.timeout) as response:
+                return json.loads(response.read().decode("utf-8")) is True
         except URLError as e:
             logger.error(e)
-            self._error_metric.inc()
+            _error_metric.inc()
             raise TechnicalException("Consul server cannot be reached.")
 
     def delete_key(self, key, recursive=False):
+        if recursive:
+            # A recursive delete matches by prefix and would remove "<key>x" as well, the transaction does not
+            return self.txn([dict(verb="delete", key=key, recursive=True)])
         key = self._build_key(key)
         try:
-            self._con.delete(key, recurse=recursive)
+            self._con.delete(key)
             return True
         except URLError as e:
             if isinstance(e, HTTPError) and e.code == 404:
                 return False
             logger.error(e)
-            self._error_metric.inc()
+            _error_metric.inc()
             raise TechnicalException("Consul server cannot be reached.")
 
+    def txn(self, ops):
+        """Applies the operations atomically with a consul transaction, returns False if it was rolled back"""
+        url = join(self._con.endpoint, 'txn')
+        kv_ops = [dict(KV=kv_op) for op in ops for kv_op in self._txn_ops(op)]
+        body = json.dumps(kv_ops)
+        if len(kv_ops) > TXN_MAX_OPS or len(body) > TXN_MAX_BYTES:
+            raise TechnicalException("Transaction with {} operations and {} bytes exceeds the limits of consul."
+                                     .format(len(kv_ops), len(body)))
+        try:
+            req = request.Request(url=url, data=body.encode("utf-8"), method='PUT')
+            with request.urlopen(req, timeout=self._con.timeout):
+                return True
+        except URLError as e:
+            if isinstance(e, HTTPError) and e.code == 409:
+                # A check failed, consul rolled back the whole transaction
+                logger.debug("Consul transaction rolled back: {}".format(e.read().decode("utf-8")))
+                return False
+            logger.error(e)
+            _error_metric.inc()
+            raise TechnicalException("Consul server cannot be reached.")
+
+    def _txn_ops(self, op):
+        key = self._build_key(op["key"])
+        if op["verb"] == "set":
+            return [dict(Verb="set", Key=key, Value=base64.b64encode(op["value"].encode("utf-8")).decode("ascii"))]
+        if op["verb"] == "check":
+            if op["index"] is None:
+                return [dict(Verb="check-not-exists", Key=key)]
+            return [dict(Verb="check-index", Key=key, Index=op["index"])]
+        if op["recursive"]:
+            # delete-tree matches by prefix, so the key and the keys below it are deleted separately
+            return [dict(Verb="delete", Key=key), dict(Verb="delete-tree", Key=key + "/")]
+        return [dict(Verb="delete", Key=key)]
+
+    def watch_keys(self, key, index, wait_seconds):
+        """
+        Returns all values below the key with the consul index of the response. With an index the request blocks
+        until something below the key changed since that index or the wait time passed (blocking query).
+        The complete subtree is returned every time.
+        """
+        url = "{}/?recurse=true".format(join(self._con.endpoint, 'kv/', self._build_key(key)))
+        timeout = self._con.timeout
+        if index is not None:
+            url += "&index={}&wait={}s".format(index, wait_seconds)
+            # Consul adds up to wait / 16 of jitter to the wait time
+            timeout = wait_seconds * 17 / 16 + 10
+        try:
+            with request.urlopen(url, timeout=timeout) as response:
+                new_index = int(response.headers["X-Consul-Index"])
+                entries = json.loads(response.read().decode("utf-8"))
+        except URLError as e:
+            if isinstance(e, HTTPError) and e.code == 404:
+                new_index, entries = int(e.headers["X-Consul-Index"]), list()
+            else:
+                logger.error(e)
+                _error_metric.inc()
+                raise TechnicalException("Consul server cannot be reached.")
+        if index is not None and new_index < index:
+            # The index went backwards, e.g. after a restore of a snapshot, consul recommends to start over
+            raise KVWatchGapException("Consul index went backwards from {} to {}".format(index, new_index))
+        values = {entry["Key"]: base64.b64decode(entry["Value"]).decode("utf-8") if entry["Value"] is not None else ""
+                  for entry in entries}
+        return values, new_index, True
+
+    def backend_key(self, key):
+        """Returns the key as returned by get_keys"""
+        return self._build_key(key)
+
     def _build_key(self, key):
         return "{}/{}".format(config.CONFIG_BASE_KEY, key)
@@ -1,11 +1,13 @@
 """Wrapper for etcd interactions."""
 
-import json
 import etcd
 from ..settings import config
 from ..util import metrics
 from ..util.logging import logger
-from ..util.exception import TechnicalException
+from ..util.exception import TechnicalException, KVWatchGapException
+
+
+_error_metric = metrics.Counter("airfield_etcd_request_errors", "Number of errors encountered with etcd", [])
 
 
 class EtcdAdapter(object):
@@ -25,49 +27,160 @@ class EtcdAdapter(object):
         else:
             host, port = endpoint.split(":")
         self._client = etcd.Client(host=host, port=int(port), protocol=protocol, version_prefix=version_prefix)
-        self._error_metric = metrics.Counter("airfield_etcd_request_errors", "Number of errors encountered with etcd", [])
 
     def get_key(self, key):
         try:
             result = self._client.read(self._build_key(key))
-            if result and result.value:
-                return json.loads(result.value)
-            else:
-                return None
+            return result.value if result else None
         except etcd.EtcdKeyNotFound:
             return None
         except Exception as e:
             logger.error(e)
-            self._error_metric.inc()
+            _error_metric.inc()
             raise TechnicalException("etcd server cannot be reached.")
 
     def get_keys(self, key):
         try:
             for child in self._client.read(self._build_key(key), recursive=True).children:
-                yield child.key, (json.loads(child.value) if child.value else None)
+                yield child.key, child.value
         except etcd.EtcdKeyNotFound:
             return
         except Exception as e:
             logger.error(e)
-            self._error_metric.inc()
+            _error_metric.inc()
+            raise TechnicalException("etcd server cannot be reached.")
+
+    def get_key_with_index(self, key):
+        try:
+            result = self._client.read(self._build_key(key))
+            return result.value, result.modifiedIndex
+        except etcd.EtcdKeyNotFound:
+            return None, None
+        except Exception as e:
+            logger.error(e)
+            _error_metric.inc()
             raise TechnicalException("etcd server cannot be reached.")
 
     def put_key(self, key, value):
         try:
-            self._client.write(self._build_key(key), json.dumps(value))
+            self._client.write(self._build_key(key), value)
         except Exception as e:
             logger.error(e)
-            self._error_metric.inc()
+            _error_metric.inc()
+            raise TechnicalException("etcd server cannot be reached.")
+
+    def put_key_cas(self, key, value, index):
+        try:
+            if index is None:
+                self._client.write(self._build_key(key), value, prevExist=False)
+            else:
+                self._client.write(self._build_key(key), value, prevIndex=index)
+            return True
+        except (etcd.EtcdCompareFailed, etcd.EtcdAlreadyExist, etcd.EtcdKeyNotFound):
+            return False
+        except Exception as e:
+            logger.error(e)
+            _error_metric.inc()
             raise TechnicalException("etcd server cannot be reached.")
 
     def delete_key(self, key, recursive=False):
         try:
             self._client.delete(self._build_key(key), recursive=recursive)
+            return True
+        except etcd.EtcdKeyNotFound:
+            return False
+        except Exception as e:
+            logger.error(e)
+            _error_metric.inc()
+            raise TechnicalException("etcd server cannot be reached.")
+
+    def apply_sequentially(self, ops):
+        """
+        The v2 API has no multi-key transactions, so this is not atomic and takes several requests: the checks are
+        done first and the changes are applied one after the other, a write of a checked key compares its index again.
+        If that fails or the server cannot be reached, the changes applied so far are rolled back on a best effort
+        basis. Other clients can see the changes half applied and a failed rollback leaves them that way.
+        Returns False if a check failed.
+        """
+        checks = {op["key"]: op["index"] for op in ops if op["verb"] == "check"}
+        for key, index in checks.items():
+            if self.get_key_with_index(key)[1] != index:
+                return False
+        undo = list()
+        try:
+            for op in ops:
+                key = self._build_key(op["key"])
+                if op["verb"] == "set":
+                    undo.append((key, self.get_key(op["key"])))
+                    if op["key"] not in checks:
+                        self._client.write(key, op["value"])
+                    elif checks[op["key"]] is None:
+                        self._client.write(key, op["value"], prevExist=False)
+                    else:
+                        self._client.write(key, op["value"], prevIndex=checks[op["key"]])
+                elif op["verb"] == "delete":
+                    previous = dict(self.get_keys(op["key"])) if op["recursive"] else dict()
+                    previous[key] = self.get_key(op["key"])
+                    undo.extend(item for item in previous.items() if item[1] is not None)
+                    self.delete_key(op["key"], recursive=op["recursive"])
+            return True
+        except (etcd.EtcdCompareFailed, etcd.EtcdAlreadyExist, etcd.EtcdKeyNotFound):
+            self._rollback(undo)
+            return False
         except Exception as e:
             logger.error(e)
-            self._error_metric.inc()
+            _error_metric.inc()
+            self._rollback(undo)
             raise TechnicalException("etcd server cannot be reached.")
 
+    def _rollback(self, undo):
+        for key, value in reversed(undo):
+            try:
+                if value is None:
+                    self._client.delete(key)
+                else:
+                    self._client.write(key, value)
+            except etcd.EtcdKeyNotFound:
+                pass
+            except Exception as e:
+                logger.error("Failed to roll back {}: {}".format(key, e))
+
+    def watch_keys(self, key, index, wait_seconds):
+        """
+        Without an index all values below the key are returned with the etcd index of the read.
+        With an index the request waits up to the wait time for the next change below the key after that index and
+        returns the changed value (None if deleted) with its index.
+        Returns the changed values, the index to continue with and whether the values are the complete subtree.
+        """
+        if index is None:
+            try:
+                result = self._client.read(self._build_key(key), recursive=True)
+            except etcd.EtcdKeyNotFound as e:
+                return dict(), e.payload["index"], True
+            except Exception as e:
+                logger.error(e)
+                _error_metric.inc()
+                raise TechnicalException("etcd server cannot be reached.")
+            return {child.key: child.value for child in result.children if not child.dir}, result.etcd_index, True
+        try:
+            result = self._client.read(self._build_key(key), recursive=True, wait=True, waitIndex=index + 1,
+                                       timeout=wait_seconds)
+        except etcd.EtcdWatchTimedOut:
+            return dict(), index, False
+        except etcd.EtcdEventIndexCleared as e:
+            # etcd only keeps the last 1000 changes
+            raise KVWatchGapException(str(e))
+        except Exception as e:
+            logger.error(e)
+            _error_metric.inc()
+            raise TechnicalException("etcd server cannot be reached.")
+        value = None if result.action in ("delete", "compareAndDelete", "expire") or result.dir else result.value
+        return {result.key: value}, result.modifiedIndex, False
+
+    def backend_key(self, key):
+        """Returns the key as returned by get_keys"""
+        return "/" + self._build_key(key).lstrip("/")
+
     def _build_key(self, key):
         return "{}/{}".format(config.CONFIG_BASE_KEY, key)
 
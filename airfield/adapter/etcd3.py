@@ -0,0 +1,183 @@
+"""Wrapper for interactions with the etcd v3 API through its JSON gateway."""
+
+import base64
+import json
+import requests
+import urllib3
+from ..settings import config
+from ..util import metrics
+from ..util.logging import logger
+from ..util.exception import TechnicalException, KVWatchGapException
+
+
+_error_metric = metrics.Counter("airfield_etcd3_request_errors", "Number of errors encountered with etcd v3", [])
+
+
+class Etcd3Adapter(object):
+    """
+    Keys are stored flat as <base key>/<key>. Reads below a key are done with prefix range reads of "<key>/" so
+    they match whole path segments like the directories of etcd v2. Revisions are used as modify indexes.
+    """
+    def __init__(self):
+        logger.info('Initializing Etcd3Adapter')
+        endpoint = config.ETCD3_ENDPOINT.rstrip("/")
+        if "://" not in endpoint:
+            endpoint = "http://" + endpoint
+        if "/v3" not in endpoint:
+            # etcd 3.4 and later serve the gateway under /v3, older versions under /v3beta or /v3alpha
+            endpoint += "/v3"
+        self._endpoint = endpoint
+        self._session = requests.Session()
+
+    def get_key(self, key):
+        kvs = self._post("kv/range", dict(key=_encode(self._build_key(key)))).get("kvs")
+        return _decode(kvs[0].get("value", "")) if kvs else None
+
+    def get_keys(self, key):
+        for kv in self._range_below(key):
+            yield _decode(kv["key"]), _decode(kv.get("value", ""))
+
+    def get_key_names(self, key):
+        """Returns the keys below the key without reading their values"""
+        return [_decode(kv["key"]) for kv in self._range_below(key, keys_only=True)]
+
+    def get_key_with_index(self, key):
+        kvs = self._post("kv/range", dict(key=_encode(self._build_key(key)))).get("kvs")
+        if not kvs:
+            return None, None
+        return _decode(kvs[0].get("value", "")), int(kvs[0]["mod_revision"])
+
+    def put_key(self, key, value):
+        self._post("kv/put", dict(key=_encode(self._build_key(key)), value=_encode(value)))
+
+    def put_key_cas(self, key, value, index):
+        return self._txn([_compare(self._build_key(key), index)],
+                         [dict(request_put=dict(key=_encode(self._build_key(key)), value=_encode(value)))])
+
+    def delete_key(self, key, recursive=False):
+        result = self._post("kv/txn", dict(success=self._delete_requests(key, recursive)))
+        return sum(int(response["response_delete_range"].get("deleted", 0)) for response in result.get("responses", list())) > 0
+
+    def txn(self, ops):
+        """Applies the operations atomically with one v3 transaction, returns False if a comparison failed"""
+        compare = list()
+        success = list()
+        for op in ops:
+            if op["verb"] == "check":
+                compare.append(_compare(self._build_key(op["key"]), op["index"]))
+            elif op["verb"] == "set":
+                success.append(dict(request_put=dict(key=_encode(self._build_key(op["key"])), value=_encode(op["value"]))))
+            else:
+                success.extend(self._delete_requests(op["key"], op["recursive"]))
+        return self._txn(compare, success)
+
+    def watch_keys(self, key, index, wait_seconds):
+        """
+        Without an index all values below the key are returned with the revision of the read.
+        With an index the next changes below the key after that revision are awaited for up to the wait time.
+        Returns the changed values (None if deleted), the revision to continue with and whether the values are the
+        complete subtree.
+        """
+        if index is None:
+            result = self._post("kv/range", self._range_request(key))
+            values = {_decode(kv["key"]): _decode(kv.get("value", "")) for kv in result.get("kvs", list())}
+            return {sub_key: value for sub_key, value in values.items() if _is_below(sub_key, self._build_key(key))}, \
+                int(result["header"]["revision"]), True
+        request = dict(create_request=dict(self._range_request(key), start_revision=str(index + 1)))
+        created = False
+        try:
+            with self._session.post(self._endpoint + "/watch", data=json.dumps(request), stream=True,
+                                    timeout=(10, wait_seconds)) as response:
+                for line in response.iter_lines():
+                    result = json.loads(line).get("result", dict())
+                    created = created or result.get("created", False)
+                    if int(result.get("compact_revision", 0)) > 0:
+                        raise KVWatchGapException("Revision {} is compacted".format(index + 1))
+                    events = [event for event in result.get("events", list())
+                              if _is_below(_decode(event["kv"]["key"]), self._build_key(key))]
+                    if events:
+                        return {_decode(event["kv"]["key"]): None if event.get("type") == "DELETE" else
+                                _decode(event["kv"].get("value", "")) for event in events}, \
+                            max(int(event["kv"]["mod_revision"]) for event in events), False
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # An idle stream ends with a read timeout after the wait time, which is no change
+            if created and (_is_read_timeout(e) or isinstance(e, requests.exceptions.ChunkedEncodingError)):
+                return dict(), index, False
+            logger.error(e)
+            _error_metric.inc()
+            raise TechnicalException("etcd server cannot be reached.")
+        return dict(), index, False
+
+    def backend_key(self, key):
+        """Returns the key as returned by get_keys"""
+        return self._build_key(key)
+
+    def _range_below(self, key, keys_only=False):
+        request = self._range_request(key)
+        if keys_only:
+            request["keys_only"] = True
+        kvs = self._post("kv/range", request).get("kvs", list())
+        return [kv for kv in kvs if _is_below(_decode(kv["key"]), self._build_key(key))]
+
+    def _range_request(self, key):
+        # Starts at the key itself and ends after all keys below it. Keys that only share the prefix, like
+        # "<key>-x", are in the range as well and filtered by the callers.
+        key = self._build_key(key)
+        return dict(key=_encode(key), range_end=_encode(_prefix_end(key + "/")))
+
+    def _delete_requests(self, key, recursive):
+        key = self._build_key(key)
+        delete_requests = [dict(request_delete_range=dict(key=_encode(key)))]
+        if recursive:
+            delete_requests.append(dict(request_delete_range=dict(key=_encode(key + "/"), range_end=_encode(_prefix_end(key + "/")))))
+        return delete_requests
+
+    def _txn(self, compare, success):
+        return self._post("kv/txn", dict(compare=compare, success=success)).get("succeeded", False)
+
+    def _post(self, path, body):
+        try:
+            response = self._session.post("{}/{}".format(self._endpoint, path), data=json.dumps(body),
+                                          timeout=config.ETCD3_TIMEOUT_SECONDS)
+            response.raise_for_status()
+            return response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(e)
+            _error_metric.inc()
+            raise TechnicalException("etcd server cannot be reached.")
+
+    def _build_key(self, key):
+        return "{}/{}".format(config.CONFIG_BASE_KEY, key)
+
+
+def _compare(key, index):
+    """Compares the modify revision of the key, index None means the key must not exist"""
+    if index is None:
+        return dict(key=_encode(key), target="CREATE", result="EQUAL", create_revision="0")
+    return dict(key=_encode(key), target="MOD", result="EQUAL", mod_revision=str(index))
+
+
+def _is_read_timeout(e):
+    """Read timeouts while streaming are raised as connection errors that wrap the timeout of urllib3"""
+    if isinstance(e, requests.exceptions.ReadTimeout):
+        return True
+    return isinstance(e, requests.exceptions.ConnectionError) and bool(e.args) and \
+        isinstance(e.args[0], urllib3.exceptions.ReadTimeoutError)
+
+
+def _prefix_end(prefix):
+    """Returns the first key after all keys with the prefix"""
+    prefix = prefix.encode("utf-8")
+    return (prefix[:-1] + bytes([prefix[-1] + 1])).decode("utf-8")
+
+
+def _is_below(key, prefix):
+    return key == prefix or key.startswith(prefix + "/")
+
+
+def _encode(value):
+    return base64.b64encode(value.encode("utf-8")).decode("ascii")
+
+
+def _decode(value):
+    return base64.b64decode(value).decode("utf-8")
@@ -1,28 +1,325 @@
 """Generic KeyValue Store adapter that delegates calls to an actual implementation depending on configuration"""
 
+import hashlib
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from . import kv_codec
+from .kv_mirror import KVMirror
 from .etcd import EtcdAdapter
-from .consul import ConsulAdapter
+from .etcd3 import Etcd3Adapter
+from .consul import ConsulAdapter, TXN_MAX_OPS, TXN_MAX_BYTES
+from .sqlite import SqliteAdapter
 from ..settings import config
 from ..util import dependency_injection as di
+from ..util.exception import TechnicalException
+from ..util.logging import logger
+
+
+# Encoded values larger than the chunk size are split into chunks stored below this prefix, mirroring the path of
+# their key: kv_chunks/<key>/<generation>/<index>. The key itself holds a manifest behind this header character.
+CHUNKS_KEY = "kv_chunks"
+CHUNKED_HEADER = "C"
+# Bytes a transaction operation takes in addition to its key and value, e.g. the json fields and the base key
+TXN_OP_OVERHEAD = 128
 
 
 class KVAdapter:
-    def __init__(self):
-        if config.ETCD_ENDPOINT:
+    """
+    Encodes values with the kv codec and stores them as strings in the configured backend.
+    Values that are still larger than the chunk size after encoding are stored in chunks. Each write uses a new
+    generation of chunks that only becomes visible when the manifest is swapped with a single write, so readers see
+    either the old or the new value completely. Replaced generations are removed later by collect_chunk_garbage.
+    The chunks of a value are fetched in parallel and verified with the checksum from the manifest.
+    Optionally the subtrees given by mirror_prefixes are kept in memory by a KVMirror and read from there while it
+    is in sync with the store. Writes and compare-and-swap reads always go to the store.
+    """
+    def __init__(self, kv=None, mirror_prefixes=None):
+        if kv is not None:
+            self._kv = kv
+        elif config.ETCD3_ENDPOINT:
+            self._kv = di.get(Etcd3Adapter)
+        elif config.ETCD_ENDPOINT:
             self._kv = di.get(EtcdAdapter)
         elif config.CONSUL_ENDPOINT:
             self._kv = di.get(ConsulAdapter)
+        elif config.SQLITE_PATH:
+            self._kv = di.get(SqliteAdapter)
         else:
             raise Exception("No key-value-store configured")
+        if not hasattr(self._kv, "txn"):
+            logger.warning("{} has no transactions, changes of several keys are applied one after the other and can be "
+                           "seen or left half done. Use etcd v3, consul or SQLite instead.".format(type(self._kv).__name__))
+        self._chunk_executor = ThreadPoolExecutor(max_workers=config.KV_CHUNK_FETCH_WORKERS,
+                                                  thread_name_prefix="kv-chunks")
+        if mirror_prefixes is None:
+            mirror_prefixes = config.KV_MIRROR_PREFIXES if config.KV_MIRROR_ENABLED else list()
+        self._mirror = None
+        if mirror_prefixes:
+            self._mirror = KVMirror(self._kv, mirror_prefixes)
+            self._mirror.start()
 
     def get_key(self, key):
-        return self._kv.get_key(key)
+        if self._mirrored(key):
+            return self._decode(self._mirror.get_key(key))
+        return self._decode(self._kv.get_key(key))
 
     def get_keys(self, key):
-        yield from self._kv.get_keys(key)
+        entries = self._mirror.get_keys(key) if self._mirrored(key) else self._kv.get_keys(key)
+        for sub_key, raw in entries:
+            yield sub_key, self._decode(raw)
+
+    def get_key_names(self, key):
+        """Returns the keys below the key, without reading the values if the backend supports it"""
+        if self._mirrored(key):
+            return [sub_key for sub_key, _ in self._mirror.get_keys(key)]
+        if hasattr(self._kv, "get_key_names"):
+            return self._kv.get_key_names(key)
+        return [sub_key for sub_key, _ in self._kv.get_keys(key)]
+
+    def find_instance_ids(self, base_key, created_by=None, group=None, delete_before=None):
+        """
+        Returns the ids of the instances below the base key that may match the filters if the backend keeps
+        secondary indexes, otherwise None. The filters have to be checked again on the read instances.
+        """
+        if not hasattr(self._kv, "find_instance_ids"):
+            return None
+        return self._kv.find_instance_ids(base_key, created_by=created_by, group=group, delete_before=delete_before)
+
+    def add_change_listener(self, prefix, listener):
+        """
+        Registers a function that is called with the key of every value below the prefix that is changed by any
+        worker, as seen by the mirror. Returns False if the prefix is not mirrored, then changes are not reported.
+        """
+        if self._mirror is None:
+            return False
+        return self._mirror.add_change_listener(prefix, listener)
+
+    def get_key_with_index(self, key):
+        """Returns the value and the modify index of a key, both are None if the key does not exist"""
+        raw, index = self._kv.get_key_with_index(key)
+        return self._decode(raw), index
 
     def put_key(self, key, value):
-        return self._kv.put_key(key, value)
+        raw = kv_codec.encode(value)
+        if len(raw) > config.KV_CHUNK_SIZE:
+            raw = self._write_chunks(key, raw)
+        self._kv.put_key(key, raw)
+        self._record_write(key, raw)
+
+    def put_key_cas(self, key, value, index):
+        """
+        Writes the key only if it was not modified since it was read with the given index (compare-and-swap).
+        With index None the key is only created if it does not exist yet.
+        Returns whether the value was written.
+        """
+        raw = kv_codec.encode(value)
+        if len(raw) > config.KV_CHUNK_SIZE:
+            raw = self._write_chunks(key, raw)
+        if not self._kv.put_key_cas(key, raw, index):
+            self._delete_chunks_of(raw)
+            return False
+        self._record_write(key, raw)
+        return True
 
     def delete_key(self, key, recursive=False):
-        return self._kv.delete_key(key, recursive=recursive)
+        deleted = self._kv.delete_key(key, recursive=recursive)
+        if self._mirror is not None:
+            self._mirror.record_delete(key, recursive)
+        if recursive:
+            # Chunks mirror the path of their key, so this removes the chunks of all values below the key
+            self._kv.delete_key("{}/{}".format(CHUNKS_KEY, key), recursive=True)
+        return deleted
+
+    def txn(self, ops):
+        """
+        Applies the operations built with set_op, check_op and delete_op as a whole with a single request.
+        Values that would make the request larger than consul accepts are chunked.
+        Returns False without changing anything if one of the checks failed.
+        etcd v2 has no transactions, with it the operations are applied one after the other instead.
+        """
+        raw_ops = list()
+        manifests = list()
+        size = 0
+        for op in ops:
+            if op["verb"] == "set":
+                raw = kv_codec.encode(op["value"])
+                if len(raw) > config.KV_CHUNK_SIZE or size + _op_size(op["key"], raw) > TXN_MAX_BYTES:
+                    # The chunks stay invisible until the transaction swapped the manifest
+                    raw = self._write_chunks(op["key"], raw)
+                    manifests.append(raw)
+                size += _op_size(op["key"], raw)
+                raw_ops.append(dict(op, value=raw))
+            elif op["verb"] == "delete":
+                raw_ops.append(op)
+                size += _op_size(op["key"], "")
+                if op["recursive"]:
+                    raw_ops.append(delete_op("{}/{}".format(CHUNKS_KEY, op["key"]), recursive=True))
+            else:
+                raw_ops.append(op)
+                size += _op_size(op["key"], "")
+        apply = self._kv.txn if hasattr(self._kv, "txn") else self._kv.apply_sequentially
+        if not apply(raw_ops):
+            for manifest in manifests:
+                self._delete_chunks_of(manifest)
+            return False
+        for op in raw_ops:
+            if op["verb"] == "set":
+                self._record_write(op["key"], op["value"])
+            elif op["verb"] == "delete" and self._mirror is not None:
+                self._mirror.record_delete(op["key"], op["recursive"])
+        return True
+
+    def collect_chunk_garbage(self, grace_seconds):
+        """
+        Removes the generations of chunks that the manifest of their key does not reference anymore because the
+        value was overwritten or deleted. Writes leave them behind so they do not have to read the previous value.
+        Generations younger than the grace period are kept, their manifest may not be written yet.
+        Returns the number of removed generations.
+        """
+        prefix = self._kv.backend_key(CHUNKS_KEY) + "/"
+        generations = dict()
+        for name in self._chunk_key_names():
+            key, generation, index = name[len(prefix):].rsplit("/", 2)
+            if index.isdigit():
+                generations.setdefault(key, set()).add(generation)
+        expired = datetime.now().timestamp() - grace_seconds
+        collected = 0
+        for key, key_generations in generations.items():
+            current = _generation_of(self._kv.get_key(key))
+            for generation in key_generations:
+                if generation != current and _created_at(generation) <= expired:
+                    self._kv.delete_key("{}/{}/{}".format(CHUNKS_KEY, key, generation), recursive=True)
+                    collected += 1
+        return collected
+
+    def _chunk_key_names(self):
+        if hasattr(self._kv, "get_key_names"):
+            return self._kv.get_key_names(CHUNKS_KEY)
+        # etcd v2 lists empty directories without a value
+        return [name for name, raw in self._kv.get_keys(CHUNKS_KEY) if raw is not None]
+
+    def _mirrored(self, key):
+        return self._mirror is not None and self._mirror.serves(key)
+
+    def _record_write(self, key, raw):
+        # The own writes are read from the mirror before its watch delivers them
+        if self._mirror is not None:
+            self._mirror.record_write(key, raw)
+
+    def _decode(self, raw, retry=True):
+        if raw and raw[0] == CHUNKED_HEADER:
+            manifest = json.loads(raw[1:])
+            raw = self._read_chunks(manifest)
+            if raw is None:
+                if not retry:
+                    raise TechnicalException("Missing chunks of {}".format(manifest["key"]))
+                # The value was overwritten while reading and the previous generation of chunks is already deleted
+                return self._decode(self._kv.get_key(manifest["key"]), retry=False)
+        return kv_codec.decode(raw)
+
+    def _write_chunks(self, key, raw):
+        """Writes the chunks of a new generation and returns the manifest to store under the key"""
+        # The generation starts with its creation time for the garbage collection
+        generation = "{}-{}".format(int(datetime.now().timestamp()), uuid.uuid4().hex)
+        chunks = [raw[offset:offset + config.KV_CHUNK_SIZE] for offset in range(0, len(raw), config.KV_CHUNK_SIZE)]
+        for index, chunk in enumerate(chunks):
+            self._kv.put_key(_chunk_key(key, generation, index), chunk)
+        manifest = dict(key=key, generation=generation, chunks=len(chunks), size=len(raw),
+                        sha256=hashlib.sha256(raw.encode("utf-8")).hexdigest())
+        return CHUNKED_HEADER + json.dumps(manifest)
+
+    def _read_chunks(self, manifest):
+        """Fetches the chunks of a manifest in parallel, returns None if any of them is missing"""
+        chunk_keys = [_chunk_key(manifest["key"], manifest["generation"], index) for index in range(manifest["chunks"])]
+        chunks = list(self._chunk_executor.map(self._kv.get_key, chunk_keys))
+        if any(chunk is None for chunk in chunks):
+            return None
+        raw = "".join(chunks)
+        if hashlib.sha256(raw.encode("utf-8")).hexdigest() != manifest["sha256"]:
+            raise TechnicalException("Checksum mismatch for the chunks of {}".format(manifest["key"]))
+        return raw
+
+    def _delete_chunks_of(self, raw):
+        if raw and raw[0] == CHUNKED_HEADER:
+            manifest = json.loads(raw[1:])
+            self._kv.delete_key("{}/{}/{}".format(CHUNKS_KEY, manifest["key"], manifest["generation"]), recursive=True)
+
+
+def _op_size(key, raw):
+    """Estimates the bytes of a transaction operation, consul and etcd v3 send the values base64 encoded"""
+    return len(key) + 4 * ((len(raw.encode("utf-8")) + 2) // 3) + TXN_OP_OVERHEAD
+
+
+def _generation_of(raw):
+    """Returns the generation of chunks referenced by the raw value or None if it is not chunked"""
+    if raw and raw[0] == CHUNKED_HEADER:
+        return json.loads(raw[1:])["generation"]
+    return None
+
+
+def _created_at(generation):
+    """Returns the creation timestamp of a generation, generations written before it was included count as old"""
+    created_at, separator, _ = generation.partition("-")
+    return int(created_at) if separator and created_at.isdigit() else 0
+
+
+def copy_raw_keys(source, target, overwrite=False, batch_size=TXN_MAX_OPS, batch_bytes=TXN_MAX_BYTES):
+    """
+    Copies the raw values of all keys below the base key from one backend to another without decoding them, so
+    compressed and chunked values stay intact. Existing keys of the target are only replaced with overwrite, which
+    writes the keys in transactions of at most batch_size operations and about batch_bytes.
+    Returns the number of copied and of skipped keys.
+    """
+    base = source.backend_key("")
+    copied = skipped = 0
+    batch = list()
+    size = 0
+    for key, raw in source.get_keys(""):
+        if raw is None:
+            # Empty etcd v2 directories
+            continue
+        key = key[len(base):]
+        if not overwrite:
+            if target.put_key_cas(key, raw, None):
+                copied += 1
+            else:
+                skipped += 1
+            continue
+        if _op_size(key, raw) > batch_bytes:
+            # Too large for any transaction
+            target.put_key(key, raw)
+            copied += 1
+            continue
+        if len(batch) >= batch_size or size + _op_size(key, raw) > batch_bytes:
+            target.txn(batch)
+            copied += len(batch)
+            batch = list()
+            size = 0
+        batch.append(set_op(key, raw))
+        size += _op_size(key, raw)
+    if batch:
+        target.txn(batch)
+        copied += len(batch)
+    return copied, skipped
+
+
+def set_op(key, value):
+    """Transaction operation that writes the value"""
+    return dict(verb="set", key=key, value=value)
+
+
+def check_op(key, index):
+    """Transaction operation that fails the transaction if the key was modified since it was read with the index"""
+    return dict(verb="check", key=key, index=index)
+
+
+def delete_op(key, recursive=False):
+    """Transaction operation that deletes the key, with recursive all keys below it as well"""
+    return dict(verb="delete", key=key, recursive=recursive)
+
+
+def _chunk_key(key, generation, index):
+    return "{}/{}/{}/{}".format(CHUNKS_KEY, key, generation, index)
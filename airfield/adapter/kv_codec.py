@@ -0,0 +1,53 @@
+"""
+Encoding of the values stored in the key-value store.
+Values are stored as json. If the json is larger than the configured threshold it is stored zlib compressed and
+base64 encoded behind the header character 'Z', which can never start a json document. Values without the header
+are plain json, so values written before compression was introduced stay readable.
+"""
+
+import base64
+import json
+import time
+import zlib
+
+from prometheus_client import Counter, Summary
+
+from ..settings import config
+
+
+COMPRESSED_HEADER = "Z"
+
+_metric_bytes_saved = Counter("airfield_kv_codec_bytes_saved", "Bytes saved in the key-value store by compression")
+_metric_values = Counter("airfield_kv_codec_values", "Values written to the key-value store", ["format"])
+_metric_codec_time = Summary("airfield_kv_codec_seconds", "Time spent compressing and decompressing values",
+                             ["operation"])
+
+
+def encode(value):
+    """Returns the string to store for a value"""
+    plain = json.dumps(value)
+    if config.KV_COMPRESSION_THRESHOLD <= 0 or len(plain) <= config.KV_COMPRESSION_THRESHOLD:
+        _metric_values.labels("plain").inc()
+        return plain
+    start = time.perf_counter()
+    compressed = COMPRESSED_HEADER + base64.b64encode(
+        zlib.compress(plain.encode("utf-8"), config.KV_COMPRESSION_LEVEL)).decode("ascii")
+    _metric_codec_time.labels("compress").observe(time.perf_counter() - start)
+    if len(compressed) >= len(plain):
+        _metric_values.labels("plain").inc()
+        return plain
+    _metric_values.labels("compressed").inc()
+    _metric_bytes_saved.inc(len(plain) - len(compressed))
+    return compressed
+
+
+def decode(raw):
+    """Returns the value of a stored string, None for missing or empty values"""
+    if not raw:
+        return None
+    if raw[0] != COMPRESSED_HEADER:
+        return json.loads(raw)
+    start = time.perf_counter()
+    plain = zlib.decompress(base64.b64decode(raw[1:])).decode("utf-8")
+    _metric_codec_time.labels("decompress").observe(time.perf_counter() - start)
+    return json.loads(plain)
@@ -0,0 +1,184 @@
+"""Keeps subtrees of the key-value store in memory, driven by etcd watches or consul blocking queries"""
+
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Summary
+
+from ..settings import config
+from ..util import metrics
+from ..util.exception import TechnicalException, KVWatchGapException
+from ..util.logging import logger
+
+
+_metric_synced = Gauge("airfield_kv_mirror_synced", "Whether the key-value mirror serves reads from memory")
+_metric_staleness = Gauge("airfield_kv_mirror_staleness_seconds", "Seconds since the key-value mirror last heard from the store")
+_metric_lag = Summary("airfield_kv_mirror_lag_seconds", "Seconds until a local write was seen by the key-value mirror watch")
+_metric_resyncs = Counter("airfield_kv_mirror_resyncs", "Full reads of a mirrored subtree", ["reason"])
+_metric_keys = Gauge("airfield_kv_mirror_keys", "Number of keys held by the key-value mirror")
+
+
+class KVMirror:
+    """
+    Mirrors the raw values below the given key prefixes of a backend in memory. A background thread per prefix
+    reads the subtree once and then follows its changes with backend.watch_keys, which blocks until something
+    changed. If the backend lost the changes since the last seen index, the subtree is read completely again.
+    Reads should only be served from memory while `serves` is true, i.e. all subtrees were read and are watched.
+    Local writes are recorded right away and take precedence over the mirrored value until the watch delivers them
+    (or a timeout passed), so a worker always reads its own writes.
+    Keys are kept in the form the backend returns them from get_keys.
+    Change listeners are called with the keys of the values the watches saw changed, including changes made by other
+    workers, so in-process caches of these values can be dropped.
+    """
+    def __init__(self, backend, prefixes):
+        self._backend = backend
+        self._prefixes = [prefix.strip('/') for prefix in prefixes]
+        self._entries = dict()
+        self._pending = dict()  # backend key -> (raw value or None if deleted, time of the write)
+        self._synced = {prefix: False for prefix in self._prefixes}
+        self._change_listeners = list()
+        self._last_contact = time.monotonic()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        _metric_staleness.set_function(lambda: time.monotonic() - self._last_contact)
+        _metric_keys.set_function(lambda: len(self._entries))
+
+    def start(self):
+        for prefix in self._prefixes:
+            threading.Thread(target=self._watch, args=(prefix,), name='kv-mirror-' + prefix, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def serves(self, key):
+        """Returns whether reads of the key (or below it) can be served from memory"""
+        for prefix in self._prefixes:
+            if key == prefix or key.startswith(prefix + '/'):
+                return self._synced[prefix]
+        return False
+
+    def add_change_listener(self, prefix, listener):
+        """
+        Registers a function that is called with the key (as passed to get_key) of every changed value below the
+        prefix. Returns False if the prefix is not mirrored.
+        """
+        if not any(_is_below(prefix.strip('/'), mirrored) for mirrored in self._prefixes):
+            return False
+        self._change_listeners.append((prefix.strip('/'), listener))
+        return True
+
+    def get_key(self, key):
+        backend_key = self._backend.backend_key(key)
+        with self._lock:
+            pending = self._pending_value(backend_key)
+            raw = pending[0] if pending is not None else self._entries.get(backend_key)
+        metrics.cache_hit("kv_mirror")
+        return raw
+
+    def get_keys(self, key):
+        backend_key = self._backend.backend_key(key)
+        with self._lock:
+            keys = {sub_key for sub_key in list(self._entries) + list(self._pending) if _is_below(sub_key, backend_key)}
+            result = list()
+            for sub_key in sorted(keys):
+                pending = self._pending_value(sub_key)
+                raw = pending[0] if pending is not None else self._entries.get(sub_key)
+                if raw is not None:
+                    result.append((sub_key, raw))
+        metrics.cache_hit("kv_mirror")
+        return result
+
+    def record_write(self, key, raw):
+        backend_key = self._backend.backend_key(key)
+        with self._lock:
+            if self._entries.get(backend_key) == raw:
+                # The watch was faster
+                self._pending.pop(backend_key, None)
+            else:
+                self._pending[backend_key] = (raw, time.monotonic())
+
+    def record_delete(self, key, recursive=False):
+        backend_key = self._backend.backend_key(key)
+        now = time.monotonic()
+        with self._lock:
+            for sub_key in list(self._entries) + list(self._pending):
+                if sub_key == backend_key or recursive and _is_below(sub_key, backend_key):
+                    self._pending[sub_key] = (None, now)
+
+    def _pending_value(self, backend_key):
+        pending = self._pending.get(backend_key)
+        if pending is not None and time.monotonic() - pending[1] > config.KV_MIRROR_WRITE_TTL_SECONDS:
+            # The watch never delivered the write, most likely the key was changed again by someone else
+            del self._pending[backend_key]
+            return None
+        return pending
+
+    def _watch(self, prefix):
+        index = None
+        while not self._stopped.is_set():
+            try:
+                entries, new_index, complete = self._backend.watch_keys(prefix, index, config.KV_MIRROR_WAIT_SECONDS)
+            except KVWatchGapException as e:
+                logger.info('Changes of mirrored key-value subtree {} are not available anymore: {}'.format(prefix, e))
+                _metric_resyncs.labels('gap').inc()
+                index = None
+                continue
+            except TechnicalException as e:
+                logger.warning('Watching mirrored key-value subtree {} failed: {}'.format(prefix, e))
+                self._set_synced(prefix, False)
+                index = None
+                self._stopped.wait(config.KV_MIRROR_RECONNECT_SECONDS)
+                continue
+            if index is None:
+                _metric_resyncs.labels('connect').inc()
+            self._notify(self._apply(prefix, entries, complete))
+            index = new_index
+            self._last_contact = time.monotonic()
+            self._set_synced(prefix, True)
+
+    def _apply(self, prefix, entries, complete):
+        """Applies the entries of a watch and returns the keys whose values changed"""
+        now = time.monotonic()
+        changed = list()
+        with self._lock:
+            if complete:
+                backend_prefix = self._backend.backend_key(prefix)
+                for key in [key for key in self._entries if _is_below(key, backend_prefix) and key not in entries]:
+                    entries[key] = None
+            for key, raw in entries.items():
+                if raw is None:
+                    for sub_key in [sub_key for sub_key in self._entries if _is_below(sub_key, key)]:
+                        del self._entries[sub_key]
+                        changed.append(sub_key)
+                elif self._entries.get(key) != raw:
+                    self._entries[key] = raw
+                    changed.append(key)
+            deleted = [key for key, raw in entries.items() if raw is None]
+            for key, (raw, written_at) in list(self._pending.items()):
+                if raw is None:
+                    seen = key not in self._entries and (complete or any(_is_below(key, prefix) for prefix in deleted))
+                else:
+                    seen = entries.get(key) == raw
+                if seen:
+                    _metric_lag.observe(now - written_at)
+                    del self._pending[key]
+        return changed
+
+    def _notify(self, changed):
+        base = self._backend.backend_key("")
+        for backend_key in changed:
+            key = backend_key[len(base):]
+            for prefix, listener in self._change_listeners:
+                if _is_below(key, prefix):
+                    try:
+                        listener(key)
+                    except Exception as e:
+                        logger.error('Change listener for {} failed: {}'.format(key, e))
+
+    def _set_synced(self, prefix, synced):
+        self._synced[prefix] = synced
+        _metric_synced.set(1 if all(self._synced.values()) else 0)
+
+
+def _is_below(key, prefix):
+    return key == prefix or key.startswith(prefix + '/')
@@ -1,13 +1,19 @@
 """Handles Marathon interactions"""
 
+import threading
 import time
 from enum import Enum
 
 import requests
-from prometheus_client import Counter
+from prometheus_client import Counter, Gauge
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from requests.packages.urllib3.util.retry import Retry
 
 from .dcos_auth import retrieve_auth
+from .marathon_watcher import MarathonStateWatcher
+from ..settings import config
+from ..util.exception import TechnicalException
 from ..util.logging import logger
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
@@ -15,6 +21,11 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 MARATHON_URL_POSTFIX = '/service/marathon/v2'
 
+_marathon_error_metric = Counter('airfield_marathon_errors_total', 'MarathonAdapter Errors')
+_pool_in_use_metric = Gauge('airfield_marathon_pool_connections_in_use', 'Marathon connections currently checked out of the pool')
+_pool_idle_metric = Gauge('airfield_marathon_pool_connections_idle', 'Idle keep-alive marathon connections in the pool')
+_pool_opened_metric = Gauge('airfield_marathon_pool_connections_opened', 'Marathon connections opened since startup')
+
 
 class InstanceState(Enum):
     NOT_FOUND = 0
@@ -34,12 +45,45 @@ class MarathonAdapter(object):
         logger.info('Initializing MarathonAdapter.')
         self._setup_metrics()
         self.base_url, self.auth = retrieve_auth()
+        self._session = _create_session(self.auth)
+        self._setup_pool_metrics()
+        self._watcher = None
+        if config.MARATHON_WATCHER_ENABLED:
+            self._watcher = MarathonStateWatcher(self, _airfield_group_ids())
+            self._watcher.start()
+
+    def add_state_listener(self, listener) -> bool:
+        """
+        Registers a function that is called with app id and InstanceState whenever the state of a watched app changes.
+        Returns False if the state watcher is disabled, the listener is never called then.
+        """
+        if self._watcher is None:
+            return False
+        states = dict()
+        lock = threading.Lock()
+
+        def on_app(app_id, app):
+            state = _app_state(app) if app is not None else InstanceState.NOT_FOUND
+            with lock:
+                changed = states.get(app_id) != state
+                states[app_id] = state
+            if changed:
+                listener(app_id, state)
+        self._watcher.add_listener(on_app)
+        return True
 
     def get_instance_ip_address_and_port(self, instance_id: str) -> tuple:
         if not instance_id:
             raise Exception("No instance id provided")
+        if self._is_watched(instance_id):
+            tasks = (self._watcher.get_app(instance_id) or dict()).get("tasks")
+            if not tasks:
+                return None, None
+            return tasks[0].get("host"), tasks[0].get("ports")[0]
         url = self._get_marathon_url() + '/apps/%s/?embed=app.task' % instance_id
-        response = requests.get(url=url, auth=self.auth, verify=False)
+        response = self._request('GET', url)
+        if response is None:
+            return None, None
         try:
             task = response.json()['app'].get("tasks")[0]
             ip_address = task.get("host")
@@ -53,8 +97,13 @@ class MarathonAdapter(object):
     def get_instance_status(self, instance_id: str) -> InstanceState:
         if not instance_id:
             raise Exception("No instance id provided")
+        if self._is_watched(instance_id):
+            app = self._watcher.get_app(instance_id)
+            return _app_state(app) if app is not None else InstanceState.NOT_FOUND
         url = self._get_marathon_url() + '/apps/%s/?embed=app.counts' % instance_id
-        response = requests.get(url=url, auth=self.auth, verify=False)
+        response = self._request('GET', url)
+        if response is None:
+            return InstanceState.CONNECTION_ERROR
         if not response.ok:
             logger.error(response.text)
             if response.status_code == 404:
@@ -65,27 +114,91 @@ class MarathonAdapter(object):
                 self.marathon_error_metric.inc()
                 return InstanceState.CONNECTION_ERROR
         try:
-            state = response.json()['app']
-            if state.get('tasksHealthy') > 0 and state.get('tasksRunning') > 0:
-                return InstanceState.HEALTHY
-            if state.get('tasksUnhealthy', None) > 0:
-                return InstanceState.UNHEALTHY
-            if len(state.get('deployments', None)) > 0:
-                return InstanceState.DEPLOYING
-            if state.get('tasksStaged', None) > 0:
-                return InstanceState.STAGING
-            else:
-                return InstanceState.STOPPED
+            return _app_state(response.json()['app'])
         except KeyError as e:
             logger.error("Failed to get instance state: %s" % e)
             self.marathon_error_metric.inc()
             return InstanceState.NOT_FOUND
 
+    def get_instance_statuses(self, group_ids) -> dict:
+        """
+        Fetches the state of all apps in the given marathon groups with a single request per group.
+        Returns a dict that maps app ids (without leading slash) to their InstanceState. If a group could not be
+        fetched the group id itself is mapped to the error state so callers can report it for all apps in the group.
+        """
+        group_ids = [group_id.lstrip('/') for group_id in group_ids]
+        if self._watcher is not None and self._watcher.synced:
+            return {app_id: _app_state(app) for app_id, app in self._watcher.get_apps(group_ids)}
+        statuses = dict()
+        for group_id in group_ids:
+            url = self._get_marathon_url() + '/groups/%s?embed=group.apps&embed=group.apps.counts' % group_id
+            response = self._request('GET', url)
+            if response is None:
+                statuses[group_id] = InstanceState.CONNECTION_ERROR
+                continue
+            if not response.ok:
+                if response.status_code == 404:
+                    continue
+                logger.error(response.text)
+                if response.status_code == 401:
+                    statuses[group_id] = InstanceState.UNAUTHORIZED
+                else:
+                    self.marathon_error_metric.inc()
+                    statuses[group_id] = InstanceState.CONNECTION_ERROR
+                continue
+            try:
+                for app in _group_apps(response.json()):
+                    statuses[app['id'].lstrip('/')] = _app_state(app)
+            except KeyError as e:
+                logger.error("Failed to get group state: %s" % e)
+                self.marathon_error_metric.inc()
+                statuses[group_id] = InstanceState.CONNECTION_ERROR
+        return statuses
+
+    def get_app(self, app_id: str):
+        """Returns the app definition with task counts and tasks or None if the app does not exist"""
+        url = self._get_marathon_url() + '/apps/%s?embed=app.counts&embed=app.tasks' % app_id.lstrip('/')
+        response = self._request('GET', url)
+        if response is not None and response.status_code == 404:
+            return None
+        if response is None or not response.ok:
+            raise TechnicalException("Marathon app {} could not be fetched.".format(app_id))
+        return response.json()['app']
+
+    def get_group_apps(self, group_id: str) -> list:
+        """Returns all apps of a marathon group with task counts and tasks"""
+        url = self._get_marathon_url() + '/groups/%s?embed=group.apps&embed=group.apps.counts&embed=group.apps.tasks' % group_id
+        response = self._request('GET', url)
+        if response is not None and response.status_code == 404:
+            return list()
+        if response is None or not response.ok:
+            raise TechnicalException("Marathon group {} could not be fetched.".format(group_id))
+        return list(_group_apps(response.json()))
+
+    def open_event_stream(self, event_types):
+        """Subscribes to the marathon event stream. Returns the streaming response or None if it failed."""
+        url = self._get_marathon_url() + '/events?' + '&'.join('event_type=' + event_type for event_type in event_types)
+        try:
+            response = self._session.get(url, stream=True, headers={'Accept': 'text/event-stream'},
+                                         timeout=(config.MARATHON_CONNECT_TIMEOUT, config.MARATHON_WATCHER_RESYNC_SECONDS))
+        except requests.exceptions.RequestException as e:
+            logger.error("Failed to subscribe to marathon events: {}".format(e))
+            self.marathon_error_metric.inc()
+            return None
+        if not response.ok:
+            logger.error(response.text)
+            self.marathon_error_metric.inc()
+            response.close()
+            return None
+        return response
+
     def get_deployment_status(self, instance_id: str) -> bool:
         if not instance_id:
             raise Exception("No instance id provided")
         url = self._get_marathon_url() + '/apps/%s/tasks' % instance_id
-        response = requests.get(url=url, auth=self.auth, verify=False)
+        response = self._request('GET', url)
+        if response is None:
+            return False
         if response.ok:
             return len(response.json()["tasks"]) != 0
         else:
@@ -101,11 +214,14 @@ class MarathonAdapter(object):
 
     def deploy_instance(self, instance_definition) -> bool:
         url = self._get_marathon_url() + '/apps?force=true'  # will update an instance definition or create a new one
-        response = requests.put(url=url, json=[instance_definition], auth=self.auth, verify=False)
+        response = self._request('PUT', url, json=[instance_definition])
+        if response is None:
+            return False
         if not response.ok:
             logger.error(response.text)
             self.marathon_error_metric.inc()
             return False
+        self._refresh_watched(instance_definition['id'])
         return True
 
     def start_instance(self, instance_id: str) -> bool:
@@ -124,8 +240,11 @@ class MarathonAdapter(object):
 
     def restart_instance(self, instance_id: str) -> bool:
         url = self._get_marathon_url() + '/apps/{}/restart'.format(instance_id)
-        response = requests.post(url, auth=self.auth, verify=False)
+        response = self._request('POST', url)
+        if response is None:
+            return False
         if response.ok:
+            self._refresh_watched(instance_id)
             return True
         else:
             logger.error(response.text)
@@ -134,8 +253,11 @@ class MarathonAdapter(object):
 
     def delete_instance(self, instance_id: str) -> bool:
         url = self._get_marathon_url() + '/apps/{}'.format(instance_id)
-        response = requests.delete(url, auth=self.auth, verify=False)
+        response = self._request('DELETE', url)
+        if response is None:
+            return False
         if response.ok:
+            self._refresh_watched(instance_id)
             return True
         else:
             logger.error(response.text)
@@ -146,8 +268,11 @@ class MarathonAdapter(object):
         url = self._get_marathon_url() + '/apps/{}'.format(instance_id)
         logger.info('Patching instance. url={0} id={1}'.format(url, instance_id))
         logger.debug('Patch payload={}'.format(payload))
-        response = requests.patch(url, json=payload, auth=self.auth, verify=False)
+        response = self._request('PATCH', url, json=payload)
+        if response is None:
+            return False
         if response.ok:
+            self._refresh_watched(instance_id)
             return True
         else:
             logger.error(response.text)
@@ -167,9 +292,83 @@ class MarathonAdapter(object):
             state = self.get_instance_status(instance_id)
         return True
 
+    def _is_watched(self, app_id: str) -> bool:
+        return self._watcher is not None and self._watcher.synced and self._watcher.is_managed(app_id)
+
+    def _refresh_watched(self, app_id: str):
+        """Updates the watcher right after a change so following reads see it before the event arrives"""
+        if self._is_watched(app_id):
+            self._watcher.refresh(app_id)
+
+    def _request(self, method: str, url: str, **kwargs):
+        """Sends a request through the pooled session. Returns None if marathon could not be reached in time."""
+        try:
+            return self._session.request(method, url,
+                                         timeout=(config.MARATHON_CONNECT_TIMEOUT, config.MARATHON_READ_TIMEOUT),
+                                         **kwargs)
+        except requests.exceptions.RequestException as e:
+            logger.error("Marathon request failed. method={} url={} error={}".format(method, url, e))
+            self.marathon_error_metric.inc()
+            return None
+
     def _get_marathon_url(self) -> str:
         return self.base_url + MARATHON_URL_POSTFIX
 
     def _setup_metrics(self):
-        self.marathon_error_metric = Counter('airfield_marathon_errors_total',
-                                             'MarathonAdapter Errors')
+        self.marathon_error_metric = _marathon_error_metric
+
+    def _setup_pool_metrics(self):
+        pools = self._session.get_adapter('https://').poolmanager.pools
+
+        def connection_pools():
+            result = list()
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    result.append(pool)
+            return result
+
+        _pool_in_use_metric.set_function(lambda: sum(pool.pool.maxsize - pool.pool.qsize() for pool in connection_pools()))
+        _pool_idle_metric.set_function(lambda: sum(1 for pool in connection_pools() for conn in list(pool.pool.queue) if conn is not None))
+        _pool_opened_metric.set_function(lambda: sum(pool.num_connections for pool in connection_pools()))
+
+
+def _airfield_group_ids():
+    return sorted({config.MARATHON_APP_GROUP.strip('/')} |
+                  {group_id.strip('/') for group_id in config.DCOS_GROUPS_MAPPING.values()})
+
+
+def _create_session(auth) -> requests.Session:
+    """Creates a session that keeps connections to marathon alive and retries idempotent requests"""
+    retry = Retry(total=config.MARATHON_GET_RETRIES,
+                  backoff_factor=config.MARATHON_RETRY_BACKOFF,
+                  status_forcelist=(502, 503, 504),
+                  method_whitelist=frozenset(['GET']),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.MARATHON_POOL_SIZE, pool_block=True,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.auth = auth
+    session.verify = False
+    return session
+
+
+def _app_state(app: dict) -> InstanceState:
+    if app.get('tasksHealthy') > 0 and app.get('tasksRunning') > 0:
+        return InstanceState.HEALTHY
+    if app.get('tasksUnhealthy', None) > 0:
+        return InstanceState.UNHEALTHY
+    if len(app.get('deployments', None)) > 0:
+        return InstanceState.DEPLOYING
+    if app.get('tasksStaged', None) > 0:
+        return InstanceState.STAGING
+    else:
+        return InstanceState.STOPPED
+
+
+def _group_apps(group: dict):
+    yield from group.get('apps', list())
+    for sub_group in group.get('groups', list()):
+        yield from _group_apps(sub_group)
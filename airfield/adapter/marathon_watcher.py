@@ -0,0 +1,219 @@
+"""Keeps the marathon state of all airfield apps in memory, driven by the marathon event stream"""
+
+import json
+import threading
+import time
+
+from prometheus_client import Counter, Gauge
+
+from ..settings import config
+from ..util.exception import TechnicalException
+from ..util.logging import logger
+
+
+WATCHED_EVENT_TYPES = [
+    'status_update_event',
+    'health_status_changed_event',
+    'app_terminated_event',
+    'deployment_info',
+    'deployment_success',
+    'deployment_failed',
+    'deployment_step_success',
+    'deployment_step_failure',
+]
+
+_metric_events = Counter('airfield_marathon_watcher_events', 'Marathon events handled by the state watcher', ['event_type'])
+_metric_resyncs = Counter('airfield_marathon_watcher_resyncs', 'Full resyncs of the marathon state watcher', ['result'])
+_metric_synced = Gauge('airfield_marathon_watcher_synced', 'Whether the marathon state watcher serves reads from memory')
+
+
+class MarathonStateWatcher:
+    """
+    Mirrors the apps (including task counts and tasks) of the airfield marathon groups in memory.
+    A background thread subscribes to the marathon event stream and refreshes single apps when an event touches them,
+    a second thread does a full resync of all groups periodically. Reads should only be served from memory while
+    `synced` is true, i.e. the event stream is attached and a full resync succeeded after attaching.
+    Every fetch takes a sequence number when it starts, a fetched app only replaces the cached state of the app if
+    that was fetched earlier. So a resync never reverts an app that an event refreshed while the resync was running.
+    """
+    def __init__(self, marathon_adapter, group_ids):
+        self._marathon_adapter = marathon_adapter
+        self._group_ids = list(group_ids)
+        self._apps = dict()
+        # app id -> sequence number of the fetch the cached state (or its absence) comes from
+        self._fetched = dict()
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._stream_attached = False
+        # Counts the attachments of the event stream, a resync only counts for the attachment it started in
+        self._attachment = 0
+        self._resynced = False
+        self._stopped = threading.Event()
+        self._listeners = list()
+
+    def start(self):
+        threading.Thread(target=self._watch_events, name='marathon-event-watcher', daemon=True).start()
+        threading.Thread(target=self._resync_periodically, name='marathon-resync', daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    @property
+    def synced(self):
+        return self._stream_attached and self._resynced
+
+    def is_managed(self, app_id):
+        app_id = app_id.lstrip('/')
+        return any(app_id.startswith(group_id + '/') for group_id in self._group_ids)
+
+    def get_app(self, app_id):
+        """Returns the cached app definition or None if the app does not exist"""
+        with self._lock:
+            return self._apps.get(app_id.lstrip('/'))
+
+    def get_apps(self, group_ids):
+        """Returns (app id, app) for all cached apps in the given groups"""
+        prefixes = tuple(group_id + '/' for group_id in group_ids)
+        with self._lock:
+            return [(app_id, app) for app_id, app in self._apps.items() if app_id.startswith(prefixes)]
+
+    def add_listener(self, listener):
+        """Registers a function that is called with app id and app (None if it is gone) whenever an app was fetched"""
+        self._listeners.append(listener)
+
+    def refresh(self, app_id):
+        """Fetches a single app from marathon and updates the cache"""
+        app_id = app_id.lstrip('/')
+        sequence = self._next_sequence()
+        try:
+            app = self._marathon_adapter.get_app(app_id)
+        except TechnicalException as e:
+            logger.warning('Failed to refresh marathon app {}: {}'.format(app_id, e))
+            return
+        with self._lock:
+            if self._fetched.get(app_id, 0) > sequence:
+                # A resync that started later already stored a newer state
+                return
+            self._fetched[app_id] = sequence
+            if app is None:
+                self._apps.pop(app_id, None)
+            else:
+                self._apps[app_id] = app
+        self._notify(app_id, app)
+
+    def resync(self):
+        attachment = self._attachment
+        sequence = self._next_sequence()
+        apps = dict()
+        try:
+            for group_id in self._group_ids:
+                for app in self._marathon_adapter.get_group_apps(group_id):
+                    apps[app['id'].lstrip('/')] = app
+        except TechnicalException as e:
+            logger.warning('Marathon state resync failed: {}'.format(e))
+            _metric_resyncs.labels('failed').inc()
+            return False
+        with self._lock:
+            # Apps refreshed after the resync started keep their newer state
+            newer = {app_id: fetched for app_id, fetched in self._fetched.items() if fetched > sequence}
+            apps = {app_id: app for app_id, app in apps.items() if app_id not in newer}
+            removed_app_ids = set(self._apps) - set(apps) - set(newer)
+            self._fetched = {app_id: sequence for app_id in set(self._fetched) | set(self._apps) | set(apps)}
+            self._fetched.update(newer)
+            self._apps = dict(apps, **{app_id: self._apps[app_id] for app_id in newer if app_id in self._apps})
+            if self._stream_attached and attachment == self._attachment:
+                self._resynced = True
+        for app_id in removed_app_ids:
+            self._notify(app_id, None)
+        for app_id, app in apps.items():
+            self._notify(app_id, app)
+        _metric_resyncs.labels('success').inc()
+        _metric_synced.set(1 if self.synced else 0)
+        return True
+
+    def _next_sequence(self):
+        with self._lock:
+            self._sequence += 1
+            return self._sequence
+
+    def _notify(self, app_id, app):
+        for listener in self._listeners:
+            try:
+                listener(app_id, app)
+            except Exception as e:
+                logger.warning('Marathon app listener failed for {}: {}'.format(app_id, e))
+
+    def _resync_periodically(self):
+        while not self._stopped.wait(config.MARATHON_WATCHER_RESYNC_SECONDS):
+            if self._stream_attached:
+                self.resync()
+
+    def _watch_events(self):
+        while not self._stopped.is_set():
+            response = self._marathon_adapter.open_event_stream(WATCHED_EVENT_TYPES)
+            if response is None:
+                self._stopped.wait(config.MARATHON_WATCHER_RECONNECT_SECONDS)
+                continue
+            try:
+                with self._lock:
+                    self._attachment += 1
+                    self._resynced = False
+                    self._stream_attached = True
+                # Events that happened before the stream was attached are only visible through a full resync
+                self.resync()
+                for event_type, data in parse_event_stream(response.iter_lines(decode_unicode=True)):
+                    if self._stopped.is_set():
+                        break
+                    self._handle_event(event_type, data)
+            except Exception as e:
+                logger.warning('Marathon event stream interrupted: {}'.format(e))
+            finally:
+                with self._lock:
+                    self._stream_attached = False
+                    self._resynced = False
+                _metric_synced.set(0)
+                response.close()
+            self._stopped.wait(config.MARATHON_WATCHER_RECONNECT_SECONDS)
+
+    def _handle_event(self, event_type, data):
+        app_ids = {app_id.lstrip('/') for app_id in _event_app_ids(data) if self.is_managed(app_id)}
+        if not app_ids:
+            return
+        _metric_events.labels(event_type).inc()
+        for app_id in app_ids:
+            self.refresh(app_id)
+
+
+def parse_event_stream(lines):
+    """Parses server-sent events and yields (event type, json data) tuples"""
+    event_type = None
+    data = list()
+    for line in lines:
+        if line is None:
+            continue
+        if not line:
+            if data:
+                try:
+                    yield event_type, json.loads("\n".join(data))
+                except ValueError:
+                    logger.warning('Ignoring malformed marathon event {}'.format(event_type))
+            event_type = None
+            data = list()
+        elif line.startswith(':'):
+            continue
+        elif line.startswith('event:'):
+            event_type = line[len('event:'):].strip()
+        elif line.startswith('data:'):
+            data.append(line[len('data:'):].strip())
+
+
+def _event_app_ids(data):
+    if 'appId' in data:
+        yield data['appId']
+    steps = list(data.get('plan', dict()).get('steps', list()))
+    if 'currentStep' in data:
+        steps.append(data['currentStep'])
+    for step in steps:
+        for action in step.get('actions', list()):
+            if 'app' in action:
+                yield action['app']
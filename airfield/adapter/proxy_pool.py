@@ -0,0 +1,94 @@
+"""Keep-alive connection pools to the notebook instances behind the proxy"""
+
+import threading
+import time
+from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from prometheus_client import Counter, Gauge
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool
+
+from ..settings import config
+from ..util.logging import logger
+
+
+_metric_pools = Gauge("airfield_proxy_upstream_pools", "Number of open connection pools to notebook instances")
+_metric_pool_evictions = Counter("airfield_proxy_upstream_pool_evictions", "Closed connection pools to notebook instances", ["reason"])
+
+
+class ProxyPoolRegistry:
+    """
+    Hands out one requests.Session per upstream host:port so the proxy reuses keep-alive connections to the
+    zeppelin/jupyter tasks. At most PROXY_MAX_UPSTREAM_POOLS pools with PROXY_UPSTREAM_POOL_SIZE connections each
+    are held open, further requests to an upstream wait for a free connection. Pools are closed when they are idle for too long, when the pool limit is
+    reached or when the task of their instance moved to a different host:port.
+    """
+    def __init__(self):
+        self._pools = OrderedDict()  # host -> (session, last used)
+        self._instance_hosts = dict()
+        self._lock = threading.Lock()
+
+    def session(self, instance_id, host) -> requests.Session:
+        with self._lock:
+            now = time.monotonic()
+            self._close_idle(now)
+            previous_host = self._instance_hosts.get(instance_id)
+            if previous_host is not None and previous_host != host:
+                logger.debug("Task of instance {} moved from {} to {}".format(instance_id, previous_host, host))
+                self._close(previous_host, "moved")
+            self._instance_hosts[instance_id] = host
+            entry = self._pools.get(host)
+            session = entry[0] if entry else _create_session()
+            self._pools[host] = (session, now)
+            self._pools.move_to_end(host)
+            while len(self._pools) > config.PROXY_MAX_UPSTREAM_POOLS:
+                self._close(next(iter(self._pools)), "limit")
+            _metric_pools.set(len(self._pools))
+            return session
+
+    def drop_instance(self, instance_id):
+        """Closes the pool of an instance, e.g. after its task could not be reached"""
+        with self._lock:
+            host = self._instance_hosts.pop(instance_id, None)
+            if host is not None:
+                self._close(host, "error")
+            _metric_pools.set(len(self._pools))
+
+    def _close_idle(self, now):
+        for host, (_, last_used) in list(self._pools.items()):
+            if now - last_used > config.PROXY_UPSTREAM_POOL_IDLE_SECONDS:
+                self._close(host, "idle")
+
+    def _close(self, host, reason):
+        entry = self._pools.pop(host, None)
+        if entry is None:
+            return
+        for instance_id, instance_host in list(self._instance_hosts.items()):
+            if instance_host == host:
+                del self._instance_hosts[instance_id]
+        entry[0].close()
+        _metric_pool_evictions.labels(reason).inc()
+
+
+class _BoundedConnectionPool(HTTPConnectionPool):
+    """Waits at most PROXY_UPSTREAM_POOL_TIMEOUT_SECONDS for a free connection, requests does not pass a pool timeout"""
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(config.PROXY_UPSTREAM_POOL_TIMEOUT_SECONDS if timeout is None else timeout)
+
+
+class _BoundedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(self.poolmanager.pool_classes_by_scheme, http=_BoundedConnectionPool)
+
+
+def _create_session():
+    adapter = _BoundedHTTPAdapter(pool_connections=1, pool_maxsize=config.PROXY_UPSTREAM_POOL_SIZE, pool_block=True)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.verify = False
+    # The session is shared by all users, cookies set by an upstream must only reach the client that received them
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
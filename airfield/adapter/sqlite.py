@@ -0,0 +1,257 @@
+"""Key-value store in a local SQLite database for single node deployments."""
+
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from . import kv_codec
+from ..settings import config
+from ..util import metrics
+from ..util.logging import logger
+from ..util.exception import TechnicalException
+
+
+_error_metric = metrics.Counter("airfield_sqlite_errors", "Number of errors encountered with the SQLite database", [])
+
+# Secondary indexes over the instances: key of the value below the instance -> (column, path in the value)
+INSTANCE_BASE_KEYS = ["instances", "deleted_instances"]
+INSTANCE_INDEX_FIELDS = {
+    "metadata": [("created_by", ["created_by"])],
+    "configuration": [("group_name", ["admin", "group"]), ("delete_at", ["delete_at"])],
+}
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, mod_index INTEGER NOT NULL) WITHOUT ROWID",
+    # Incremented with every change, used as modify index of the written keys and to detect changes for watches
+    "CREATE TABLE IF NOT EXISTS kv_counter (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO kv_counter VALUES (0, 0)",
+    # A value that could not be indexed (e.g. because it is chunked) is marked, its instance is always a candidate
+    """CREATE TABLE IF NOT EXISTS instance_index (base_key TEXT NOT NULL, instance_id TEXT NOT NULL, created_by TEXT,
+       group_name TEXT, delete_at REAL, metadata_indexed INTEGER NOT NULL DEFAULT 1,
+       configuration_indexed INTEGER NOT NULL DEFAULT 1, PRIMARY KEY (base_key, instance_id))""",
+    "CREATE INDEX IF NOT EXISTS instance_index_created_by ON instance_index (base_key, created_by)",
+    "CREATE INDEX IF NOT EXISTS instance_index_group_name ON instance_index (base_key, group_name)",
+    "CREATE INDEX IF NOT EXISTS instance_index_delete_at ON instance_index (base_key, delete_at)",
+]
+
+
+class SqliteAdapter(object):
+    """
+    Stores the keys in one table whose primary key index serves the reads below a key as range scans.
+    The database uses write-ahead logging, so readers never block the writer. Every write runs in an immediate
+    transaction, which makes compare-and-swap and transactions safe across the processes of one host (e.g. the
+    gunicorn workers). Each thread and process uses its own connection.
+    Additionally the creator, group and deletion time of the instances are kept in indexed columns for
+    find_instance_ids.
+    """
+    def __init__(self, path=None):
+        self._path = path or config.SQLITE_PATH
+        logger.info('Initializing SqliteAdapter with {}'.format(self._path))
+        self._local = threading.local()
+        with self._write() as connection:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+
+    def get_key(self, key):
+        rows = self._read("SELECT value FROM kv WHERE key = ?", (self._build_key(key),))
+        return rows[0][0] if rows else None
+
+    def get_keys(self, key):
+        return self._read("SELECT key, value FROM kv WHERE " + _BELOW, _below_params(self._build_key(key)))
+
+    def get_key_names(self, key):
+        return [row[0] for row in self._read("SELECT key FROM kv WHERE " + _BELOW, _below_params(self._build_key(key)))]
+
+    def get_key_with_index(self, key):
+        rows = self._read("SELECT value, mod_index FROM kv WHERE key = ?", (self._build_key(key),))
+        return rows[0] if rows else (None, None)
+
+    def put_key(self, key, value):
+        with self._write() as connection:
+            self._put(connection, key, value)
+
+    def put_key_cas(self, key, value, index):
+        with self._write() as connection:
+            if not _check(connection, self._build_key(key), index):
+                return False
+            self._put(connection, key, value)
+            return True
+
+    def delete_key(self, key, recursive=False):
+        with self._write() as connection:
+            return self._delete(connection, key, recursive)
+
+    def txn(self, ops):
+        """Applies the operations in one database transaction, returns False if a check failed"""
+        with self._write() as connection:
+            if not all(_check(connection, self._build_key(op["key"]), op["index"]) for op in ops if op["verb"] == "check"):
+                return False
+            for op in ops:
+                if op["verb"] == "set":
+                    self._put(connection, op["key"], op["value"])
+                elif op["verb"] == "delete":
+                    self._delete(connection, op["key"], op["recursive"])
+            return True
+
+    def watch_keys(self, key, index, wait_seconds):
+        """
+        SQLite has no change notifications, so the change counter is polled. Returns the complete subtree and the
+        counter once it changed since the index, or nothing if the wait time passed.
+        """
+        deadline = time.monotonic() + wait_seconds
+        while index is not None and self._read("SELECT value FROM kv_counter")[0][0] <= index:
+            if time.monotonic() >= deadline:
+                return dict(), index, False
+            time.sleep(config.SQLITE_WATCH_POLL_SECONDS)
+        connection = self._connection()
+        try:
+            # Both reads see the same snapshot
+            connection.execute("BEGIN")
+            counter = connection.execute("SELECT value FROM kv_counter").fetchone()[0]
+            entries = dict(connection.execute("SELECT key, value FROM kv WHERE " + _BELOW, _below_params(self._build_key(key))))
+            connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            self._failed(connection, e)
+        return entries, counter, True
+
+    def find_instance_ids(self, base_key, created_by=None, group=None, delete_before=None):
+        """
+        Returns the ids of the instances below the base key that may match the filters, using the secondary indexes.
+        Instances whose values could not be indexed are always returned, so the caller has to check the filters again.
+        """
+        conditions = ["base_key = ?"]
+        params = [base_key]
+        if created_by is not None:
+            conditions.append("(created_by = ? OR metadata_indexed = 0)")
+            params.append(created_by)
+        if group is not None:
+            conditions.append("(group_name = ? OR configuration_indexed = 0)")
+            params.append(group)
+        if delete_before is not None:
+            conditions.append("(delete_at <= ? OR configuration_indexed = 0)")
+            params.append(delete_before)
+        return [row[0] for row in self._read("SELECT instance_id FROM instance_index WHERE " + " AND ".join(conditions), params)]
+
+    def backend_key(self, key):
+        """Returns the key as returned by get_keys"""
+        return self._build_key(key)
+
+    def _put(self, connection, key, value):
+        connection.execute("INSERT OR REPLACE INTO kv (key, value, mod_index) VALUES (?, ?, ?)",
+                           (self._build_key(key), value, _increment(connection)))
+        parts = key.split("/")
+        if len(parts) == 3 and parts[0] in INSTANCE_BASE_KEYS and parts[2] in INSTANCE_INDEX_FIELDS:
+            _index_instance_value(connection, parts[0], parts[1], parts[2], value)
+
+    def _delete(self, connection, key, recursive):
+        full_key = self._build_key(key)
+        if recursive:
+            deleted = connection.execute("DELETE FROM kv WHERE " + _BELOW, _below_params(full_key)).rowcount
+        else:
+            deleted = connection.execute("DELETE FROM kv WHERE key = ?", (full_key,)).rowcount
+        _increment(connection)
+        parts = key.split("/")
+        if parts[0] not in INSTANCE_BASE_KEYS:
+            if key == "" and recursive:
+                connection.execute("DELETE FROM instance_index")
+        elif len(parts) == 1 and recursive:
+            connection.execute("DELETE FROM instance_index WHERE base_key = ?", (parts[0],))
+        elif len(parts) == 2 and recursive:
+            connection.execute("DELETE FROM instance_index WHERE base_key = ? AND instance_id = ?", parts)
+        elif len(parts) == 3 and parts[2] in INSTANCE_INDEX_FIELDS:
+            _index_instance_value(connection, parts[0], parts[1], parts[2], None)
+        return deleted > 0
+
+    def _connection(self):
+        # Connections must not be shared between threads or be inherited by forked workers
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            try:
+                connection = sqlite3.connect(self._path, timeout=config.SQLITE_BUSY_TIMEOUT_SECONDS, isolation_level=None)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+            except sqlite3.Error as e:
+                logger.error(e)
+                _error_metric.inc()
+                raise TechnicalException("SQLite database cannot be opened.")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _read(self, statement, params=()):
+        connection = self._connection()
+        try:
+            return connection.execute(statement, params).fetchall()
+        except sqlite3.Error as e:
+            self._failed(connection, e)
+
+    @contextmanager
+    def _write(self):
+        connection = self._connection()
+        try:
+            # Takes the write lock right away, so the checks of a transaction cannot be invalidated before it commits
+            connection.execute("BEGIN IMMEDIATE")
+            yield connection
+            connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            self._failed(connection, e)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _failed(self, connection, error):
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+        logger.error(error)
+        _error_metric.inc()
+        raise TechnicalException("SQLite database cannot be used.")
+
+    def _build_key(self, key):
+        return "{}/{}".format(config.CONFIG_BASE_KEY, key)
+
+
+# The key itself and all keys below it, the range ends at the first key after "<key>/"
+_BELOW = "key = ? OR (key >= ? AND key < ?)"
+
+
+def _below_params(key):
+    prefix = key if key.endswith("/") else key + "/"
+    return key, prefix, prefix[:-1] + "0"
+
+
+def _check(connection, key, index):
+    row = connection.execute("SELECT mod_index FROM kv WHERE key = ?", (key,)).fetchone()
+    return (row[0] if row else None) == index
+
+
+def _increment(connection):
+    connection.execute("UPDATE kv_counter SET value = value + 1 WHERE id = 0")
+    return connection.execute("SELECT value FROM kv_counter WHERE id = 0").fetchone()[0]
+
+
+def _index_instance_value(connection, base_key, instance_id, name, raw):
+    """Updates the indexed columns of one value of an instance, raw None clears them"""
+    fields = INSTANCE_INDEX_FIELDS[name]
+    values = [None] * len(fields)
+    indexed = 1
+    if raw is not None:
+        try:
+            value = kv_codec.decode(raw)
+            values = [_lookup(value, path) for _, path in fields]
+        except (ValueError, TypeError, zlib.error):
+            # Chunked values are only readable through the KVAdapter
+            indexed = 0
+    connection.execute("INSERT OR IGNORE INTO instance_index (base_key, instance_id) VALUES (?, ?)", (base_key, instance_id))
+    assignments = ", ".join("{} = ?".format(column) for column, _ in fields)
+    connection.execute("UPDATE instance_index SET {}, {}_indexed = ? WHERE base_key = ? AND instance_id = ?".format(assignments, name),
+                       values + [indexed, base_key, instance_id])
+
+
+def _lookup(value, path):
+    for part in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
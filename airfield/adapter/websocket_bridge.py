@@ -0,0 +1,107 @@
+"""Cooperative bridge between a proxied websocket client and the websocket of a notebook instance"""
+
+import time
+
+import gevent
+import gevent.lock
+import websocket
+from prometheus_client import Counter, Gauge
+from websocket import ABNF
+
+from ..settings import config
+from ..util.logging import logger
+
+
+_metric_open_bridges = Gauge("airfield_websocket_bridges_open", "Open websocket bridges to notebook instances", ["instance_id"])
+_metric_bytes_relayed = Counter("airfield_websocket_bytes_relayed", "Bytes relayed through websocket bridges", ["instance_id", "direction"])
+
+
+class WebsocketBridge:
+    """
+    Relays messages between the client websocket (gevent-websocket) and the upstream websocket (websocket-client)
+    with one greenlet per direction. Each pump only receives the next message after the previous one was sent, so
+    a slow receiver slows down the sender instead of buffering messages in the worker.
+    A third greenlet pings both sides and ends the bridge if the upstream stops answering or no message was relayed
+    for WEBSOCKET_IDLE_TIMEOUT_SECONDS. The bridge is torn down as soon as either side closes.
+    The upstream has to be created with enable_multithread, it is written to from several greenlets.
+    """
+    def __init__(self, instance_id, client, upstream: websocket.WebSocket):
+        self._instance_id = instance_id
+        self._client = client
+        self._upstream = upstream
+        self._client_lock = gevent.lock.Semaphore()
+        self._last_activity = self._last_pong = time.monotonic()
+
+    def run(self):
+        _metric_open_bridges.labels(self._instance_id).inc()
+        greenlets = [gevent.spawn(self._client_to_upstream), gevent.spawn(self._upstream_to_client),
+                     gevent.spawn(self._keepalive)]
+        try:
+            gevent.wait(greenlets, count=1)
+        finally:
+            gevent.killall(greenlets)
+            self._close()
+            _metric_open_bridges.labels(self._instance_id).dec()
+
+    def _client_to_upstream(self):
+        try:
+            while True:
+                message = self._client.receive()
+                if message is None:
+                    return
+                self._last_activity = time.monotonic()
+                if isinstance(message, str):
+                    self._upstream.send(message)
+                    _metric_bytes_relayed.labels(self._instance_id, "upstream").inc(len(message.encode("utf-8")))
+                else:
+                    self._upstream.send_binary(message)
+                    _metric_bytes_relayed.labels(self._instance_id, "upstream").inc(len(message))
+        except Exception as e:
+            logger.debug("Websocket bridge for instance {} closed by client: {}".format(self._instance_id, e))
+
+    def _upstream_to_client(self):
+        try:
+            while True:
+                opcode, frame = self._upstream.recv_data_frame(control_frame=True)
+                if opcode == ABNF.OPCODE_CLOSE:
+                    return
+                if opcode == ABNF.OPCODE_PONG:
+                    self._last_pong = time.monotonic()
+                    continue
+                if opcode not in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+                    continue
+                self._last_activity = time.monotonic()
+                with self._client_lock:
+                    if opcode == ABNF.OPCODE_TEXT:
+                        self._client.send(frame.data.decode("utf-8"))
+                    else:
+                        self._client.send(frame.data, binary=True)
+                _metric_bytes_relayed.labels(self._instance_id, "client").inc(len(frame.data))
+        except Exception as e:
+            logger.debug("Websocket bridge for instance {} closed by upstream: {}".format(self._instance_id, e))
+
+    def _keepalive(self):
+        interval = config.WEBSOCKET_PING_INTERVAL_SECONDS
+        while True:
+            gevent.sleep(interval)
+            now = time.monotonic()
+            if now - self._last_activity > config.WEBSOCKET_IDLE_TIMEOUT_SECONDS:
+                logger.debug("Closing idle websocket bridge for instance {}".format(self._instance_id))
+                return
+            if now - self._last_pong > 2 * interval:
+                logger.warning("Upstream websocket of instance {} stopped answering pings".format(self._instance_id))
+                return
+            try:
+                self._upstream.ping()
+                with self._client_lock:
+                    self._client.send_frame(b"", self._client.OPCODE_PING)
+            except Exception as e:
+                logger.debug("Websocket keepalive for instance {} failed: {}".format(self._instance_id, e))
+                return
+
+    def _close(self):
+        for close in (self._upstream.close, self._client.close):
+            try:
+                close()
+            except Exception:
+                pass
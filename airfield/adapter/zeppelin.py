@@ -8,32 +8,48 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 
 class ZeppelinAdapter:
+    """
+    Client for the REST api of one zeppelin instance. After a login the credentials are kept, so requests that are
+    rejected with 401/403 because the session expired or the instance was restarted log in again and are retried once.
+    """
     def __init__(self, base_host):
         self.base_host = base_host
         self.session = requests.Session()
+        self._credentials = None
 
     def login(self, username, password):
         try:
             r = self.session.post(self.base_host + '/api/login', data={"userName": username, "password": password})
-        except ConnectionError:
+        except requests.exceptions.ConnectionError:
             raise ZeppelinException("Login at Zeppelin instance " + self.base_host + " was unsuccessful.")
         if not r.ok:
             raise ZeppelinException("Login at Zeppelin instance " + self.base_host + " was unsuccessful.")
+        self._credentials = (username, password)
+
+    def close(self):
+        self.session.close()
+
+    def _request(self, method, path, **kwargs):
+        r = self.session.request(method, self.base_host + path, **kwargs)
+        if r.status_code in (401, 403) and self._credentials is not None:
+            self.login(*self._credentials)
+            r = self.session.request(method, self.base_host + path, **kwargs)
+        return r
 
     def add_notebook(self, notebook):
-        r = self.session.post(self.base_host + '/api/notebook', json=notebook)
+        r = self._request('POST', '/api/notebook', json=notebook)
         if not r.ok:
             raise ZeppelinException(r.text)
         return r
 
     def import_notebook(self, notebook):
-        r = self.session.post(self.base_host + '/api/notebook/import', json=notebook)
+        r = self._request('POST', '/api/notebook/import', json=notebook)
         if not r.ok:
             raise ZeppelinException(r.text)
         return r
 
     def export_notebook(self, id):
-        r = self.session.get(self.base_host + '/api/notebook/export/'+id)
+        r = self._request('GET', '/api/notebook/export/' + id)
         if not r.ok:
             raise ZeppelinException(r.text)
         content = r.json()
@@ -44,7 +60,7 @@ class ZeppelinAdapter:
         return notebook
 
     def list_notebooks(self):
-        r = self.session.get(self.base_host + '/api/notebook')
+        r = self._request('GET', '/api/notebook')
         if not r.ok:
             raise ZeppelinException(r.text)
         return r.json()["body"]
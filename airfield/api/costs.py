@@ -0,0 +1,74 @@
+"""API for cost reports"""
+
+import csv
+import io
+from datetime import datetime
+
+from flask import Blueprint, request, Response
+
+from .auth import require_login
+from ..service.cost_report import CostReportService
+from ..util import metrics, dependency_injection as di
+from ..util.exception import ConfigurationException
+
+costs_blueprint = Blueprint('costs', __name__)
+
+REPORT_VALUE_COLUMNS = ["core_minutes", "gb_minutes", "running_time_seconds", "cost"]
+
+
+def register_blueprint(app):
+    app.register_blueprint(costs_blueprint)
+
+
+def instrumented_route(endpoint, method):
+    def wrapped(f):
+        return metrics.api_endpoint(endpoint, method)(
+            costs_blueprint.route(endpoint, endpoint="{}-{}".format(endpoint, method), methods=[method])(
+                require_login(f)))
+    return wrapped
+
+
+@instrumented_route('/api/costs/report', 'GET')
+def get_cost_report():
+    """
+    Returns the costs of all live and deleted instances between start and end (ISO dates or datetimes,
+    defaults to the current month), grouped by a comma separated list of user, group and day or week.
+    With format=csv the rows are streamed as CSV.
+    """
+    now = datetime.now()
+    try:
+        start = _parse_datetime(request.args.get("start"), datetime(now.year, now.month, 1))
+        end = _parse_datetime(request.args.get("end"), now)
+        group_by = [field for field in request.args.get("group_by", "user").split(",") if field]
+        report = di.get(CostReportService).create_report(start, end, group_by)
+    except ConfigurationException as e:
+        return dict(msg=e.error), 400
+    if request.args.get("format", "json").lower() == "csv":
+        return Response(_csv_rows(report["columns"] + REPORT_VALUE_COLUMNS, report["rows"]), mimetype="text/csv",
+                        headers={"Content-Disposition": "attachment; filename=airfield_costs.csv"})
+    return report
+
+
+def _parse_datetime(value, default):
+    if not value:
+        return default
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ConfigurationException("Invalid date: {}".format(value))
+    if parsed.tzinfo is not None:
+        # The report works with naive local times like datetime.now(), so dates with an offset are converted
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+def _csv_rows(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
@@ -1,4 +1,4 @@
-from . import airfield, instance, proxy, notebook
+from . import airfield, instance, proxy, notebook, costs
 
 
 def register_blueprints(app):
@@ -6,3 +6,4 @@ def register_blueprints(app):
     instance.register_blueprint(app)
     proxy.register_blueprint(app)
     notebook.register_blueprint(app)
+    costs.register_blueprint(app)
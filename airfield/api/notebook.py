@@ -50,8 +50,9 @@ def get_instance_notebooks(instance_id):
 
 @instrumented_route('/api/instance/<instance_id>/notebook/backup', 'POST')
 def backup_notebooks(instance_id):
-    di.get(NotebookService).backup_notebooks(instance_id)
-    return dict(instance_id=instance_id, status="finished"), 200
+    results = di.get(NotebookService).backup_notebooks(instance_id)
+    status = "finished" if all(result["status"] == "ok" for result in results) else "incomplete"
+    return dict(instance_id=instance_id, status=status, notebooks=results), 200
 
 
 @instrumented_route('/api/instance/<instance_id>/notebook/restore', 'POST')
@@ -60,6 +61,14 @@ def restore_notebooks(instance_id):
     return dict(instance_id=instance_id, status="started"), 200
 
 
+@instrumented_route('/api/instance/<instance_id>/notebook/restore', 'GET')
+def get_restore_status(instance_id):
+    restore = di.get(NotebookService).get_restore_status(instance_id)
+    if restore is None:
+        return dict(instance_id=instance_id, msg="No notebook restore found"), 404
+    return restore, 200
+
+
 @instrumented_route('/api/instance/<instance_id>/notebook/restore', 'DELETE')
 def cancel_restore_notebooks(instance_id):
     di.get(NotebookService).cancel_restore_notebooks(instance_id)
@@ -1,11 +1,12 @@
-import threading
-
 import requests
 import websocket
+from urllib3.exceptions import EmptyPoolError
 from flask import Blueprint, request, Response
 from flask_sockets import Sockets
 
 from .auth import require_login, get_user_name
+from ..adapter.proxy_pool import ProxyPoolRegistry
+from ..adapter.websocket_bridge import WebsocketBridge
 from ..service.instance import InstanceService
 from ..settings import config
 from ..util import dependency_injection as di
@@ -15,6 +16,7 @@ proxy_blueprint = Blueprint("proxy", __name__)
 websocket_blueprint = Blueprint("websocket", __name__)
 sockets = Sockets()
 instance_service = di.get(InstanceService)
+pool_registry = di.get(ProxyPoolRegistry)
 
 
 def register_blueprint(app):
@@ -24,46 +26,35 @@ def register_blueprint(app):
 
 
 def websocket_proxy_body(ws, instance_id=None, header=None, kernel_id=None):
-    client = websocket.WebSocket()
-    base_url = instance_service.get_instance_url(instance_id)
+    # The bridge writes to the upstream from several greenlets (messages, pings and the automatic pongs while
+    # receiving), the lock of websocket-client keeps their frames from interleaving
+    client = websocket.WebSocket(enable_multithread=True)
+    base_url = instance_service.resolve_instance_endpoint(instance_id)["url"]
     if kernel_id is not None:
         url = "ws://{}/proxy/{}/api/kernels/{}/channels?{}".format(base_url, instance_id, kernel_id,
                                                                    request.query_string.decode("utf-8"))
     else:
         url = "ws://{}/ws".format(base_url)
 
-    if header is None:
-        client.connect(url)
-    else:
-        client.connect(url,
-                       header=header)
-    stop_event = threading.Event()
-
-    def loop():
-        while not stop_event.is_set():
-            msg = client.recv()
-            if msg:
-                ws.send(msg)
-
-    thread = threading.Thread(target=loop)
-    thread.start()
-    while not ws.closed:
-        message = ws.receive()
-        if message:
-            client.send(message)
-    stop_event.set()
-    thread.join()
+    try:
+        if header is None:
+            client.connect(url)
+        else:
+            client.connect(url,
+                           header=header)
+    except (OSError, websocket.WebSocketException):
+        # The instance task might have moved, resolve it again on the next connect
+        instance_service.invalidate_instance_endpoint(instance_id)
+        raise
+    WebsocketBridge(instance_id, ws, client).run()
 
 
 @websocket_blueprint.route("/proxy/<instance_id>/ws")
 @require_login
 def websocket_proxy_zeppelin(ws, instance_id=None):
     instance_id = clean_input_string(instance_id)
-    if config.OIDC_ACTIVATED:
-        user_name = get_user_name()
-        admins = instance_service.get_instance_admins(instance_id)
-        if admins and user_name not in admins:
-            return dict(msg="User not authorized for instance"), 403
+    if not _is_authorized(instance_service.resolve_instance_endpoint(instance_id)):
+        return dict(msg="User not authorized for instance"), 403
     websocket_proxy_body(ws=ws, instance_id=instance_id)
 
 
@@ -71,11 +62,8 @@ def websocket_proxy_zeppelin(ws, instance_id=None):
 @require_login
 def websocket_proxy_jupyter(ws, instance_id=None, kernel_id=None):
     instance_id = clean_input_string(instance_id)
-    if config.OIDC_ACTIVATED:
-        user_name = get_user_name()
-        admins = instance_service.get_instance_admins(instance_id)
-        if admins and user_name not in admins:
-            return dict(msg="User not authorized for instance"), 403
+    if not _is_authorized(instance_service.resolve_instance_endpoint(instance_id)):
+        return dict(msg="User not authorized for instance"), 403
     websocket_proxy_body(ws=ws, instance_id=instance_id, kernel_id=kernel_id, header={key: value for (key, value) in request.headers if key != "Host" and key != "Content-Length" and key != "If-Modified-Since"})
 
 
@@ -84,28 +72,82 @@ def websocket_proxy_jupyter(ws, instance_id=None, kernel_id=None):
 @require_login
 def proxy(instance_id, path):
     instance_id = clean_input_string(instance_id)
-    if config.OIDC_ACTIVATED:
-        user_name = get_user_name()
-        admins = instance_service.get_instance_admins(instance_id)
-        if admins and user_name not in admins:
-            return dict(msg="User not authorized for instance"), 403
-    instance_type = instance_service.get_instance_type(instance_id)
-    base_url = instance_service.get_instance_url(instance_id)
+    endpoint = instance_service.resolve_instance_endpoint(instance_id)
+    if not _is_authorized(endpoint):
+        return dict(msg="User not authorized for instance"), 403
+    instance_type = endpoint["type"]
+    base_url = endpoint["url"]
     if instance_type == "jupyter":
         base_url = "{}/proxy/{}".format(base_url, instance_id)
     url = "http://{}/{}".format(base_url, path)
-    resp = requests.request(
-        method=request.method,
-        url=url,
-        headers={key: value for (key, value) in request.headers if
-                 key != "Host" and key != "Content-Length" and key != "If-Modified-Since"},
-        data=request.get_data(),
-        allow_redirects=False,
-        verify=False)
+    streaming = config.PROXY_STREAMING_ENABLED
+    session = pool_registry.session(instance_id, endpoint["url"])
+    try:
+        resp = session.request(
+            method=request.method,
+            url=url,
+            headers={key: value for (key, value) in request.headers if
+                     key != "Host" and key != "Content-Length" and key != "If-Modified-Since"},
+            data=_request_body() if streaming else request.get_data(),
+            allow_redirects=False,
+            stream=streaming,
+            verify=False)
+    except requests.exceptions.ConnectionError:
+        # The instance task might have moved, resolve it again on the next request
+        instance_service.invalidate_instance_endpoint(instance_id)
+        pool_registry.drop_instance(instance_id)
+        return dict(msg="Instance cannot be reached"), 502
+    except EmptyPoolError:
+        # All connections to the instance stayed busy for PROXY_UPSTREAM_POOL_TIMEOUT_SECONDS
+        return dict(msg="Instance is busy"), 503
     excluded_headers = ["content-encoding", "content-length", "transfer-encoding", "connection"]
     if instance_type == "zeppelin":
         excluded_headers.append("location")
     headers = [(name, value) for (name, value) in resp.raw.headers.items()
                if name.lower() not in excluded_headers]
-    response = Response(resp.content, resp.status_code, headers)
+    response = Response(_response_body(resp) if streaming else resp.content, resp.status_code, headers)
     return response
+
+
+def _is_authorized(endpoint):
+    if not config.OIDC_ACTIVATED:
+        return True
+    admins = endpoint["admins"]
+    return not admins or get_user_name() in admins
+
+
+class _RequestBody:
+    """Forwards the incoming request body in chunks with a known length, so it is never buffered completely"""
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return _read_chunks(self._stream)
+
+
+def _request_body():
+    if request.content_length:
+        return _RequestBody(request.stream, request.content_length)
+    if request.headers.get("Transfer-Encoding", "").lower() == "chunked":
+        # Without a length requests forwards the generator with chunked transfer encoding
+        return _read_chunks(request.stream)
+    return None
+
+
+def _read_chunks(stream):
+    while True:
+        chunk = stream.read(config.PROXY_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _response_body(resp):
+    try:
+        yield from resp.iter_content(chunk_size=config.PROXY_CHUNK_SIZE)
+    finally:
+        resp.close()
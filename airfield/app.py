@@ -2,6 +2,7 @@ import base64
 from flask_cors import CORS
 from flask_api import FlaskAPI
 from flask_log_request_id import RequestID
+from . import commands
 from .api import main, oidc
 from .service.cleanup import InstanceCleanupService
 from .settings import config, base
@@ -28,6 +29,7 @@ def create_app():
     RequestID(app)
     logger.info('Registering APIs...')
     main.register_blueprints(app)
+    commands.register_commands(app)
     logger.info('Flask app prepared.')
     # Init here so service can start its scheduler
     di.get(InstanceCleanupService)
@@ -0,0 +1,85 @@
+"""Maintenance commands, run with `FLASK_APP="run:create_app()" flask <command>`"""
+
+import click
+from .adapter.consul import ConsulAdapter
+from .adapter.etcd import EtcdAdapter
+from .adapter.etcd3 import Etcd3Adapter
+from .adapter.kv import KVAdapter, copy_raw_keys
+from .service.costs import CostLedgerService
+from .settings import config
+from .storage.kv_benchmark import run_benchmark
+from .storage.notebook import NotebookStore
+from .storage.notebook_blob import NotebookBlobStore
+from .util import dependency_injection as di
+
+
+def register_commands(app):
+    app.cli.add_command(recompute_costs)
+    app.cli.add_command(migrate_notebook_index)
+    app.cli.add_command(collect_notebook_garbage)
+    app.cli.add_command(migrate_etcd_v3)
+    app.cli.add_command(benchmark_kv)
+
+
+@click.command("recompute-costs")
+@click.option("--deleted/--no-deleted", default=True, help="Also recompute the totals of deleted instances.")
+def recompute_costs(deleted):
+    """Rebuilds the cost totals of all instances from their raw runtimes."""
+    cost_ledger = di.get(CostLedgerService)
+    count = cost_ledger.recompute()
+    if deleted:
+        count += cost_ledger.recompute(deleted=True)
+    click.echo("Recomputed the cost totals of {} instances.".format(count))
+
+
+@click.command("migrate-notebook-index")
+def migrate_notebook_index():
+    """Rebuilds the notebook metadata index and name lookup from the stored notebooks."""
+    count = di.get(NotebookStore).migrate_index()
+    click.echo("Indexed {} notebooks.".format(count))
+
+
+@click.command("collect-notebook-garbage")
+@click.option("--grace-seconds", type=float, default=config.NOTEBOOK_GC_GRACE_SECONDS,
+              help="Only remove notebooks that have been unreferenced for this long.")
+def collect_notebook_garbage(grace_seconds):
+    """Removes stored notebook bodies that are not referenced by any backup, template or export anymore."""
+    count = di.get(NotebookBlobStore).collect_garbage(grace_seconds)
+    click.echo("Removed {} unreferenced notebooks.".format(count))
+
+
+@click.command("migrate-etcd-v3")
+@click.option("--overwrite/--no-overwrite", default=False, help="Replace keys that already exist in etcd v3.")
+def migrate_etcd_v3(overwrite):
+    """Copies all keys from etcd v2 (AIRFIELD_ETCD_ENDPOINT) to etcd v3 (AIRFIELD_ETCD3_ENDPOINT)."""
+    if not config.ETCD_ENDPOINT or not config.ETCD3_ENDPOINT:
+        raise click.UsageError("Both AIRFIELD_ETCD_ENDPOINT and AIRFIELD_ETCD3_ENDPOINT must be set.")
+    copied, skipped = copy_raw_keys(di.get(EtcdAdapter), di.get(Etcd3Adapter), overwrite=overwrite)
+    click.echo("Copied {} keys, skipped {} existing keys.".format(copied, skipped))
+
+
+_BENCHMARK_BACKENDS = dict(consul=ConsulAdapter, etcd=EtcdAdapter, etcd3=Etcd3Adapter)
+
+
+@click.command("benchmark-kv")
+@click.option("--backend", "backends", multiple=True, type=click.Choice(sorted(_BENCHMARK_BACKENDS)),
+              help="Backend to measure, can be given multiple times. Defaults to all configured backends.")
+@click.option("--instances", "instance_counts", multiple=True, type=int, default=[1000, 10000],
+              help="Number of synthetic instances, can be given multiple times.")
+@click.option("--reads", type=int, default=200, help="Number of single instance reads to measure.")
+def benchmark_kv(backends, instance_counts, reads):
+    """Measures listing and reading instances with synthetic instances stored below <base key>-benchmark."""
+    endpoints = dict(consul=config.CONSUL_ENDPOINT, etcd=config.ETCD_ENDPOINT, etcd3=config.ETCD3_ENDPOINT)
+    backends = backends or [backend for backend in sorted(_BENCHMARK_BACKENDS) if endpoints[backend]]
+    base_key = config.CONFIG_BASE_KEY
+    # The backends build their keys with the base key, so the synthetic instances never mix with real ones
+    config.CONFIG_BASE_KEY = base_key + "-benchmark"
+    try:
+        for backend in backends:
+            kv_adapter = KVAdapter(di.get(_BENCHMARK_BACKENDS[backend]), mirror_prefixes=list())
+            for instance_count in instance_counts:
+                for operation, result in run_benchmark(kv_adapter, instance_count, reads).items():
+                    click.echo("{:8} {:>7} instances  {:18} median {:9.2f} ms  p95 {:9.2f} ms".format(
+                        backend, instance_count, operation, result["median_ms"], result["p95_ms"]))
+    finally:
+        config.CONFIG_BASE_KEY = base_key
@@ -3,7 +3,9 @@
 from datetime import datetime
 from .instance import InstanceService
 from .scheduler import SchedulerService
+from ..settings import config
 from ..util import dependency_injection as di
+from ..util.logging import logger
 
 
 class InstanceCleanupService:
@@ -13,12 +15,12 @@ class InstanceCleanupService:
         scheduler.add_job(self._run, 'interval', id='run', minutes=30)
 
     def _run(self):
-        now = datetime.now()
         # Delete instances who have a delete_at time that is elapsed
-        for instance in self._instance_service.get_instance_configurations():
-            delete_at = instance["configuration"].get("delete_at")
-            if not delete_at:
-                continue
-            delete_at_time = datetime.fromisoformat(delete_at)
-            if now >= delete_at_time:
-                self._instance_service.delete_instance(instance["instance_id"])
+        instance_ids = list(self._instance_service.get_overdue_instance_ids(datetime.now()))
+        if not config.INSTANCE_CLEANUP_DELETE_ENABLED:
+            if instance_ids:
+                logger.info("Dry run, set AIRFIELD_INSTANCE_CLEANUP_DELETE_ENABLED=true to delete the overdue instances {}"
+                            .format(", ".join(instance_ids)))
+            return
+        for instance_id in instance_ids:
+            self._instance_service.delete_instance(instance_id)
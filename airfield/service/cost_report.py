@@ -0,0 +1,155 @@
+"""Cost reports over the runtimes of all live and deleted instances"""
+
+from datetime import datetime, timedelta
+import numpy as np
+from ..settings import config
+from ..storage.instance import InstanceStore
+from ..util import dependency_injection as di
+from ..util import metrics
+from ..util.exception import ConfigurationException
+
+
+GROUP_BY_FIELDS = ["user", "group"]
+GROUP_BY_PERIODS = ["day", "week"]
+# Number of runtime intervals whose overlaps with the report periods are computed at once, bounds the memory usage
+_CHUNK_SIZE = 4096
+
+
+class CostReportService:
+    """
+    Aggregates the costs of all runtimes within a time window by creator, DC/OS group and/or day or week.
+    The runtimes are loaded into columnar arrays and clipped to the window, the aggregation is done with numpy.
+    """
+    @di.inject
+    def __init__(self, instance_store: InstanceStore):
+        self._instance_store = instance_store
+
+    @metrics.instrument
+    def create_report(self, start, end, group_by, now=None):
+        """
+        :param start: start of the report window as datetime
+        :param end: end of the report window as datetime
+        :param group_by: list of fields (user, group) and at most one period (day, week) to aggregate by
+        :param now: timestamp used as end of runtimes that are still open
+        :return: dict with the grouping columns and the rows of the report, sorted by these columns
+        """
+        fields, period = _parse_group_by(group_by)
+        if end <= start:
+            raise ConfigurationException("The end of the report must be after its start!")
+        if now is None:
+            now = datetime.now().timestamp()
+        columns = self._load_runtimes()
+        boundaries, labels = _periods(start, end, period)
+        period_starts = np.array([boundary.timestamp() for boundary in boundaries[:-1]])
+        period_ends = np.array([boundary.timestamp() for boundary in boundaries[1:]])
+
+        keys = [columns[field] for field in fields]
+        key_ids, key_values = _combine_keys(keys, len(columns["started_at"]))
+        seconds = np.zeros((len(key_values), len(period_starts)))
+        core_seconds = np.zeros_like(seconds)
+        gb_seconds = np.zeros_like(seconds)
+        stopped_at = np.where(np.isnan(columns["stopped_at"]), now, columns["stopped_at"])
+        for offset in range(0, len(stopped_at), _CHUNK_SIZE):
+            chunk = slice(offset, offset + _CHUNK_SIZE)
+            # Seconds every runtime of the chunk overlaps with every period, shape (runtimes, periods)
+            overlap = np.minimum(stopped_at[chunk, None], period_ends[None, :]) - \
+                np.maximum(columns["started_at"][chunk, None], period_starts[None, :])
+            np.clip(overlap, 0, None, out=overlap)
+            bins = (key_ids[chunk, None] * len(period_starts) + np.arange(len(period_starts))[None, :]).ravel()
+            size = seconds.size
+            seconds += np.bincount(bins, overlap.ravel(), minlength=size).reshape(seconds.shape)
+            core_seconds += np.bincount(bins, (overlap * columns["cores"][chunk, None]).ravel(),
+                                        minlength=size).reshape(seconds.shape)
+            gb_seconds += np.bincount(bins, (overlap * columns["memory"][chunk, None] / 1024).ravel(),
+                                      minlength=size).reshape(seconds.shape)
+
+        core_minutes = core_seconds / 60
+        gb_minutes = gb_seconds / 60
+        costs = config.COST_CORE_PER_MINUTE * core_minutes + config.COST_GB_PER_MINUTE * gb_minutes
+        rows = list()
+        for key_index, period_index in zip(*np.nonzero(seconds)):
+            row = dict(zip(fields, key_values[key_index]))
+            if period is not None:
+                row[period] = labels[period_index]
+            row.update(core_minutes=float(core_minutes[key_index, period_index]),
+                       gb_minutes=float(gb_minutes[key_index, period_index]),
+                       running_time_seconds=float(seconds[key_index, period_index]),
+                       cost=float(costs[key_index, period_index]))
+            rows.append(row)
+        columns = fields + ([period] if period is not None else list())
+        rows.sort(key=lambda row: tuple(row[column] for column in columns))
+        return dict(start=start.isoformat(), end=end.isoformat(), columns=columns, currency=config.COST_CURRENCY,
+                    total_cost=float(costs.sum()), rows=rows)
+
+    def _load_runtimes(self):
+        """Loads the runtimes of all live and deleted instances into columnar arrays"""
+        live_instances, deleted_instances = self._instance_store.get_all_instances_with_runtimes()
+        # An instance that is being deleted can show up in both, the deleted record is the final one
+        instances = {**live_instances, **deleted_instances}
+        started_at, stopped_at, cores, memory, users, groups = list(), list(), list(), list(), list(), list()
+        for data in instances.values():
+            user = data.get("metadata", dict()).get("created_by")
+            group = data.get("configuration", dict()).get("admin", dict()).get("group")
+            for runtime in data["runtimes"]:
+                started_at.append(runtime["started_at"])
+                stopped_at.append(runtime["stopped_at"] if runtime["stopped_at"] is not None else np.nan)
+                cores.append(runtime["cores"])
+                memory.append(runtime["memory"])
+                users.append(user or "")
+                groups.append(group or "")
+        return dict(started_at=np.array(started_at, dtype=float), stopped_at=np.array(stopped_at, dtype=float),
+                    cores=np.array(cores, dtype=float), memory=np.array(memory, dtype=float),
+                    user=np.array(users, dtype=object), group=np.array(groups, dtype=object))
+
+
+def _parse_group_by(group_by):
+    fields = [field for field in group_by if field in GROUP_BY_FIELDS]
+    periods = [field for field in group_by if field in GROUP_BY_PERIODS]
+    unknown = [field for field in group_by if field not in GROUP_BY_FIELDS + GROUP_BY_PERIODS]
+    if unknown:
+        raise ConfigurationException("Cannot group costs by {}!".format(", ".join(unknown)))
+    if len(periods) > 1:
+        raise ConfigurationException("Costs can only be grouped by one of {}!".format(", ".join(GROUP_BY_PERIODS)))
+    return fields, periods[0] if periods else None
+
+
+def _periods(start, end, period):
+    """
+    Returns the boundaries of the report periods, the first and last one are clipped to the window,
+    and the labels of the periods, i.e. the date of the day or of the monday of the week.
+    """
+    if period is None:
+        return [start, end], [None]
+    current = datetime(start.year, start.month, start.day)
+    if period == "day":
+        step = timedelta(days=1)
+    else:
+        current -= timedelta(days=start.weekday())
+        step = timedelta(weeks=1)
+    boundaries = [start]
+    labels = [current.date().isoformat()]
+    current += step
+    while current < end:
+        boundaries.append(current)
+        labels.append(current.date().isoformat())
+        current += step
+    boundaries.append(end)
+    return boundaries, labels
+
+
+def _combine_keys(keys, length):
+    """Maps the combination of the given key columns to consecutive ids, returns the ids and the key tuples"""
+    if not keys:
+        return np.zeros(length, dtype=np.int64), [tuple()]
+    codes = list()
+    uniques = list()
+    for key in keys:
+        unique, inverse = np.unique(key.astype(str), return_inverse=True)
+        codes.append(inverse)
+        uniques.append(unique)
+    combined = np.ravel_multi_index(codes, [len(unique) for unique in uniques]) if length else np.zeros(0, dtype=np.int64)
+    combined_unique, key_ids = np.unique(combined, return_inverse=True)
+    key_values = [tuple(str(unique[index]) for unique, index in
+                        zip(uniques, np.unravel_index(value, [len(unique) for unique in uniques])))
+                  for value in combined_unique]
+    return key_ids, key_values
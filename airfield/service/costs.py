@@ -0,0 +1,48 @@
+"""Cost ledger that calculates instance costs from the pre-aggregated runtime totals"""
+
+from datetime import datetime
+from ..settings import config
+from ..storage.instance import InstanceStore, add_runtime_to_totals, runtime_totals
+from ..util import dependency_injection as di
+from ..util.logging import logger
+
+
+class CostLedgerService:
+    """
+    The runtime head of every instance keeps running totals (core minutes, GB minutes and running seconds) of its
+    closed runtimes, which the instance store updates whenever a runtime is finished. Costs are calculated from these
+    totals plus the open runtime, so they do not depend on the number of runtimes of an instance.
+    """
+    @di.inject
+    def __init__(self, instance_store: InstanceStore):
+        self._instance_store = instance_store
+
+    def calculate_costs(self, instance_id, instance_data, deleted=False, now=None):
+        runtime_head = instance_data["runtime_head"]
+        if "totals" in runtime_head:
+            totals = dict(runtime_head["totals"])
+        else:
+            # Written before the totals were introduced, the next runtime update or a recompute adds them
+            totals = runtime_totals(self._instance_store.get_runtimes(instance_id, deleted=deleted))
+        if runtime_head["open"] is not None:
+            if now is None:
+                now = datetime.now().timestamp()
+            add_runtime_to_totals(totals, runtime_head["open"], stopped_at=now)
+        return _costs_of_totals(totals)
+
+    def calculate_costs_per_hour(self, cost_factors):
+        runtime = dict(started_at=0, stopped_at=3600, cores=cost_factors["cores"], memory=cost_factors["memory"])
+        return _costs_of_totals(runtime_totals([runtime]))["cost"]
+
+    def recompute(self, deleted=False):
+        """Rebuilds the totals of all (deleted) instances from their raw runtimes. Returns the number of instances."""
+        instance_ids = self._instance_store.get_instance_ids(deleted=deleted)
+        for instance_id in instance_ids:
+            totals = self._instance_store.recompute_runtime_totals(instance_id, deleted=deleted)
+            logger.debug('Recomputed runtime totals of instance {}: {}'.format(instance_id, totals))
+        return len(instance_ids)
+
+
+def _costs_of_totals(totals):
+    cost = config.COST_CORE_PER_MINUTE * totals["core_minutes"] + config.COST_GB_PER_MINUTE * totals["gb_minutes"]
+    return dict(cost=cost, running_time_seconds=int(totals["running_seconds"]))
@@ -7,10 +7,12 @@ from ..storage.instance import InstanceStore
 from ..adapter.marathon import MarathonAdapter, InstanceState
 from .instance_zeppelin import ZeppelinInstanceService
 from .instance_jupyter import JupyterInstanceService
+from .costs import CostLedgerService
 from ..configuration.service import ConfigurationService
 from ..settings import config
 from ..util import dependency_injection as di
 from ..util import metrics
+from ..util.cache import TTLCache
 from ..util.logging import logger
 from ..api.auth import get_airfield_groups, get_user_groups
 
@@ -19,21 +21,29 @@ from ..util.exception import ConfigurationException, InstanceRunningTimeExceptio
 class InstanceService:
     @di.inject
     def __init__(self, zeppelin_instance: ZeppelinInstanceService, configuration_service: ConfigurationService,
-                 instance_store: InstanceStore, marathon_adapter: MarathonAdapter, jupyter_instance: JupyterInstanceService):
+                 instance_store: InstanceStore, marathon_adapter: MarathonAdapter, jupyter_instance: JupyterInstanceService,
+                 cost_ledger: CostLedgerService):
         self._zeppelin_instance_service = zeppelin_instance
+        self._cost_ledger = cost_ledger
         self._jupyter_instance_service = jupyter_instance
         self._configuration_service = configuration_service
         self._instance_store = instance_store
         self._marathon_adapter = marathon_adapter
+        self._endpoint_cache = TTLCache("instance_endpoint", config.PROXY_ENDPOINT_CACHE_SIZE,
+                                        config.PROXY_ENDPOINT_CACHE_TTL_SECONDS)
+        self._invalidation_listeners = list()
+        # Other workers change instances as well, without the mirror their cached endpoints expire with the TTL
+        instance_store.add_change_listener(self.invalidate_instance_endpoint)
 
     @metrics.instrument
     def get_instances(self, deleted=False):
         instances = list()
-        instance_ids = self._instance_store.get_instance_ids(deleted=deleted)
-        for instance_id in instance_ids:
-            status = self.get_instance(instance_id, deleted=deleted)
-            if status != {}:
-                instances.append(status)
+        instance_configurations = self._instance_store.get_all_instances(deleted=deleted)
+        # Fetch the marathon state of all instances with one request per marathon group instead of one per instance
+        statuses = dict() if deleted else self.get_instance_statuses(instance_configurations)
+        for instance_id, instance_configuration in instance_configurations.items():
+            instances.append(self._build_instance(instance_id, instance_configuration, deleted,
+                                                  status=statuses.get(instance_id)))
         return dict(instances=instances)
 
     @metrics.instrument
@@ -41,28 +51,28 @@ class InstanceService:
         instance_configuration = self._instance_store.get_instance(instance_id, deleted=deleted)
         if not instance_configuration:
             return {}
-        instance = self.get_instance_state(instance_id, instance_configuration=instance_configuration, deleted=deleted)
-        instance["details"] = self._calculate_instance_details(instance_configuration)
-        instance["proxy_url"] = "/proxy/{}".format(instance_id)
-        return instance
+        return self._build_instance(instance_id, instance_configuration, deleted)
 
     @metrics.instrument
-    def get_instance_state(self, instance_id, instance_configuration=None, deleted=False):
+    def get_instance_state(self, instance_id, instance_configuration=None, deleted=False, status=None):
         if instance_configuration is None:
             instance_configuration = self._instance_store.get_instance(instance_id, deleted=deleted)
-        status = InstanceState.NOT_FOUND
         stuck_deploying = False
         stuck_duration_seconds = 0
-        if instance_configuration:
-            status = InstanceState.DELETED if deleted else self._marathon_adapter.get_instance_status(
+        if not instance_configuration:
+            status = InstanceState.NOT_FOUND
+        elif deleted:
+            status = InstanceState.DELETED
+        elif status is None:
+            status = self._marathon_adapter.get_instance_status(
                 _instance_path(instance_configuration["configuration"], instance_id))
-            if status == InstanceState.DEPLOYING:
-                runtimes = instance_configuration["runtimes"]
-                if runtimes and runtimes[-1]["stopped_at"] is None:
-                    started_at = datetime.fromtimestamp(runtimes[-1]["started_at"])
-                    if started_at + timedelta(seconds=10 * 60) <= datetime.now():
-                        stuck_deploying = True
-                        stuck_duration_seconds = (datetime.now() - started_at).seconds
+        if status == InstanceState.DEPLOYING:
+            open_runtime = instance_configuration["runtime_head"]["open"]
+            if open_runtime is not None:
+                started_at = datetime.fromtimestamp(open_runtime["started_at"])
+                if started_at + timedelta(seconds=10 * 60) <= datetime.now():
+                    stuck_deploying = True
+                    stuck_duration_seconds = int((datetime.now() - started_at).total_seconds())
         return {
             "instance_id": instance_id,
             "status": status.name,
@@ -77,19 +87,37 @@ class InstanceService:
 
     @metrics.instrument
     def get_instance_admins(self, instance_id):
-        data = self._instance_store.get_instance(instance_id)
-        return data["configuration"]["admin"]["admins"] + [data["metadata"]["created_by"]]
+        return _instance_admins(self._instance_store.get_instance(instance_id))
 
     @metrics.instrument
     def get_instance_url(self, instance_id):
         instance_configuration = self._instance_store.get_instance(instance_id)["configuration"]
-        instance_path = _instance_path(instance_configuration, instance_id)
-        ip, port = self._marathon_adapter.get_instance_ip_address_and_port(instance_path)
-        if ip is not None and port is not None:
-            return "{}:{}".format(ip, port)
-        else:
-            logger.error('Error while retrieving the ip address and the port of the instance {}'.format(instance_id))
-            return None
+        return self._get_instance_url(instance_id, instance_configuration)
+
+    @metrics.instrument
+    def resolve_instance_endpoint(self, instance_id):
+        """
+        Returns type, admins and url (host:port) of an instance for the proxy.
+        Results are cached until they expire or the instance is changed through this service, or by any worker if
+        the key-value mirror follows the instances.
+        """
+        endpoint = self._endpoint_cache.get(instance_id)
+        if endpoint is None:
+            data = self._instance_store.get_instance(instance_id)
+            url = self._get_instance_url(instance_id, data["configuration"])
+            endpoint = dict(type=data["configuration"]["type"], admins=_instance_admins(data), url=url)
+            if url is not None:
+                self._endpoint_cache.put(instance_id, endpoint)
+        return endpoint
+
+    def invalidate_instance_endpoint(self, instance_id):
+        self._endpoint_cache.pop(instance_id)
+        for listener in self._invalidation_listeners:
+            listener(instance_id)
+
+    def add_invalidation_listener(self, listener):
+        """Registers a function that is called with the instance id whenever an instance is changed through this service"""
+        self._invalidation_listeners.append(listener)
 
     @metrics.instrument
     def get_instance_type(self, instance_id):
@@ -110,12 +138,27 @@ class InstanceService:
     @metrics.instrument
     def get_instance_configurations(self):
         instances = list()
-        instance_ids = self._instance_store.get_instance_ids()
-        for instance_id in instance_ids:
-            instance_configuration = self._instance_store.get_instance(instance_id)
+        for instance_id, instance_configuration in self._instance_store.get_all_instances().items():
             instances.append(dict(instance_id=instance_id, configuration=instance_configuration))
         return instances
 
+    def get_instance_statuses(self, instance_configurations):
+        """Returns the marathon state of the given instances by instance id, with one request per marathon group"""
+        # Marathon reports app ids without the leading slash that group paths of DCOS_GROUPS_MAPPING may have
+        instance_paths = {instance_id: _instance_path(instance_configuration["configuration"], instance_id).lstrip('/')
+                          for instance_id, instance_configuration in instance_configurations.items()}
+        if not instance_paths:
+            return dict()
+        group_ids = sorted({_group_of_path(instance_path) for instance_path in instance_paths.values()})
+        statuses = self._marathon_adapter.get_instance_statuses(group_ids)
+        return {instance_id: statuses.get(instance_path, statuses.get(_group_of_path(instance_path), InstanceState.NOT_FOUND))
+                for instance_id, instance_path in instance_paths.items()}
+
+    @metrics.instrument
+    def get_overdue_instance_ids(self, now):
+        """Returns the ids of the instances whose delete_at time has elapsed"""
+        return list(self._instance_store.find_instances(delete_before=now.timestamp()))
+
     @metrics.instrument
     def create_instance(self, configuration, username):
         configuration = self._configuration_service.prepare_configuration(configuration)
@@ -146,6 +189,7 @@ class InstanceService:
         self._get_service(configuration).update_instance(instance_path, configuration)
         configuration = self._instance_store.update_instance_configuration(instance_id, configuration)
         self._start_runtime(instance_id, self._calculate_cost_factors(configuration))
+        self.invalidate_instance_endpoint(instance_id)
         return instance_id
 
     @metrics.instrument
@@ -156,6 +200,7 @@ class InstanceService:
         self._finish_runtime(instance_id)
         self._add_deleted_at(instance_id)
         self._instance_store.delete_instance(instance_id)
+        self.invalidate_instance_endpoint(instance_id)
 
     @metrics.instrument
     def start_instance(self, instance_id):
@@ -164,6 +209,7 @@ class InstanceService:
         if self._marathon_adapter.get_instance_status(instance_path) == InstanceState.STOPPED:
             self._marathon_adapter.start_instance(instance_path)
             self._start_runtime(instance_id, self._calculate_cost_factors(instance_configuration))
+            self.invalidate_instance_endpoint(instance_id)
             return "started"
         return ""
 
@@ -174,6 +220,7 @@ class InstanceService:
         if self._marathon_adapter.get_instance_status(instance_path) != InstanceState.STOPPED:
             self._marathon_adapter.stop_instance(instance_path)
             self._finish_runtime(instance_id)
+            self.invalidate_instance_endpoint(instance_id)
             return "stopped"
         return ""
 
@@ -187,12 +234,29 @@ class InstanceService:
         self._marathon_adapter.restart_instance(instance_path)
         self._finish_runtime(instance_id)
         self._start_runtime(instance_id, self._calculate_cost_factors(instance_configuration))
+        self.invalidate_instance_endpoint(instance_id)
         return "restarted"
 
     @metrics.instrument
     def get_default_configurations(self):
         return dict(configurations=self._configuration_service.get_available_configurations())
 
+    def _get_instance_url(self, instance_id, instance_configuration):
+        instance_path = _instance_path(instance_configuration, instance_id)
+        ip, port = self._marathon_adapter.get_instance_ip_address_and_port(instance_path)
+        if ip is not None and port is not None:
+            return "{}:{}".format(ip, port)
+        else:
+            logger.error('Error while retrieving the ip address and the port of the instance {}'.format(instance_id))
+            return None
+
+    def _build_instance(self, instance_id, instance_configuration, deleted, status=None):
+        instance = self.get_instance_state(instance_id, instance_configuration=instance_configuration,
+                                           deleted=deleted, status=status)
+        instance["details"] = self._calculate_instance_details(instance_id, instance_configuration, deleted)
+        instance["proxy_url"] = "/proxy/{}".format(instance_id)
+        return instance
+
     def _calculate_cost_factors(self, instance_configuration):
         configuration = instance_configuration["configuration"]
         num_executors = int(configuration["spark"]["cores_max"]) / int(configuration["spark"]["executor_cores"])
@@ -201,12 +265,12 @@ class InstanceService:
             configuration["spark"]["executor_memory"])
         return dict(cores=cores, memory=memory)
 
-    def _calculate_instance_details(self, instance_configuration):
+    def _calculate_instance_details(self, instance_id, instance_configuration, deleted):
         configuration = instance_configuration["configuration"]
         metadata = instance_configuration["metadata"]
-        runtimes = instance_configuration["runtimes"]
-        if runtimes and runtimes[-1]["stopped_at"] is None:
-            started_at = datetime.fromtimestamp(runtimes[-1]["started_at"]).isoformat()
+        open_runtime = instance_configuration["runtime_head"]["open"]
+        if open_runtime is not None:
+            started_at = datetime.fromtimestamp(open_runtime["started_at"]).isoformat()
         else:
             started_at = None
         details = dict()
@@ -217,20 +281,14 @@ class InstanceService:
                 details[key] = datetime.fromtimestamp(metadata[key]).isoformat()
         details["running_since"] = started_at
         if config.COST_TRACKING_ENABLED:
-            details["costs"] = _calculate_costs(instance_configuration)
+            details["costs"] = self._cost_ledger.calculate_costs(instance_id, instance_configuration, deleted=deleted)
         if configuration["delete_at"]:
             details["delete_at"] = datetime.fromtimestamp(configuration["delete_at"]).isoformat()
         return details
 
     def calculate_costs_per_hour(self, configuration):
-        now = datetime.now().timestamp()
-        instance_configuration = dict(configuration=configuration)
-        cost_factors = self._calculate_cost_factors(dict(instance_configuration))
-        cost_factors['started_at'] = now
-        cost_factors['stopped_at'] = now + 3600
-
-        instance_configuration['runtimes'] = [cost_factors]
-        return dict(costs_per_hour=_calculate_costs(instance_configuration)['cost'])
+        cost_factors = self._calculate_cost_factors(dict(configuration=configuration))
+        return dict(costs_per_hour=self._cost_ledger.calculate_costs_per_hour(cost_factors))
 
     def _add_deleted_at(self, instance_id):
         metadata = self._instance_store.get_instance(instance_id, deleted=False)["metadata"]
@@ -261,19 +319,8 @@ class InstanceService:
             raise InstanceTypeError(f"The given instance type {instance_type} does not exist! Please select zeppelin or jupyter!")
 
 
-def _calculate_costs(instance_configuration):
-    core_minutes = 0.0
-    gb_minutes = 0.0
-    running_time_seconds = 0
-    for runtime in instance_configuration["runtimes"]:
-        started_at = datetime.fromtimestamp(runtime["started_at"])
-        stopped_at = datetime.fromtimestamp(runtime["stopped_at"]) if runtime["stopped_at"] else datetime.now()
-        minutes = (stopped_at - started_at).seconds / 60
-        running_time_seconds += (stopped_at - started_at).seconds
-        core_minutes += runtime["cores"] * minutes
-        gb_minutes += runtime["memory"] / 1024 * minutes
-    cost = config.COST_CORE_PER_MINUTE * core_minutes + config.COST_GB_PER_MINUTE * gb_minutes
-    return dict(cost=cost, running_time_seconds=running_time_seconds)
+def _instance_admins(instance_data):
+    return instance_data["configuration"]["admin"]["admins"] + [instance_data["metadata"]["created_by"]]
 
 
 def _generate_instance_id() -> str:
@@ -285,3 +332,7 @@ def _instance_path(configuration, instance_id):
            return "{}/{}".format(config.DCOS_GROUPS_MAPPING.get(configuration["admin"]["group"]), instance_id)
     else:
         return "{}/{}".format(config.MARATHON_APP_GROUP, instance_id)
+
+
+def _group_of_path(instance_path):
+    return instance_path.rsplit("/", 1)[0]
@@ -1,5 +1,4 @@
-import json
-
+from .template import TemplateRegistry
 from ..adapter.marathon import MarathonAdapter
 from ..settings import config
 from ..settings.base import JUPYTER_MARATHON_FILE
@@ -11,28 +10,33 @@ from ..util.exception import HostNetworkException
 class JupyterInstanceService:
     """Manage jupyter instances"""
     @di.inject
-    def __init__(self, marathon_adapter: MarathonAdapter):
+    def __init__(self, marathon_adapter: MarathonAdapter, template_registry: TemplateRegistry):
         self._marathon_adapter = marathon_adapter
+        self._template_registry = template_registry
 
     @metrics.instrument
     def create_instance(self, instance_path, configuration):
-        marathon_app_definition = _generate_marathon_configuration(instance_path, configuration)
+        marathon_app_definition = self.generate_marathon_configuration(instance_path, configuration)
         self._marathon_adapter.deploy_instance(marathon_app_definition)
 
     @metrics.instrument
     def update_instance(self, instance_path, configuration):
-        marathon_app_definition = _generate_marathon_configuration(instance_path, configuration)
+        marathon_app_definition = self.generate_marathon_configuration(instance_path, configuration)
         self._marathon_adapter.deploy_instance(marathon_app_definition)
 
     @metrics.instrument
     def delete_instance(self, instance_path):
         self._marathon_adapter.delete_instance(instance_path)
 
+    def generate_marathon_configuration(self, instance_path, configuration):
+        return self.generate_marathon_configurations([(instance_path, configuration)])[0]
+
+    def generate_marathon_configurations(self, instances):
+        """Generates the marathon app definitions for a list of (instance path, configuration) tuples"""
+        return self._template_registry.render_batch(JUPYTER_MARATHON_FILE, instances, _generate_marathon_configuration)
 
-def _generate_marathon_configuration(app_id, configuration):
-    with open(JUPYTER_MARATHON_FILE) as marathon_file:
-        app_definition = json.load(marathon_file)
 
+def _generate_marathon_configuration(app_definition, app_id, configuration):
     app_definition["id"] = app_id
     app_definition["cpus"] = int(configuration["notebook"]["cores"])
     app_definition["mem"] = int(configuration["notebook"]["memory"])
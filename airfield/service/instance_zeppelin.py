@@ -1,9 +1,7 @@
 
 import hashlib
-import json
-
-from jinja2 import Template
 
+from .template import TemplateRegistry
 from ..adapter.marathon import MarathonAdapter
 from ..settings import config
 from ..settings.base import ZEPPELIN_MARATHON_FILE, SHIRO_CONF_FILE
@@ -14,28 +12,37 @@ from ..util import metrics
 class ZeppelinInstanceService:
     """Manage zeppelin instances"""
     @di.inject
-    def __init__(self, marathon_adapter: MarathonAdapter):
+    def __init__(self, marathon_adapter: MarathonAdapter, template_registry: TemplateRegistry):
         self._marathon_adapter = marathon_adapter
+        self._template_registry = template_registry
 
     @metrics.instrument
     def create_instance(self, instance_path, configuration):
-        marathon_app_definition = _generate_marathon_configuration(instance_path, configuration)
+        marathon_app_definition = self.generate_marathon_configuration(instance_path, configuration)
         self._marathon_adapter.deploy_instance(marathon_app_definition)
 
     @metrics.instrument
     def update_instance(self, instance_path, configuration):
-        marathon_app_definition = _generate_marathon_configuration(instance_path, configuration)
+        marathon_app_definition = self.generate_marathon_configuration(instance_path, configuration)
         self._marathon_adapter.deploy_instance(marathon_app_definition)
 
     @metrics.instrument
     def delete_instance(self, instance_path):
         self._marathon_adapter.delete_instance(instance_path)
 
+    def generate_marathon_configuration(self, instance_path, configuration):
+        return self.generate_marathon_configurations([(instance_path, configuration)])[0]
+
+    def generate_marathon_configurations(self, instances):
+        """Generates the marathon app definitions for a list of (instance path, configuration) tuples"""
+        shiro_template = self._template_registry.get_jinja_template(SHIRO_CONF_FILE)
+        return self._template_registry.render_batch(
+            ZEPPELIN_MARATHON_FILE, instances,
+            lambda app_definition, app_id, configuration: _generate_marathon_configuration(
+                app_definition, app_id, configuration, shiro_template))
 
-def _generate_marathon_configuration(app_id, configuration):
-    with open(ZEPPELIN_MARATHON_FILE) as marathon_file:
-        app_definition = json.load(marathon_file)
 
+def _generate_marathon_configuration(app_definition, app_id, configuration, shiro_template):
     if config.AIRFIELD_VIRTUAL_NETWORK_ENABLED:
         del app_definition["portDefinitions"]
         app_definition["networks"][0]["mode"] = "container"
@@ -63,7 +70,7 @@ def _generate_marathon_configuration(app_id, configuration):
         app_definition["env"]["PYTHON_PACKAGES"] = python_packages_string
     if r_packages_string:
         app_definition["env"]["R_PACKAGES"] = r_packages_string
-    app_definition["env"]["ZEPPELIN_SHIRO_CONF"] = _create_user_config_file(configuration)
+    app_definition["env"]["ZEPPELIN_SHIRO_CONF"] = _create_user_config_file(configuration, shiro_template)
 
     if config.HDFS_CONFIG_FOLDER:
         hdfs_folder = config.HDFS_CONFIG_FOLDER
@@ -123,7 +130,7 @@ def _create_r_packages_string(r_packages: list):
         return "c(%s)" % package_string
 
 
-def _create_user_config_file(configuration: dict):
+def _create_user_config_file(configuration: dict, template):
     usermanagement = configuration["usermanagement"]
     if not usermanagement["enabled"]:
         return ""
@@ -134,7 +141,5 @@ def _create_user_config_file(configuration: dict):
         # hash passwords and store for template
         hashed_password = hashlib.sha256(password.encode("utf-8")).hexdigest()
         hashed_users.append({"username": user, "password": hashed_password})
-    with open(SHIRO_CONF_FILE) as shiro_file:
-        template = Template(shiro_file.read())
     out = template.render(users=hashed_users)
     return out
\ No newline at end of file
@@ -1,9 +1,17 @@
 """Service to manage notebooks in zeppelin/jupyter instances"""
 
-from datetime import datetime, timedelta
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from uuid import uuid4
+from ..adapter.marathon import MarathonAdapter, InstanceState
+from ..settings import config
 from ..storage.notebook import NotebookStore
+from ..storage.notebook_backup import NotebookBackupStore
+from ..storage.notebook_blob import NotebookBlobStore, content_hash, normalize, references_of
+from ..storage.notebook_restore import NotebookRestoreStore, is_claimable, QUEUED, DONE, FAILED
 from ..storage.instance import InstanceStore
+from .instance import InstanceService
 from .notebook_zeppelin import ZeppelinNotebookService
 from .scheduler import SchedulerService
 from ..configuration.service import ConfigurationService
@@ -13,15 +21,37 @@ from ..util.logging import logger
 from ..util.exception import ConflictError
 
 
+# Error of the restore result of a notebook whose stored body is gone, such a notebook is not retried
+MISSING_NOTEBOOK_ERROR = "The stored notebook is missing"
+
+
 class NotebookService:
+    """
+    Restores of notebooks into instances are queued in the key-value store so every airfield worker sees them.
+    A restore is processed as soon as its instance turns healthy and by a periodic sweep, the worker that claims
+    it first with a lease does the import.
+    The notebooks of backups and templates are kept in the blob store, the instance only holds references to them.
+    Backups are incremental, only notebooks whose content changed since the last backup are written.
+    """
     @di.inject
-    def __init__(self, notebook_store: NotebookStore, instance_store: InstanceStore, zeppelin_notebook_service: ZeppelinNotebookService, configuration_service: ConfigurationService, scheduler: SchedulerService):
+    def __init__(self, notebook_store: NotebookStore, instance_store: InstanceStore, zeppelin_notebook_service: ZeppelinNotebookService, configuration_service: ConfigurationService, scheduler: SchedulerService,
+                 restore_store: NotebookRestoreStore, marathon_adapter: MarathonAdapter, blob_store: NotebookBlobStore,
+                 backup_store: NotebookBackupStore, instance_service: InstanceService):
         self._notebook_store = notebook_store
         self._instance_store = instance_store
+        self._instance_service = instance_service
         self._zeppelin_notebook_service = zeppelin_notebook_service
         self._configuration_service = configuration_service
-        self._schedule_import_list = dict()
-        scheduler.add_job(self._run_job, 'interval', id='notebook_import', seconds=20)
+        self._restore_store = restore_store
+        self._blob_store = blob_store
+        self._backup_store = backup_store
+        self._worker_id = "{}-{}".format(socket.gethostname(), uuid4())
+        self._executor = ThreadPoolExecutor(max_workers=config.NOTEBOOK_RESTORE_WORKERS, thread_name_prefix="notebook-jobs")
+        scheduler.add_job(self._run_job, 'interval', id='notebook_import', seconds=config.NOTEBOOK_RESTORE_SWEEP_SECONDS)
+        scheduler.add_job(self.collect_garbage, 'interval', id='notebook_gc', seconds=config.NOTEBOOK_GC_INTERVAL_SECONDS)
+        if config.NOTEBOOK_AUTO_BACKUP_INTERVAL_SECONDS > 0:
+            scheduler.add_job(self._run_auto_backups, 'interval', id='notebook_auto_backup', seconds=config.NOTEBOOK_AUTO_BACKUP_CHECK_SECONDS)
+        marathon_adapter.add_state_listener(self._on_instance_state)
 
     @metrics.instrument
     def get_stored_notebooks(self):
@@ -53,20 +83,53 @@ class NotebookService:
         return self._zeppelin_notebook_service.import_notebook(instance_id, notebook["data"])
 
     @metrics.instrument
-    def backup_notebooks(self, instance_id):
-        notebooks = list()
-        for notebook in self._zeppelin_notebook_service.get_instance_notebooks(instance_id):
-            _, notebook = self._zeppelin_notebook_service.export_notebook(instance_id, notebook["id"])
-            notebooks.append(notebook)
-        self._instance_store.store_extra_data(instance_id, "notebooks", notebooks)
+    def backup_notebooks(self, instance_id, merge=False):
+        """
+        Stores a snapshot of all notebooks of the instance and returns the result of every notebook.
+        Only notebooks whose normalized content differs from the last backup are written (marked as changed), a
+        notebook that failed to export keeps its last backed up version. With merge, notebooks that are missing in
+        the instance are kept as well, otherwise the snapshot only contains the notebooks of the instance.
+        """
+        results = self._zeppelin_notebook_service.export_notebooks(instance_id)
+        holder = self._instance_store.extra_data_key(instance_id, "notebooks")
+        stored = self._instance_store.get_extra_data(instance_id, "notebooks") or list()
+        # Entries stored before the deduplication hold the notebook itself instead of a reference
+        previous = {item["id"]: item for item in stored if "id" in item}
+        references = dict()
+        if merge:
+            references.update(previous)
+        for result in results:
+            last = previous.get(result["id"])
+            if result["status"] != "ok":
+                if last is not None:
+                    references[result["id"]] = last
+                continue
+            notebook = result.pop("notebook")
+            ref = content_hash(normalize(notebook))
+            result["changed"] = last is None or last.get("ref") != ref
+            if result["changed"]:
+                ref = self._blob_store.put_notebook(holder, notebook)
+            references[result["id"]] = dict(ref=ref, id=result["id"], name=result["name"])
+        references = list(references.values())
+        if references != stored:
+            self._instance_store.store_extra_data(instance_id, "notebooks", references)
+            self._blob_store.release(holder, references_of(stored) - references_of(references))
+        return results
 
     @metrics.instrument
     def restore_notebooks(self, instance_id):
-        self._schedule_import_list[instance_id] = datetime.now()
+        self._restore_store.enqueue(instance_id)
 
     @metrics.instrument
     def cancel_restore_notebooks(self, instance_id):
-        self._schedule_import_list.pop(instance_id, None)
+        self._restore_store.delete_restore(instance_id)
+
+    @metrics.instrument
+    def get_restore_status(self, instance_id):
+        restore = self._restore_store.get_restore(instance_id)
+        if restore is None:
+            return None
+        return {key: value for key, value in restore.items() if key != "lease"}
 
     @metrics.instrument
     def get_notebook_templates(self):
@@ -76,26 +139,129 @@ class NotebookService:
     def import_notebook_template(self, instance_id, template_id):
         template = self._configuration_service.get_notebook_template(template_id)
         if template:
-            self._instance_store.store_extra_data(instance_id, "notebooks", template["notebooks"])
+            self._store_instance_notebooks(instance_id, template["notebooks"])
             self.restore_notebooks(instance_id)
         else:
             logger.warning("Requested notebook template {} not found. Not starting import for instance {}".format(template_id, instance_id))
 
+    @metrics.instrument
+    def collect_garbage(self):
+        """Removes notebook bodies that are not referenced anymore, returns the number of removed bodies"""
+        collected = self._blob_store.collect_garbage(config.NOTEBOOK_GC_GRACE_SECONDS)
+        if collected:
+            logger.info("Removed {} unreferenced notebooks".format(collected))
+        return collected
+
+    def _store_instance_notebooks(self, instance_id, notebooks):
+        holder = self._instance_store.extra_data_key(instance_id, "notebooks")
+        previous_refs = references_of(self._instance_store.get_extra_data(instance_id, "notebooks"))
+        references = [dict(ref=self._blob_store.put_notebook(holder, notebook), id=notebook.get("id"), name=notebook.get("name"))
+                      for notebook in notebooks]
+        self._instance_store.store_extra_data(instance_id, "notebooks", references)
+        self._blob_store.release(holder, previous_refs - references_of(references))
+
+    def _get_instance_notebooks(self, instance_id):
+        """Returns the stored notebooks of the instance and the failed results of those whose body is missing"""
+        notebooks = list()
+        missing = list()
+        for item in self._instance_store.get_extra_data(instance_id, "notebooks") or list():
+            if "ref" not in item:
+                # Stored before the deduplication
+                notebooks.append(item)
+                continue
+            notebook = self._blob_store.get_notebook(item["ref"])
+            if notebook is None:
+                logger.error("Notebook {} of instance {} is missing".format(item["name"], instance_id))
+                missing.append(dict(id=item["id"], name=item["name"], status="failed", error=MISSING_NOTEBOOK_ERROR))
+                continue
+            notebooks.append(notebook)
+        return notebooks, missing
+
+    def _delete_instance_notebooks(self, instance_id):
+        holder = self._instance_store.extra_data_key(instance_id, "notebooks")
+        self._blob_store.release(holder, references_of(self._instance_store.get_extra_data(instance_id, "notebooks")))
+        self._instance_store.delete_extra_data(instance_id, "notebooks")
+
+    @metrics.instrument
+    def _run_auto_backups(self):
+        instances = {instance_id: data for instance_id, data in self._instance_store.get_all_instances().items()
+                     if data["configuration"].get("type") == "zeppelin"}
+        for instance_id in set(self._backup_store.get_instance_ids()) - set(instances):
+            self._backup_store.delete_backup(instance_id)
+        # Stopped or starting instances cannot export their notebooks, they are backed up once they are healthy again
+        running = {instance_id for instance_id, status in self._instance_service.get_instance_statuses(instances).items()
+                   if status == InstanceState.HEALTHY}
+        # The snapshot of an instance with a pending restore must not be replaced by the current state of the instance
+        pending = {restore["instance_id"] for restore in self._restore_store.get_restores() if restore["status"] not in (DONE, FAILED)}
+        list(self._executor.map(self._auto_backup, sorted(running - pending)))
+
+    def _auto_backup(self, instance_id):
+        if not self._backup_store.claim_backup(instance_id, config.NOTEBOOK_AUTO_BACKUP_INTERVAL_SECONDS):
+            return
+        try:
+            # Merging keeps the snapshot if the instance lost its notebooks, e.g. when it was recreated
+            results = self.backup_notebooks(instance_id, merge=True)
+            logger.info("Automatic backup of instance {}: {} of {} notebooks changed".format(
+                instance_id, sum(1 for result in results if result.get("changed")), len(results)))
+        except Exception as ex:
+            logger.warning("Automatic backup of instance {} failed: {}".format(instance_id, ex))
+
     @metrics.instrument
     def _run_job(self):
-        for instance_id in list(self._schedule_import_list.keys()):
-            try:
-                if self._zeppelin_notebook_service.is_import_possible(instance_id):
-                    for notebook in self._instance_store.get_extra_data(instance_id, "notebooks"):
-                        self._zeppelin_notebook_service.import_notebook(instance_id, notebook)
-                    self._instance_store.delete_extra_data(instance_id, "notebooks")
-                    self._schedule_import_list.pop(instance_id, None)
-            except Exception as ex:
-                logger.exception("Failed to run import job", exc_info=ex)
-        for instance_id, time_added in list(self._schedule_import_list.items()):
-            if datetime.now() > time_added + timedelta(seconds=60*10):
-                logger.warning("Notebook import timed out: {}".format(instance_id))
-                self._schedule_import_list.pop(instance_id, None)
+        now = datetime.now().timestamp()
+        pending = list()
+        for restore in self._restore_store.get_restores():
+            if is_claimable(restore, now):
+                pending.append(restore["instance_id"])
+            elif restore["status"] in (DONE, FAILED) and restore["updated_at"] + config.NOTEBOOK_RESTORE_RETENTION_SECONDS <= now:
+                self._restore_store.delete_restore(restore["instance_id"])
+        list(self._executor.map(self._restore, pending))
+
+    def _on_instance_state(self, app_id, state):
+        if state != InstanceState.HEALTHY:
+            return
+        instance_id = app_id.rsplit("/", 1)[-1]
+        restore = self._restore_store.get_restore(instance_id)
+        if restore is not None and is_claimable(restore, datetime.now().timestamp()):
+            self._executor.submit(self._restore, instance_id)
+
+    def _restore(self, instance_id):
+        restore = self._restore_store.claim(instance_id, self._worker_id, config.NOTEBOOK_RESTORE_LEASE_SECONDS)
+        if restore is None:
+            # Claimed by another worker or canceled meanwhile
+            return
+        timed_out = datetime.now().timestamp() > restore["queued_at"] + config.NOTEBOOK_RESTORE_TIMEOUT_SECONDS
+        retry_status = FAILED if timed_out else QUEUED
+        try:
+            if not self._zeppelin_notebook_service.is_import_possible(instance_id):
+                if timed_out:
+                    logger.warning("Notebook import timed out: {}".format(instance_id))
+                self._restore_store.release(instance_id, self._worker_id, retry_status,
+                                            error="Timed out waiting for the instance" if timed_out else None)
+                return
+            notebooks, missing = self._get_instance_notebooks(instance_id)
+            results = self._zeppelin_notebook_service.import_notebooks(instance_id, notebooks)
+            failed = [notebook for notebook, result in zip(notebooks, results) if result["status"] != "ok"]
+            # Notebooks imported or found missing by previous attempts are kept in the results
+            missing = [result for result in restore["results"] if result.get("error") == MISSING_NOTEBOOK_ERROR] + missing
+            results = [result for result in restore["results"] if result["status"] == "ok"] + results + missing
+            if failed:
+                # Only the failed notebooks are retried with the next run until the import times out
+                logger.warning("Failed to import {} of {} notebooks into instance {}".format(len(failed), len(notebooks), instance_id))
+                self._store_instance_notebooks(instance_id, failed)
+                self._restore_store.release(instance_id, self._worker_id, retry_status, results=results,
+                                            error="Failed to import {} notebooks".format(len(failed)))
+            elif missing:
+                # The missing notebooks cannot be restored by retrying
+                self._delete_instance_notebooks(instance_id)
+                self._restore_store.release(instance_id, self._worker_id, FAILED, results=results,
+                                            error="{} notebooks are missing".format(len(missing)))
+            else:
+                self._delete_instance_notebooks(instance_id)
+                self._restore_store.release(instance_id, self._worker_id, DONE, results=results)
+        except Exception as ex:
+            logger.exception("Failed to run import job", exc_info=ex)
+            self._restore_store.release(instance_id, self._worker_id, retry_status, error=str(ex))
 
 
 def _gen_notebook_id():
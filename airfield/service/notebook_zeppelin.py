@@ -1,15 +1,31 @@
 """Service to manage notebooks in zeppelin instances"""
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from prometheus_client import Counter
 from .instance import InstanceService
+from ..settings import config
 from ..util import dependency_injection as di
 from ..util import metrics
-from ..adapter.zeppelin import ZeppelinAdapter
+from ..util.cache import TTLCache
+from ..util.logging import logger
+from ..adapter.zeppelin import ZeppelinAdapter, ZeppelinException
+
+
+_metric_transfers = Counter("airfield_notebook_transfers", "Notebooks exported from or imported into instances", ["operation", "status"])
 
 
 class ZeppelinNotebookService:
+    """
+    Logged in zeppelin sessions are cached per instance together with the endpoint they were created for, so
+    consecutive calls neither resolve the instance again nor log in again. A session is dropped when it was idle for
+    too long, when the endpoint of its instance changed or when the instance was changed through the instance service.
+    """
     @di.inject
     def __init__(self, instance_service: InstanceService):
         self._instance_service = instance_service
+        self._sessions = TTLCache("zeppelin_session", config.ZEPPELIN_SESSION_CACHE_SIZE,
+                                  config.ZEPPELIN_SESSION_IDLE_SECONDS, sliding=True)
+        instance_service.add_invalidation_listener(self.invalidate_session)
 
     @metrics.instrument
     def get_instance_notebooks(self, instance_id):
@@ -30,19 +46,88 @@ class ZeppelinNotebookService:
         return True
 
     @metrics.instrument
-    def is_import_possible(self, instance_id):
+    def export_notebooks(self, instance_id, notebook_ids=None):
+        """
+        Exports notebooks of an instance concurrently through one logged in session, all notebooks if no ids are given.
+        Returns one result per notebook with its id, name, status ("ok" or "failed") and the notebook or the error.
+        """
+        zeppelin = self._adapter(instance_id)
+        if notebook_ids is None:
+            notebook_ids = [notebook["id"] for notebook in _filter_notebooks(zeppelin.list_notebooks())]
+
+        def export(notebook_id):
+            notebook = zeppelin.export_notebook(notebook_id)
+            return dict(id=notebook_id, name=notebook["name"], notebook=notebook)
+        return _transfer(instance_id, "export", notebook_ids, export, lambda notebook_id: dict(id=notebook_id, name=None))
+
+    @metrics.instrument
+    def import_notebooks(self, instance_id, notebooks):
+        """
+        Imports notebooks into an instance concurrently through one logged in session.
+        Returns one result per notebook, in the order of the notebooks, with its id, name, status and error if any.
+        """
         zeppelin = self._adapter(instance_id)
+
+        def import_(notebook):
+            zeppelin.import_notebook(notebook)
+            return _describe(notebook)
+        return _transfer(instance_id, "import", notebooks, import_, _describe)
+
+    @metrics.instrument
+    def is_import_possible(self, instance_id):
+        try:
+            zeppelin = self._adapter(instance_id)
+        except ZeppelinException:
+            return False
         return zeppelin.ping()
 
+    def invalidate_session(self, instance_id):
+        zeppelin = self._sessions.pop(instance_id)
+        if zeppelin is not None:
+            zeppelin.close()
+
     def _adapter(self, instance_id):
-        url = self._instance_service.get_instance_url(instance_id)
+        url = self._instance_service.resolve_instance_endpoint(instance_id)["url"]
+        if url is None:
+            raise ZeppelinException("Zeppelin instance {} is not running.".format(instance_id))
+        base_host = "http://{}".format(url)
+        zeppelin = self._sessions.get(instance_id)
+        if zeppelin is not None and zeppelin.base_host == base_host:
+            return zeppelin
+        if zeppelin is not None:
+            # The task of the instance moved, the session belongs to the previous one
+            self.invalidate_session(instance_id)
         credentials = self._instance_service.get_instance_credentials(instance_id)
-        zeppelin = ZeppelinAdapter("http://{}".format(url))
+        zeppelin = ZeppelinAdapter(base_host)
         if credentials:
-            username = credentials.keys()[0]
+            username = next(iter(credentials))
             zeppelin.login(username, credentials[username])
+        self._sessions.put(instance_id, zeppelin)
         return zeppelin
 
 
 def _filter_notebooks(notebooks):
-    return list(filter(lambda x: not (x["name"].startswith("Zeppelin Tutorial") or x["name"].startswith("~Trash")), notebooks))
\ No newline at end of file
+    return list(filter(lambda x: not (x["name"].startswith("Zeppelin Tutorial") or x["name"].startswith("~Trash")), notebooks))
+
+
+def _describe(notebook):
+    return dict(id=notebook.get("id"), name=notebook.get("name"))
+
+
+def _transfer(instance_id, operation, items, transfer, describe):
+    """Runs the transfer of every item in a bounded pool, a failed item is reported without aborting the others"""
+    results = [None] * len(items)
+    if not items:
+        return results
+    with ThreadPoolExecutor(max_workers=config.NOTEBOOK_TRANSFER_WORKERS, thread_name_prefix="notebook-" + operation) as executor:
+        futures = {executor.submit(transfer, item): index for index, item in enumerate(items)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            index = futures[future]
+            try:
+                results[index] = dict(future.result(), status="ok")
+            except Exception as ex:
+                logger.warning("Failed to {} notebook of instance {}: {}".format(operation, instance_id, ex))
+                results[index] = dict(describe(items[index]), status="failed", error=str(ex))
+            _metric_transfers.labels(operation, results[index]["status"]).inc()
+            logger.info("Notebook {} of instance {}: {}/{} done".format(operation, instance_id, done, len(items)))
+    return results
@@ -0,0 +1,55 @@
+"""Loads the resource templates for marathon app definitions and config files"""
+
+import copy
+import json
+import os
+import threading
+
+from jinja2 import Template
+
+from ..util import metrics
+
+
+class TemplateRegistry:
+    """
+    Loads and parses template resources once and hands out deep copies of them.
+    A template is loaded again when the modification time of its file changes.
+    """
+    def __init__(self):
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    def get_app_definition(self, path):
+        """Returns a fresh copy of the marathon app definition in the given json file"""
+        return copy.deepcopy(self._load(path, json.loads))
+
+    def get_jinja_template(self, path):
+        """Returns the compiled jinja template in the given file. Compiled templates are immutable and can be shared."""
+        return self._load(path, Template)
+
+    def render_batch(self, path, items, render):
+        """
+        Generates many app definitions from the same json template, e.g. for bulk redeploys.
+        The template is checked for changes only once, every item gets its own copy.
+
+        :param path: path of the json template
+        :param items: tuples of arguments that are passed to render after the app definition
+        :param render: function (app_definition, *item) returning the final app definition
+        :return: list with the rendered app definition for each item
+        """
+        template = self._load(path, json.loads)
+        return [render(copy.deepcopy(template), *item) for item in items]
+
+    def _load(self, path, parse):
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            entry = self._entries.get((path, parse))
+            if entry is not None and entry[0] == mtime:
+                metrics.cache_hit("template")
+                return entry[1]
+        metrics.cache_miss("template")
+        with open(path) as template_file:
+            value = parse(template_file.read())
+        with self._lock:
+            self._entries[(path, parse)] = (mtime, value)
+        return value
@@ -10,13 +10,54 @@ LOGGING_LEVEL = os.getenv('AIRFIELD_LOGGING_LEVEL', 'INFO')
 
 ETCD_ENDPOINT = os.getenv('AIRFIELD_ETCD_ENDPOINT')
 CONSUL_ENDPOINT = os.getenv('AIRFIELD_CONSUL_ENDPOINT')
+# etcd v3 JSON gateway, e.g. http://etcd:2379 (/v3 is added if no version is given). Takes precedence over the v2 endpoint.
+ETCD3_ENDPOINT = os.getenv('AIRFIELD_ETCD3_ENDPOINT')
+ETCD3_TIMEOUT_SECONDS = float(os.getenv('AIRFIELD_ETCD3_TIMEOUT_SECONDS', '10'))
+# Local SQLite database for single node deployments, used if no etcd or consul endpoint is set
+SQLITE_PATH = os.getenv('AIRFIELD_SQLITE_PATH')
+SQLITE_BUSY_TIMEOUT_SECONDS = float(os.getenv('AIRFIELD_SQLITE_BUSY_TIMEOUT_SECONDS', '30'))
+SQLITE_WATCH_POLL_SECONDS = float(os.getenv('AIRFIELD_SQLITE_WATCH_POLL_SECONDS', '0.5'))
 CONFIG_BASE_KEY = os.getenv('AIRFIELD_CONFIG_BASE_KEY', 'airfield')
+# Values whose json is larger than this number of bytes are stored zlib compressed, 0 disables compression
+KV_COMPRESSION_THRESHOLD = int(os.getenv('AIRFIELD_KV_COMPRESSION_THRESHOLD', '4096'))
+KV_COMPRESSION_LEVEL = int(os.getenv('AIRFIELD_KV_COMPRESSION_LEVEL', '6'))
+# Encoded values larger than this number of characters are split into chunks, consul limits values to 512 KB
+KV_CHUNK_SIZE = int(os.getenv('AIRFIELD_KV_CHUNK_SIZE', str(256 * 1024)))
+KV_CHUNK_FETCH_WORKERS = int(os.getenv('AIRFIELD_KV_CHUNK_FETCH_WORKERS', '8'))
+# Keeps the given comma separated subtrees in memory and follows their changes with watches (blocking queries)
+KV_MIRROR_ENABLED = os.getenv('AIRFIELD_KV_MIRROR_ENABLED', "false").lower() == "true"
+KV_MIRROR_PREFIXES = [prefix.strip() for prefix in os.getenv('AIRFIELD_KV_MIRROR_PREFIXES', 'instances').split(',') if prefix.strip()]
+KV_MIRROR_WAIT_SECONDS = int(os.getenv('AIRFIELD_KV_MIRROR_WAIT_SECONDS', '30'))
+KV_MIRROR_RECONNECT_SECONDS = float(os.getenv('AIRFIELD_KV_MIRROR_RECONNECT_SECONDS', '5'))
+# Local writes are read from memory until the watch delivers them, but at most for this number of seconds
+KV_MIRROR_WRITE_TTL_SECONDS = float(os.getenv('AIRFIELD_KV_MIRROR_WRITE_TTL_SECONDS', '10'))
+# The cleanup job only deletes instances whose delete_at has passed if enabled, otherwise it logs their ids
+INSTANCE_CLEANUP_DELETE_ENABLED = os.getenv('AIRFIELD_INSTANCE_CLEANUP_DELETE_ENABLED', "false").lower() == "true"
 
 ## Zeppelin config
 
 HDFS_CONFIG_FOLDER = os.getenv("HDFS_CONFIG_FOLDER", "").rstrip("/")
 ZEPPELIN_DOCKER_IMAGE = os.getenv("ZEPPELIN_DOCKER_IMAGE")
 SPARK_MESOS_EXECUTOR_DOCKER_IMAGE = os.getenv("SPARK_MESOS_EXECUTOR_DOCKER_IMAGE")
+# Number of notebooks exported from or imported into one instance at the same time during backups and restores
+NOTEBOOK_TRANSFER_WORKERS = int(os.getenv("AIRFIELD_NOTEBOOK_TRANSFER_WORKERS", "4"))
+# Pending notebook restores are processed when their instance turns healthy and are checked with this interval
+NOTEBOOK_RESTORE_SWEEP_SECONDS = float(os.getenv("AIRFIELD_NOTEBOOK_RESTORE_SWEEP_SECONDS", "15"))
+NOTEBOOK_RESTORE_WORKERS = int(os.getenv("AIRFIELD_NOTEBOOK_RESTORE_WORKERS", "4"))
+# A worker that claimed a restore owns it for this number of seconds, afterwards other workers may take it over
+NOTEBOOK_RESTORE_LEASE_SECONDS = float(os.getenv("AIRFIELD_NOTEBOOK_RESTORE_LEASE_SECONDS", "300"))
+NOTEBOOK_RESTORE_TIMEOUT_SECONDS = float(os.getenv("AIRFIELD_NOTEBOOK_RESTORE_TIMEOUT_SECONDS", str(10 * 60)))
+# Finished and failed restores are kept this long to report their status
+NOTEBOOK_RESTORE_RETENTION_SECONDS = float(os.getenv("AIRFIELD_NOTEBOOK_RESTORE_RETENTION_SECONDS", str(24 * 60 * 60)))
+# Notebook bodies without references are removed by a job with this interval after this grace period
+NOTEBOOK_GC_INTERVAL_SECONDS = float(os.getenv("AIRFIELD_NOTEBOOK_GC_INTERVAL_SECONDS", str(60 * 60)))
+NOTEBOOK_GC_GRACE_SECONDS = float(os.getenv("AIRFIELD_NOTEBOOK_GC_GRACE_SECONDS", str(60 * 60)))
+# Notebooks of running zeppelin instances are backed up with this interval, 0 disables the automatic backups
+NOTEBOOK_AUTO_BACKUP_INTERVAL_SECONDS = float(os.getenv("AIRFIELD_NOTEBOOK_AUTO_BACKUP_INTERVAL_SECONDS", "0"))
+NOTEBOOK_AUTO_BACKUP_CHECK_SECONDS = float(os.getenv("AIRFIELD_NOTEBOOK_AUTO_BACKUP_CHECK_SECONDS", "60"))
+# Logged in sessions to zeppelin instances are reused until they were idle for this number of seconds
+ZEPPELIN_SESSION_CACHE_SIZE = int(os.getenv("AIRFIELD_ZEPPELIN_SESSION_CACHE_SIZE", "100"))
+ZEPPELIN_SESSION_IDLE_SECONDS = float(os.getenv("AIRFIELD_ZEPPELIN_SESSION_IDLE_SECONDS", "600"))
 
 ## Jupyter config
 
@@ -46,8 +87,33 @@ DCOS_BASE_URL = os.getenv('DCOS_BASE_URL', 'https://leader.mesos:443/')
 DCOS_USERNAME = os.getenv('DCOS_USERNAME', None)
 DCOS_PASSWORD = os.getenv('DCOS_PASSWORD', None)
 
+MARATHON_CONNECT_TIMEOUT = float(os.getenv('AIRFIELD_MARATHON_CONNECT_TIMEOUT', '3.05'))
+MARATHON_READ_TIMEOUT = float(os.getenv('AIRFIELD_MARATHON_READ_TIMEOUT', '30'))
+MARATHON_POOL_SIZE = int(os.getenv('AIRFIELD_MARATHON_POOL_SIZE', '10'))
+MARATHON_GET_RETRIES = int(os.getenv('AIRFIELD_MARATHON_GET_RETRIES', '3'))
+MARATHON_RETRY_BACKOFF = float(os.getenv('AIRFIELD_MARATHON_RETRY_BACKOFF', '0.3'))
+
+MARATHON_WATCHER_ENABLED = os.getenv('AIRFIELD_MARATHON_WATCHER_ENABLED', "false").lower() == "true"
+MARATHON_WATCHER_RESYNC_SECONDS = float(os.getenv('AIRFIELD_MARATHON_WATCHER_RESYNC_SECONDS', '300'))
+MARATHON_WATCHER_RECONNECT_SECONDS = float(os.getenv('AIRFIELD_MARATHON_WATCHER_RECONNECT_SECONDS', '5'))
+
 AIRFIELD_VIRTUAL_NETWORK_ENABLED = os.getenv('AIRFIELD_VIRTUAL_NETWORK_ENABLED', True)
 
+## Proxy config
+
+PROXY_STREAMING_ENABLED = os.getenv('AIRFIELD_PROXY_STREAMING_ENABLED', "true").lower() == "true"
+PROXY_CHUNK_SIZE = int(os.getenv('AIRFIELD_PROXY_CHUNK_SIZE', str(64 * 1024)))
+# Each worker caches the url and admins of instances, changes by other workers are only seen after this time unless
+# the key-value mirror follows the instances
+PROXY_ENDPOINT_CACHE_TTL_SECONDS = float(os.getenv('AIRFIELD_PROXY_ENDPOINT_CACHE_TTL_SECONDS', '10'))
+PROXY_ENDPOINT_CACHE_SIZE = int(os.getenv('AIRFIELD_PROXY_ENDPOINT_CACHE_SIZE', '1000'))
+PROXY_MAX_UPSTREAM_POOLS = int(os.getenv('AIRFIELD_PROXY_MAX_UPSTREAM_POOLS', '100'))
+PROXY_UPSTREAM_POOL_SIZE = int(os.getenv('AIRFIELD_PROXY_UPSTREAM_POOL_SIZE', '10'))
+PROXY_UPSTREAM_POOL_IDLE_SECONDS = float(os.getenv('AIRFIELD_PROXY_UPSTREAM_POOL_IDLE_SECONDS', '300'))
+PROXY_UPSTREAM_POOL_TIMEOUT_SECONDS = float(os.getenv('AIRFIELD_PROXY_UPSTREAM_POOL_TIMEOUT_SECONDS', '30'))
+WEBSOCKET_PING_INTERVAL_SECONDS = float(os.getenv('AIRFIELD_WEBSOCKET_PING_INTERVAL_SECONDS', '30'))
+WEBSOCKET_IDLE_TIMEOUT_SECONDS = float(os.getenv('AIRFIELD_WEBSOCKET_IDLE_TIMEOUT_SECONDS', '3600'))
+
 ## OIDC specific config
 
 OIDC_ACTIVATED = os.getenv('AIRFIELD_OIDC_ACTIVATED', "false").lower() == "true"
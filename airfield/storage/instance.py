@@ -1,12 +1,21 @@
 
 from datetime import datetime
-from ..adapter.kv import KVAdapter
+from ..adapter.kv import KVAdapter, set_op, check_op, delete_op
 from ..util import dependency_injection as di
-from ..util.exception import InstanceRunningTimeException
+from ..util.exception import ConflictError, InstanceRunningTimeException
 
 
 BASE_KEY = "instances"
 BASE_KEY_DELETED = "deleted_instances"
+# Closed runtimes are stored append-only as runtime_log/<instance_id>/<sequence number>, outside of the instance
+# so that reading an instance does not load its runtime history.
+BASE_KEY_RUNTIMES = "runtime_log"
+# The small runtime head of an instance holds the open runtime and the next sequence number of the runtime log.
+# It is only written with compare-and-swap so that concurrent workers cannot lose updates.
+RUNTIME_HEAD = "runtime_head"
+# Runtimes of instances created by older versions are stored as one list under this key until they are migrated
+LEGACY_RUNTIMES = "runtimes"
+MAX_CAS_ATTEMPTS = 10
 
 
 class InstanceStore:
@@ -14,27 +23,75 @@ class InstanceStore:
     def __init__(self, kv_adapter: KVAdapter):
         self._kv_adapter = kv_adapter
 
+    def add_change_listener(self, listener):
+        """
+        Calls the listener with the instance id whenever an instance is changed by any worker. Only works if the
+        key-value mirror follows the instances, returns whether it does.
+        """
+        return self._kv_adapter.add_change_listener(BASE_KEY, lambda key: listener(key.split('/')[1]))
+
     def get_instance_ids(self, deleted=False):
         base_key = BASE_KEY if not deleted else BASE_KEY_DELETED
         instance_ids = list()
-        for key, _ in self._kv_adapter.get_keys(base_key):
+        for key in self._kv_adapter.get_key_names(base_key):
             instance_id = get_id_of_key(key)
             if instance_id not in instance_ids:
                 instance_ids.append(instance_id)
         return instance_ids
 
-    def get_instance(self, instance_id, deleted=False):
+    def get_all_instances(self, deleted=False, with_runtimes=False):
+        """
+        Returns a dict of instance id to instance data for all instances, built from a single recursive read.
+        With with_runtimes the runtime history of all instances is added with one more recursive read.
+        """
+        return self._get_all_instances(deleted, self._get_closed_runtimes("") if with_runtimes else None)
+
+    def get_all_instances_with_runtimes(self):
+        """
+        Returns the live and the deleted instances including their runtimes as two dicts of instance id to data.
+        The runtime log is read only once for both.
+        """
+        closed_runtimes = self._get_closed_runtimes("")
+        return self._get_all_instances(False, closed_runtimes), self._get_all_instances(True, closed_runtimes)
+
+    def find_instances(self, deleted=False, created_by=None, group=None, delete_before=None):
+        """
+        Returns a dict of instance id to instance data for the instances that match all given filters.
+        Backends with secondary indexes only read the candidate instances, otherwise all instances are read.
+        """
+        base_key = BASE_KEY if not deleted else BASE_KEY_DELETED
+        candidates = self._kv_adapter.find_instance_ids(base_key, created_by=created_by, group=group, delete_before=delete_before)
+        if candidates is None:
+            instances = self._get_all_instances(deleted, None)
+        else:
+            instances = {instance_id: self.get_instance(instance_id, deleted=deleted) for instance_id in candidates}
+        return {instance_id: data for instance_id, data in instances.items()
+                if data and _matches(data, created_by, group, delete_before)}
+
+    def get_instance(self, instance_id, deleted=False, with_runtimes=False):
+        """
+        Returns the data of an instance. The open runtime is always part of the runtime head,
+        the full list of runtimes is only read from the runtime log with with_runtimes.
+        """
         base_key = BASE_KEY if not deleted else BASE_KEY_DELETED
         data = dict()
         for key, value in self._kv_adapter.get_keys("{}/{}".format(base_key, instance_id)):
             # The key is in the form 'instances/<instance_id>/configuration', so the last one is the searched one.
             data[key.split('/').pop()] = value
+        if data:
+            closed_runtimes = self._get_closed_runtimes(instance_id).get(instance_id, list()) if with_runtimes else None
+            _prepare_runtimes(data, closed_runtimes)
         return data
 
+    def get_runtimes(self, instance_id, deleted=False):
+        return self.get_instance(instance_id, deleted=deleted, with_runtimes=True).get("runtimes", list())
+
     def insert_instance(self, instance_id, configuration, metadata):
-        self._kv_adapter.put_key("{}/{}/configuration".format(BASE_KEY, instance_id), configuration)
-        self._kv_adapter.put_key("{}/{}/metadata".format(BASE_KEY, instance_id), metadata)
-        self._kv_adapter.put_key("{}/{}/runtimes".format(BASE_KEY, instance_id), [])
+        self._kv_adapter.txn([
+            set_op("{}/{}/configuration".format(BASE_KEY, instance_id), configuration),
+            set_op("{}/{}/metadata".format(BASE_KEY, instance_id), metadata),
+            set_op("{}/{}/{}".format(BASE_KEY, instance_id, RUNTIME_HEAD), _new_runtime_head()),
+        ])
         return dict(configuration=configuration, metadata=metadata)
 
     def update_instance_metadata(self, instance_id, metadata):
@@ -45,44 +102,116 @@ class InstanceStore:
         return self.get_instance(instance_id)
 
     def delete_instance(self, instance_id):
+        """
+        Moves the instance to the deleted instances with a single transaction. It is retried if the runtime head
+        was changed meanwhile, so a runtime that was closed concurrently is not lost.
+        """
         configuration = self._kv_adapter.get_key("{}/{}/configuration".format(BASE_KEY, instance_id))
         metadata = self._kv_adapter.get_key("{}/{}/metadata".format(BASE_KEY, instance_id))
-        runtimes = self._kv_adapter.get_key("{}/{}/runtimes".format(BASE_KEY, instance_id))
-        self._kv_adapter.put_key("{}/{}/configuration".format(BASE_KEY_DELETED, instance_id), configuration)
-        self._kv_adapter.put_key("{}/{}/runtimes".format(BASE_KEY_DELETED, instance_id), runtimes)
-        self._kv_adapter.put_key("{}/{}/metadata".format(BASE_KEY_DELETED, instance_id), metadata)
-        self._kv_adapter.delete_key("{}/{}".format(BASE_KEY, instance_id), recursive=True)
+        head_key = "{}/{}/{}".format(BASE_KEY, instance_id, RUNTIME_HEAD)
+        for _ in range(MAX_CAS_ATTEMPTS):
+            runtime_head, index = self._kv_adapter.get_key_with_index(head_key)
+            if runtime_head is None or "totals" not in runtime_head:
+                # Migrating first means only the small head has to be moved, the runtime log stays where it is
+                self._update_runtime_head(instance_id, lambda head: None)
+                continue
+            if self._kv_adapter.txn([
+                check_op(head_key, index),
+                set_op("{}/{}/configuration".format(BASE_KEY_DELETED, instance_id), configuration),
+                set_op("{}/{}/{}".format(BASE_KEY_DELETED, instance_id, RUNTIME_HEAD), runtime_head),
+                set_op("{}/{}/metadata".format(BASE_KEY_DELETED, instance_id), metadata),
+                delete_op("{}/{}".format(BASE_KEY, instance_id), recursive=True),
+            ]):
+                return
+        raise ConflictError(f'The runtimes of the instance {instance_id} are modified concurrently!')
 
     def store_extra_data(self, instance_id, name, data):
-        self._kv_adapter.put_key("{}/{}/{}".format(BASE_KEY, instance_id, name), data)
+        self._kv_adapter.put_key(self.extra_data_key(instance_id, name), data)
 
     def get_extra_data(self, instance_id, name):
-        return self._kv_adapter.get_key("{}/{}/{}".format(BASE_KEY, instance_id, name))
+        return self._kv_adapter.get_key(self.extra_data_key(instance_id, name))
 
     def delete_extra_data(self, instance_id, name):
-        self._kv_adapter.delete_key("{}/{}/{}".format(BASE_KEY, instance_id, name))
+        self._kv_adapter.delete_key(self.extra_data_key(instance_id, name))
+
+    def extra_data_key(self, instance_id, name):
+        return "{}/{}/{}".format(BASE_KEY, instance_id, name)
 
     def finish_runtime(self, instance_id):
-        runtimes = self._kv_adapter.get_key("{}/{}/runtimes".format(BASE_KEY, instance_id))
-        if not runtimes:
-            raise Exception("No runtime!")
-        if runtimes[-1]["stopped_at"] is not None:
-            raise InstanceRunningTimeException(f'The last runtime for the instance {instance_id} is already stopped!')
-        runtimes[-1]["stopped_at"] = datetime.now().timestamp()
-        self._kv_adapter.put_key("{}/{}/runtimes".format(BASE_KEY, instance_id), runtimes)
+        def finish(head):
+            if head["open"] is None:
+                raise InstanceRunningTimeException(f'The last runtime for the instance {instance_id} is already stopped!')
+            runtime = head["open"]
+            runtime["stopped_at"] = datetime.now().timestamp()
+            # The log entry is written before the head, so a closed runtime is never lost. If the head update
+            # conflicts, the retry finds the entry already present and does not overwrite it.
+            self._kv_adapter.put_key_cas(_runtime_log_key(instance_id, head["next_seq"]), runtime, None)
+            head["open"] = None
+            head["next_seq"] += 1
+            add_runtime_to_totals(head["totals"], runtime)
+        self._update_runtime_head(instance_id, finish)
 
     def start_runtime(self, instance_id, cost_factors):
-        runtimes = self._kv_adapter.get_key("{}/{}/runtimes".format(BASE_KEY, instance_id))
-        if not runtimes:
-            runtimes = []
-        if len(runtimes) > 0 and runtimes[-1]["stopped_at"] is None:
-            raise InstanceRunningTimeException(f'The last runtime for the instance {instance_id} is currently not stopped!')
-        runtime = _runtime_model.copy()
-        runtime["started_at"] = datetime.now().timestamp()
-        runtime["cores"] = cost_factors["cores"]
-        runtime["memory"] = cost_factors["memory"]
-        runtimes.append(runtime)
-        self._kv_adapter.put_key("{}/{}/runtimes".format(BASE_KEY, instance_id), runtimes)
+        def start(head):
+            if head["open"] is not None:
+                raise InstanceRunningTimeException(f'The last runtime for the instance {instance_id} is currently not stopped!')
+            runtime = _runtime_model.copy()
+            runtime["started_at"] = datetime.now().timestamp()
+            runtime["cores"] = cost_factors["cores"]
+            runtime["memory"] = cost_factors["memory"]
+            head["open"] = runtime
+        self._update_runtime_head(instance_id, start)
+
+    def recompute_runtime_totals(self, instance_id, deleted=False):
+        """Rebuilds the runtime totals of an instance from its raw runtimes and returns them"""
+        def recompute(head):
+            head["totals"] = runtime_totals(self._get_closed_runtimes(instance_id).get(instance_id, list()))
+        return self._update_runtime_head(instance_id, recompute, deleted=deleted)["totals"]
+
+    def _update_runtime_head(self, instance_id, update, deleted=False):
+        """Applies update to the runtime head with compare-and-swap, retrying if another worker changed it meanwhile"""
+        base_key = BASE_KEY if not deleted else BASE_KEY_DELETED
+        key = "{}/{}/{}".format(base_key, instance_id, RUNTIME_HEAD)
+        for _ in range(MAX_CAS_ATTEMPTS):
+            head, index = self._kv_adapter.get_key_with_index(key)
+            if head is None:
+                head = self._migrate_legacy_runtimes(base_key, instance_id)
+            elif "totals" not in head:
+                # Heads written before the totals were introduced
+                head["totals"] = runtime_totals(self._get_closed_runtimes(instance_id).get(instance_id, list()))
+            update(head)
+            if self._kv_adapter.put_key_cas(key, head, index):
+                if index is None:
+                    self._kv_adapter.delete_key("{}/{}/{}".format(base_key, instance_id, LEGACY_RUNTIMES))
+                return head
+        raise ConflictError(f'The runtimes of the instance {instance_id} are modified concurrently!')
+
+    def _migrate_legacy_runtimes(self, base_key, instance_id):
+        """Copies the closed runtimes of the legacy runtimes list into the runtime log and returns the new head"""
+        runtimes = self._kv_adapter.get_key("{}/{}/{}".format(base_key, instance_id, LEGACY_RUNTIMES)) or list()
+        head = _legacy_runtime_head(runtimes)
+        for seq, runtime in enumerate(runtimes[:head["next_seq"]]):
+            self._kv_adapter.put_key(_runtime_log_key(instance_id, seq), runtime)
+        return head
+
+    def _get_all_instances(self, deleted, closed_runtimes):
+        base_key = BASE_KEY if not deleted else BASE_KEY_DELETED
+        instances = dict()
+        for key, value in self._kv_adapter.get_keys(base_key):
+            instances.setdefault(get_id_of_key(key), dict())[key.split('/').pop()] = value
+        for instance_id, data in instances.items():
+            _prepare_runtimes(data, None if closed_runtimes is None else closed_runtimes.get(instance_id, list()))
+        return instances
+
+    def _get_closed_runtimes(self, instance_id):
+        """Reads the runtime log below the given instance id, or of all instances for an empty id"""
+        entries = dict()
+        base_key = "{}/{}".format(BASE_KEY_RUNTIMES, instance_id) if instance_id else BASE_KEY_RUNTIMES
+        for key, value in self._kv_adapter.get_keys(base_key):
+            # The key is in the form 'runtime_log/<instance_id>/<sequence number>'
+            entries.setdefault(get_id_of_key(key), list()).append((int(key.split('/').pop()), value))
+        return {entry_instance_id: [runtime for _, runtime in sorted(runtimes, key=lambda entry: entry[0])]
+                for entry_instance_id, runtimes in entries.items()}
 
 
 _runtime_model = {
@@ -93,6 +222,76 @@ _runtime_model = {
 }
 
 
+def empty_runtime_totals():
+    return dict(core_minutes=0.0, gb_minutes=0.0, running_seconds=0.0)
+
+
+def add_runtime_to_totals(totals, runtime, stopped_at=None):
+    """Adds the resource usage of a runtime to the totals, an open runtime is counted until stopped_at"""
+    if stopped_at is None:
+        stopped_at = runtime["stopped_at"]
+    seconds = max(0.0, stopped_at - runtime["started_at"])
+    totals["core_minutes"] += runtime["cores"] * seconds / 60
+    totals["gb_minutes"] += runtime["memory"] / 1024 * seconds / 60
+    totals["running_seconds"] += seconds
+    return totals
+
+
+def runtime_totals(runtimes):
+    """Sums up the resource usage of all closed runtimes"""
+    totals = empty_runtime_totals()
+    for runtime in runtimes:
+        if runtime["stopped_at"] is not None:
+            add_runtime_to_totals(totals, runtime)
+    return totals
+
+
+def _new_runtime_head():
+    return dict(next_seq=0, open=None, totals=empty_runtime_totals())
+
+
+def _legacy_runtime_head(runtimes):
+    head = _new_runtime_head()
+    if runtimes and runtimes[-1]["stopped_at"] is None:
+        head["open"] = runtimes[-1]
+        head["next_seq"] = len(runtimes) - 1
+    else:
+        head["next_seq"] = len(runtimes)
+    head["totals"] = runtime_totals(runtimes[:head["next_seq"]])
+    return head
+
+
+def _prepare_runtimes(data, closed_runtimes):
+    """
+    Sets the runtime head of the instance data and, if closed runtimes are given, the full list of runtimes.
+    Instances that were not migrated yet still have the legacy runtimes list which already contains everything.
+    """
+    legacy_runtimes = data.pop(LEGACY_RUNTIMES, None)
+    if RUNTIME_HEAD not in data:
+        legacy_runtimes = legacy_runtimes or list()
+        data[RUNTIME_HEAD] = _legacy_runtime_head(legacy_runtimes)
+        if closed_runtimes is not None:
+            closed_runtimes = legacy_runtimes[:data[RUNTIME_HEAD]["next_seq"]]
+    if closed_runtimes is not None:
+        open_runtime = data[RUNTIME_HEAD]["open"]
+        data["runtimes"] = closed_runtimes + ([open_runtime] if open_runtime is not None else list())
+
+
+def _matches(data, created_by, group, delete_before):
+    configuration = data.get("configuration") or dict()
+    if created_by is not None and (data.get("metadata") or dict()).get("created_by") != created_by:
+        return False
+    if group is not None and (configuration.get("admin") or dict()).get("group") != group:
+        return False
+    if delete_before is not None and not (configuration.get("delete_at") and configuration["delete_at"] <= delete_before):
+        return False
+    return True
+
+
+def _runtime_log_key(instance_id, seq):
+    return "{}/{}/{:010d}".format(BASE_KEY_RUNTIMES, instance_id, seq)
+
+
 def get_id_of_key(key):
     # The Last key part is 'configuration', 'metadata' and so on, so the key part before the last key part is the
     # searched one.
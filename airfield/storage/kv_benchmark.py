@@ -0,0 +1,50 @@
+"""Measures how long listing and reading instances takes with a key-value backend"""
+
+import random
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from .instance import InstanceStore, BASE_KEY, BASE_KEY_RUNTIMES
+
+
+SETUP_WORKERS = 16
+LIST_REPETITIONS = 5
+
+
+def run_benchmark(kv_adapter, instance_count, reads):
+    """
+    Stores the given number of synthetic instances, measures listing all instances, listing their ids and reading
+    single instances and removes them again. The kv adapter should use a separate base key.
+    Returns a dict of operation name to the median and 95th percentile in milliseconds.
+    """
+    instance_store = InstanceStore(kv_adapter)
+    instance_ids = [str(uuid.uuid4()) for _ in range(instance_count)]
+    try:
+        with ThreadPoolExecutor(max_workers=SETUP_WORKERS) as executor:
+            list(executor.map(lambda instance_id: instance_store.insert_instance(
+                instance_id, _configuration(instance_id), dict(created_by="benchmark", created_at=time.time())), instance_ids))
+        return dict(
+            list_instances=_measure(instance_store.get_all_instances, LIST_REPETITIONS),
+            list_instance_ids=_measure(instance_store.get_instance_ids, LIST_REPETITIONS),
+            read_instance=_measure(lambda: instance_store.get_instance(random.choice(instance_ids)), reads),
+        )
+    finally:
+        kv_adapter.delete_key(BASE_KEY, recursive=True)
+        kv_adapter.delete_key(BASE_KEY_RUNTIMES, recursive=True)
+
+
+def _measure(operation, repetitions):
+    durations = list()
+    for _ in range(repetitions):
+        started = time.perf_counter()
+        operation()
+        durations.append((time.perf_counter() - started) * 1000)
+    durations.sort()
+    return dict(median_ms=statistics.median(durations), p95_ms=durations[int(0.95 * (len(durations) - 1))])
+
+
+def _configuration(instance_id):
+    return dict(type="zeppelin", comment="benchmark", usermanagement=dict(enabled=False), libraries=list(),
+                spark=dict(cores_max=4, executor_memory="4096M"), marathon=dict(id=instance_id, instances=1),
+                environment={"SPARK_OPTION_{}".format(index): "x" * 20 for index in range(10)})
@@ -1,41 +1,121 @@
-
-from ..adapter.kv import KVAdapter
+import hashlib
+import json
+import threading
+from datetime import datetime
+from ..adapter.kv import KVAdapter, set_op, check_op, delete_op
+from .notebook_blob import NotebookBlobStore, references_of
 from ..util import dependency_injection as di
+from ..util.exception import ConflictError
+from ..util.logging import logger
 
 
 BASE_KEY = "notebooks"
+# Metadata of every stored notebook without its body, so listing notebooks does not download all bodies
+INDEX_KEY = "notebook_index"
+# Lookup of notebook ids by type and name, keyed by a hash of the name so any name is a valid key
+NAMES_KEY = "notebook_names"
+# Kept outside of the prefixes above, consul and etcd v2 recursive reads match key prefixes
+INDEX_VERSION_KEY = "notebook_migrations/index"
+INDEX_VERSION = 1
 
 
 class NotebookStore:
     @di.inject
-    def __init__(self, kv_adapter: KVAdapter):
+    def __init__(self, kv_adapter: KVAdapter, blob_store: NotebookBlobStore):
         self._kv_adapter = kv_adapter
+        self._blob_store = blob_store
+        self._index_ready = False
+        self._index_lock = threading.Lock()
 
     def get_notebooks(self, instance_type="zeppelin"):
+        self._ensure_index()
         notebooks = list()
-        for key, value in self._kv_adapter.get_keys(BASE_KEY):
-            if value["type"] != instance_type:
+        for _, entry in self._kv_adapter.get_keys(INDEX_KEY):
+            if entry["type"] != instance_type:
                 continue
-            notebooks.append(dict(id=_get_id_of_key(key), name=value["name"]))
+            notebooks.append(dict(id=entry["id"], name=entry["name"], creator=entry["creator"], size=entry["size"],
+                                  stored_at=entry["stored_at"]))
         return notebooks
 
     def get_notebook(self, notebook_id):
         data = self._kv_adapter.get_key("{}/{}".format(BASE_KEY, notebook_id))
+        # Notebooks stored before the deduplication contain their body
+        if data is not None and "ref" in data:
+            data["data"] = self._blob_store.get_notebook(data.pop("ref"))
         return data
 
     def find_notebook(self, instance_type, name):
-        for key, value in self._kv_adapter.get_keys(BASE_KEY):
-            if value["type"] != instance_type:
-                continue
-            if value["name"] == name:
-                return _get_id_of_key(key)
-        return None
+        self._ensure_index()
+        entry = self._kv_adapter.get_key(_name_key(instance_type, name))
+        if entry is None or entry["name"] != name:
+            return None
+        return entry["id"]
 
     def delete_notebook(self, notebook_id):
-        self._kv_adapter.delete_key("{}/{}".format(BASE_KEY, notebook_id))
+        """Deletes the body and the lookups of the notebook with one transaction"""
+        entry = self._kv_adapter.get_key("{}/{}".format(INDEX_KEY, notebook_id))
+        body_key = "{}/{}".format(BASE_KEY, notebook_id)
+        refs = references_of(self._kv_adapter.get_key(body_key))
+        ops = self._delete_name_ops(entry["type"], entry["name"], notebook_id) if entry is not None else list()
+        ops += [delete_op("{}/{}".format(INDEX_KEY, notebook_id)), delete_op(body_key)]
+        if not self._kv_adapter.txn(ops):
+            raise ConflictError(f"The notebook {notebook_id} is modified concurrently!")
+        self._blob_store.release(body_key, refs)
 
     def store_notebook(self, notebook_id, name, notebook_data, username):
-        self._kv_adapter.put_key("{}/{}".format(BASE_KEY, notebook_id), dict(type="zeppelin", name=name, data=notebook_data, creator=username))
+        """Writes the body and the lookups of the notebook with one transaction"""
+        body_key = "{}/{}".format(BASE_KEY, notebook_id)
+        previous = self._kv_adapter.get_key("{}/{}".format(INDEX_KEY, notebook_id))
+        previous_refs = references_of(self._kv_adapter.get_key(body_key))
+        ref = self._blob_store.put_notebook(body_key, notebook_data)
+        notebook = dict(type="zeppelin", name=name, ref=ref, creator=username)
+        ops = [set_op(body_key, notebook)]
+        ops += self._index_ops(notebook_id, notebook, len(json.dumps(notebook_data)), datetime.now().timestamp())
+        if previous is not None and (previous["type"], previous["name"]) != (notebook["type"], name):
+            ops += self._delete_name_ops(previous["type"], previous["name"], notebook_id)
+        if not self._kv_adapter.txn(ops):
+            raise ConflictError(f"The notebook {notebook_id} is modified concurrently!")
+        self._blob_store.release(body_key, previous_refs - {ref})
+
+    def migrate_index(self):
+        """Builds the metadata index and the name lookup from the stored notebooks. Returns the number of notebooks."""
+        count = 0
+        for key, notebook in self._kv_adapter.get_keys(BASE_KEY):
+            size = len(json.dumps(notebook["data"])) if "data" in notebook else None
+            self._kv_adapter.txn(self._index_ops(_get_id_of_key(key), notebook, size, None))
+            count += 1
+        self._kv_adapter.put_key(INDEX_VERSION_KEY, INDEX_VERSION)
+        logger.info("Migrated {} notebooks to the notebook index".format(count))
+        return count
+
+    def _ensure_index(self):
+        """Migrates existing notebooks to the index once per process if that has not been done yet"""
+        if self._index_ready:
+            return
+        with self._index_lock:
+            if not self._index_ready:
+                if self._kv_adapter.get_key(INDEX_VERSION_KEY) != INDEX_VERSION:
+                    self.migrate_index()
+                self._index_ready = True
+
+    def _index_ops(self, notebook_id, notebook, size, stored_at):
+        entry = dict(id=notebook_id, name=notebook["name"], type=notebook["type"], creator=notebook.get("creator"),
+                     size=size, stored_at=stored_at)
+        return [set_op("{}/{}".format(INDEX_KEY, notebook_id), entry),
+                set_op(_name_key(notebook["type"], notebook["name"]), dict(id=notebook_id, name=notebook["name"]))]
+
+    def _delete_name_ops(self, instance_type, name, notebook_id):
+        # Only remove the lookup if it was not taken over by another notebook with the same name, the check fails
+        # the transaction if that happens after the lookup was read
+        key = _name_key(instance_type, name)
+        entry, index = self._kv_adapter.get_key_with_index(key)
+        if entry is None or entry["id"] != notebook_id:
+            return list()
+        return [check_op(key, index), delete_op(key)]
+
+
+def _name_key(instance_type, name):
+    return "{}/{}/{}".format(NAMES_KEY, instance_type, hashlib.sha256(name.encode("utf-8")).hexdigest())
 
 
 def _get_id_of_key(key):
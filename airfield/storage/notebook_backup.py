@@ -0,0 +1,37 @@
+"""Schedule of the automatic notebook backups that is shared by all airfield workers"""
+
+from datetime import datetime
+from ..adapter.kv import KVAdapter
+from ..util import dependency_injection as di
+
+
+BASE_KEY = "notebook_backups"
+
+
+class NotebookBackupStore:
+    """Keeps the time of the last automatic backup per instance"""
+    @di.inject
+    def __init__(self, kv_adapter: KVAdapter):
+        self._kv_adapter = kv_adapter
+
+    def claim_backup(self, instance_id, interval_seconds):
+        """
+        Returns whether the backup of the instance is due and was claimed by the caller.
+        The time of the backup is set with compare-and-swap, so only one worker claims it per interval.
+        """
+        key = _backup_key(instance_id)
+        schedule, index = self._kv_adapter.get_key_with_index(key)
+        now = datetime.now().timestamp()
+        if schedule is not None and schedule["backed_up_at"] + interval_seconds > now:
+            return False
+        return self._kv_adapter.put_key_cas(key, dict(backed_up_at=now), index)
+
+    def get_instance_ids(self):
+        return [key.split('/')[-1] for key in self._kv_adapter.get_key_names(BASE_KEY)]
+
+    def delete_backup(self, instance_id):
+        self._kv_adapter.delete_key(_backup_key(instance_id))
+
+
+def _backup_key(instance_id):
+    return "{}/{}".format(BASE_KEY, instance_id)
@@ -0,0 +1,178 @@
+"""Content-addressed storage of notebook bodies that are shared by backups, templates and exports"""
+
+import copy
+import hashlib
+import json
+from datetime import datetime
+from uuid import uuid4
+from prometheus_client import Counter
+from ..adapter.kv import KVAdapter
+from ..util import dependency_injection as di
+from ..util.exception import ConflictError
+from ..util.logging import logger
+
+
+BLOB_KEY = "notebook_blobs"
+# One entry per content hash with the keys of the values that reference it, kept apart from the (large) blobs
+REFS_KEY = "notebook_refs"
+MAX_CAS_ATTEMPTS = 10
+# Fields that change with every run of a notebook but not its content
+VOLATILE_NOTE_FIELDS = ["info"]
+VOLATILE_PARAGRAPH_FIELDS = ["results", "dateCreated", "dateStarted", "dateFinished", "dateUpdated", "status", "jobName",
+                             "progressUpdateIntervalMs", "runtimeInfos", "errorMessage"]
+
+_metric_writes = Counter("airfield_notebook_blob_writes", "Notebook bodies stored or deduplicated by content", ["result"])
+_metric_collected = Counter("airfield_notebook_blobs_collected", "Notebook bodies removed by the garbage collection")
+
+
+class NotebookBlobStore:
+    """
+    Stores every distinct notebook body once under the hash of its normalized content. Values that use a notebook
+    hold a reference (the hash) and are registered as holders of it with their own key. A body is removed by the
+    garbage collection once it has had no holders for a grace period. Holders whose key no longer references the
+    body, e.g. because the instance was deleted, are dropped by the garbage collection as well.
+    Every body is written under a new generation when it is stored again after being collected, so a collection
+    can never delete a body that was stored concurrently.
+    """
+    @di.inject
+    def __init__(self, kv_adapter: KVAdapter):
+        self._kv_adapter = kv_adapter
+
+    def put_notebook(self, holder, notebook):
+        """Registers the key holder as user of the notebook, stores its body if it is new and returns its reference"""
+        notebook = normalize(notebook)
+        ref = content_hash(notebook)
+        key = _refs_key(ref)
+        for _ in range(MAX_CAS_ATTEMPTS):
+            entry, index = self._kv_adapter.get_key_with_index(key)
+            created = entry is None or entry["collected"]
+            if created:
+                entry = dict(holders=dict(), generation=uuid4().hex, released_at=None, collected=False)
+                # The body must exist before the entry references it, others deduplicate against it right away
+                self._kv_adapter.put_key(_blob_key(ref, entry["generation"]), notebook)
+            elif holder in entry["holders"]:
+                _metric_writes.labels("deduplicated").inc()
+                return ref
+            entry["holders"][holder] = datetime.now().timestamp()
+            entry["released_at"] = None
+            if self._kv_adapter.put_key_cas(key, entry, index):
+                _metric_writes.labels("stored" if created else "deduplicated").inc()
+                return ref
+            if created:
+                self._kv_adapter.delete_key(_blob_key(ref, entry["generation"]))
+        raise ConflictError(f'The references of notebook {ref} are modified concurrently!')
+
+    def get_notebook(self, ref):
+        entry = self._kv_adapter.get_key(_refs_key(ref))
+        if entry is None or entry["collected"]:
+            return None
+        return self._kv_adapter.get_key(_blob_key(ref, entry["generation"]))
+
+    def release(self, holder, refs):
+        """Removes the key holder from the users of the given references"""
+        for ref in set(refs):
+            self._update(ref, lambda entry, now: _remove_holders(entry, [holder], now))
+
+    def collect_garbage(self, grace_seconds):
+        """
+        Drops holders that were registered longer than the grace period ago but do not reference their notebook
+        anymore and removes the bodies that have had no holders for the grace period, as well as chunks of
+        overwritten values in the key-value store. Returns the number of removed bodies.
+        """
+        now = datetime.now().timestamp()
+        holder_refs = dict()
+        collected = 0
+        for key, entry in list(self._kv_adapter.get_keys(REFS_KEY)):
+            ref = key.split('/')[-1]
+            if entry["collected"]:
+                if entry["released_at"] + grace_seconds <= now:
+                    # Only the tombstone is left, its body was deleted with the last run
+                    self._kv_adapter.delete_key(_refs_key(ref))
+                continue
+            stale = [holder for holder, added_at in entry["holders"].items()
+                     if added_at + grace_seconds <= now and ref not in self._refs_of_holder(holder, holder_refs)]
+            if stale:
+                logger.debug("Dropping stale holders of notebook {}: {}".format(ref, stale))
+                entry = self._update(ref, lambda entry, now: _remove_holders(entry, stale, now))
+            if entry is not None and self._collect(ref, grace_seconds):
+                collected += 1
+        _metric_collected.inc(collected)
+        # Notebook bodies are the values large enough to be chunked, replacing them leaves the old chunks behind
+        chunk_generations = self._kv_adapter.collect_chunk_garbage(grace_seconds)
+        if chunk_generations:
+            logger.info("Removed {} replaced generations of chunks".format(chunk_generations))
+        return collected
+
+    def _collect(self, ref, grace_seconds):
+        def mark_collected(entry, now):
+            if entry["collected"] or entry["holders"] or entry["released_at"] + grace_seconds > now:
+                return False
+            entry["collected"] = True
+            entry["released_at"] = now
+            return True
+        entry = self._update(ref, mark_collected)
+        if entry is None:
+            return False
+        # Storing the notebook again creates a new generation, so only the unreferenced body is deleted
+        self._kv_adapter.delete_key(_blob_key(ref, entry["generation"]))
+        return True
+
+    def _refs_of_holder(self, holder, holder_refs):
+        if holder not in holder_refs:
+            holder_refs[holder] = references_of(self._kv_adapter.get_key(holder))
+        return holder_refs[holder]
+
+    def _update(self, ref, update):
+        """Applies the update to the entry of the reference with compare-and-swap, returns None if nothing changed"""
+        key = _refs_key(ref)
+        for _ in range(MAX_CAS_ATTEMPTS):
+            entry, index = self._kv_adapter.get_key_with_index(key)
+            if entry is None or not update(entry, datetime.now().timestamp()):
+                return None
+            if self._kv_adapter.put_key_cas(key, entry, index):
+                return entry
+        raise ConflictError(f'The references of notebook {ref} are modified concurrently!')
+
+
+def normalize(notebook):
+    """Returns a copy of the notebook without the fields that change when it is run"""
+    notebook = copy.deepcopy(notebook)
+    for field in VOLATILE_NOTE_FIELDS:
+        notebook.pop(field, None)
+    for paragraph in notebook.get("paragraphs", list()):
+        if not isinstance(paragraph, dict):
+            continue
+        for field in VOLATILE_PARAGRAPH_FIELDS:
+            paragraph.pop(field, None)
+    return notebook
+
+
+def content_hash(notebook):
+    return hashlib.sha256(json.dumps(notebook, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def references_of(value):
+    """Returns the references held by a value, i.e. by a dict with a ref or by a list of them"""
+    if isinstance(value, dict):
+        value = [value]
+    if not isinstance(value, list):
+        return set()
+    return {item["ref"] for item in value if isinstance(item, dict) and "ref" in item}
+
+
+def _remove_holders(entry, holders, now):
+    if not any(holder in entry["holders"] for holder in holders):
+        return False
+    for holder in holders:
+        entry["holders"].pop(holder, None)
+    if not entry["holders"]:
+        entry["released_at"] = now
+    return True
+
+
+def _refs_key(ref):
+    return "{}/{}".format(REFS_KEY, ref)
+
+
+def _blob_key(ref, generation):
+    return "{}/{}/{}".format(BLOB_KEY, ref, generation)
@@ -0,0 +1,87 @@
+"""Queue of pending notebook restores that is shared by all airfield workers"""
+
+from datetime import datetime
+from ..adapter.kv import KVAdapter
+from ..util import dependency_injection as di
+
+
+BASE_KEY = "notebook_restores"
+MAX_CAS_ATTEMPTS = 10
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class NotebookRestoreStore:
+    """
+    Keeps one restore item per instance with its status (queued, running, done or failed).
+    A worker has to claim an item before processing it. Claiming sets a lease with an expiry time using a
+    compare-and-swap write, so only one worker gets it. The lease of a worker that died expires and the item can be
+    claimed again.
+    """
+    @di.inject
+    def __init__(self, kv_adapter: KVAdapter):
+        self._kv_adapter = kv_adapter
+
+    def enqueue(self, instance_id):
+        now = datetime.now().timestamp()
+        restore = dict(instance_id=instance_id, status=QUEUED, queued_at=now, updated_at=now, attempts=0, lease=None,
+                       results=list(), error=None)
+        self._kv_adapter.put_key(_restore_key(instance_id), restore)
+        return restore
+
+    def get_restore(self, instance_id):
+        return self._kv_adapter.get_key(_restore_key(instance_id))
+
+    def get_restores(self):
+        return [restore for _, restore in self._kv_adapter.get_keys(BASE_KEY)]
+
+    def delete_restore(self, instance_id):
+        self._kv_adapter.delete_key(_restore_key(instance_id))
+
+    def claim(self, instance_id, owner, lease_seconds):
+        """Takes the lease of a queued item or of one whose lease expired. Returns the item or None if not claimed."""
+        def claim(restore, now):
+            if not is_claimable(restore, now):
+                return False
+            restore.update(status=RUNNING, lease=dict(owner=owner, expires_at=now + lease_seconds),
+                           attempts=restore["attempts"] + 1)
+            return True
+        return self._update(instance_id, claim)
+
+    def release(self, instance_id, owner, status=QUEUED, results=None, error=None):
+        """Gives up the lease and sets the new status of the item. Returns None if the lease was lost meanwhile."""
+        def release(restore, now):
+            if restore["lease"] is None or restore["lease"]["owner"] != owner:
+                return False
+            restore.update(status=status, lease=None, error=error)
+            if results is not None:
+                restore["results"] = results
+            return True
+        return self._update(instance_id, release)
+
+    def _update(self, instance_id, update):
+        key = _restore_key(instance_id)
+        for _ in range(MAX_CAS_ATTEMPTS):
+            restore, index = self._kv_adapter.get_key_with_index(key)
+            if restore is None:
+                return None
+            now = datetime.now().timestamp()
+            if not update(restore, now):
+                return None
+            restore["updated_at"] = now
+            if self._kv_adapter.put_key_cas(key, restore, index):
+                return restore
+        return None
+
+
+def is_claimable(restore, now):
+    if restore["status"] == QUEUED:
+        return True
+    return restore["status"] == RUNNING and restore["lease"] is not None and restore["lease"]["expires_at"] <= now
+
+
+def _restore_key(instance_id):
+    return "{}/{}".format(BASE_KEY, instance_id)
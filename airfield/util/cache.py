@@ -0,0 +1,56 @@
+"""Small in-process caches for hot lookups"""
+
+import threading
+import time
+from collections import OrderedDict
+from . import metrics
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a time to live.
+    With sliding expiry every access extends the lifetime of an entry, so only idle entries expire.
+    Hits and misses are counted in the cache metrics under the given name.
+    """
+    def __init__(self, name, max_size, ttl_seconds, sliding=False):
+        self._name = name
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._sliding = sliding
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                metrics.cache_miss(self._name)
+                return default
+            self._entries.move_to_end(key)
+            if self._sliding:
+                self._entries[key] = (now + self._ttl_seconds, entry[1])
+            metrics.cache_hit(self._name)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[1] if entry is not None else default
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
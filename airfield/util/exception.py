@@ -33,3 +33,8 @@ class HostNetworkException(Exception):
     def __init__(self, error):
         super().__init__()
         self.error = error
+
+
+class KVWatchGapException(TechnicalException):
+    """The changes since the watched index are not available anymore, the watched keys must be read again"""
+    pass
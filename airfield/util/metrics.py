@@ -5,6 +5,7 @@ from prometheus_client import Gauge, Counter, Summary
 
 _metric_api_endpoint_summary = Summary("airfield_api_endpoint", "", ["endpoint", "method"])
 _metric_service_method_summary = Summary("airfield_service_method", "", ["component", "method"])
+_metric_cache_counter = Counter("airfield_cache_lookups", "Lookups of in-process caches", ["cache", "result"])
 
 
 def api_endpoint(endpoint, method=None):
@@ -21,3 +22,11 @@ def instrument(func):
 
 def service_method(component, method):
     return _metric_service_method_summary.labels(component, method).time()
+
+
+def cache_hit(cache):
+    _metric_cache_counter.labels(cache, "hit").inc()
+
+
+def cache_miss(cache):
+    _metric_cache_counter.labels(cache, "miss").inc()
@@ -0,0 +1,59 @@
+import base64
+import io
+import json
+import unittest
+from unittest import mock
+from urllib.error import HTTPError
+from airfield.adapter.consul import ConsulAdapter
+from airfield.adapter.kv import set_op, check_op, delete_op
+from airfield.util.exception import TechnicalException
+
+
+class ConsulTransactionTest(unittest.TestCase):
+    def setUp(self):
+        with mock.patch("airfield.adapter.consul.config.CONSUL_ENDPOINT", "http://consul:8500/v1/"):
+            self.under_test = ConsulAdapter()
+        patcher = mock.patch("airfield.adapter.consul.request.urlopen")
+        self.urlopen = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_operations_are_sent_in_one_request(self):
+        self.assertTrue(self.under_test.txn([check_op("instances/a/runtime_head", 7), set_op("deleted_instances/a/metadata", "{}"),
+                                             check_op("notebook_names/x", None), delete_op("instances/a", recursive=True)]))
+        self.urlopen.assert_called_once()
+        req = self.urlopen.call_args[0][0]
+        self.assertEqual((req.full_url, req.method), ("http://consul:8500/v1/txn", "PUT"))
+        self.assertEqual([op["KV"] for op in json.loads(req.data)], [
+            dict(Verb="check-index", Key="airfield/instances/a/runtime_head", Index=7),
+            dict(Verb="set", Key="airfield/deleted_instances/a/metadata", Value=base64.b64encode(b"{}").decode("ascii")),
+            dict(Verb="check-not-exists", Key="airfield/notebook_names/x"),
+            dict(Verb="delete", Key="airfield/instances/a"),
+            dict(Verb="delete-tree", Key="airfield/instances/a/"),
+        ])
+
+    def test_recursive_delete_does_not_match_by_prefix(self):
+        self.assertTrue(self.under_test.delete_key("kv_chunks/notebooks/abc", recursive=True))
+        self.assertEqual([op["KV"] for op in json.loads(self.urlopen.call_args[0][0].data)], [
+            dict(Verb="delete", Key="airfield/kv_chunks/notebooks/abc"),
+            dict(Verb="delete-tree", Key="airfield/kv_chunks/notebooks/abc/"),
+        ])
+
+    def test_rolled_back_transaction(self):
+        self.urlopen.side_effect = HTTPError("http://consul:8500/v1/txn", 409, "Conflict", dict(),
+                                             io.BytesIO(b'{"Errors": [{"OpIndex": 0, "What": "index mismatch"}]}'))
+        self.assertFalse(self.under_test.txn([check_op("instances/a/runtime_head", 7), delete_op("instances/a")]))
+
+    def test_key_names_are_listed_without_values(self):
+        self.urlopen.return_value.__enter__.return_value.read.return_value = b'["airfield/kv_chunks/notebooks/1/g/0"]'
+        self.assertEqual(self.under_test.get_key_names("kv_chunks"), ["airfield/kv_chunks/notebooks/1/g/0"])
+        self.assertEqual(self.urlopen.call_args[0][0], "http://consul:8500/v1/kv/airfield/kv_chunks/?keys=true")
+        self.urlopen.side_effect = HTTPError("http://consul:8500/v1/kv/airfield/kv_chunks/?keys=true", 404, "Not Found",
+                                             dict(), io.BytesIO(b""))
+        self.assertEqual(self.under_test.get_key_names("kv_chunks"), [])
+
+    def test_transactions_beyond_the_limits_of_consul_are_rejected(self):
+        with self.assertRaises(TechnicalException):
+            self.under_test.txn([set_op("instances/{}".format(index), "{}") for index in range(65)])
+        with self.assertRaises(TechnicalException):
+            self.under_test.txn([set_op("notebooks/1", "x" * 400 * 1024)])
+        self.urlopen.assert_not_called()
@@ -0,0 +1,136 @@
+import base64
+import json
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+import requests
+from airfield.adapter.etcd3 import Etcd3Adapter
+from airfield.adapter.kv import set_op, check_op, delete_op
+from airfield.util import logging
+from airfield.util.exception import KVWatchGapException, TechnicalException
+
+
+def _b64(value):
+    return base64.b64encode(value.encode("utf-8")).decode("ascii")
+
+
+def _kv(key, value, revision=5):
+    return dict(key=_b64(key), value=_b64(value), mod_revision=str(revision))
+
+
+class Etcd3AdapterTest(unittest.TestCase):
+    def setUp(self):
+        with mock.patch("airfield.adapter.etcd3.config.ETCD3_ENDPOINT", "etcd:2379"):
+            self.under_test = Etcd3Adapter()
+        self.session = mock.MagicMock()
+        self.under_test._session = self.session
+        self.responses = list()
+        self.session.post.side_effect = lambda url, **kwargs: self.responses.pop(0)
+
+    def _respond(self, body):
+        response = mock.MagicMock()
+        response.json.return_value = body
+        self.responses.append(response)
+
+    def _request(self, call=0):
+        url, kwargs = self.session.post.call_args_list[call][0][0], self.session.post.call_args_list[call][1]
+        return url, json.loads(kwargs["data"])
+
+    def test_reads_below_a_key_match_path_segments(self):
+        self._respond(dict(kvs=[_kv("airfield/instances/a", "x"), _kv("airfield/instances/a/configuration", "{}"),
+                                _kv("airfield/instances/a-b/configuration", "{}")]))
+        self.assertEqual(list(self.under_test.get_keys("instances/a")),
+                         [("airfield/instances/a", "x"), ("airfield/instances/a/configuration", "{}")])
+        url, body = self._request()
+        self.assertEqual(url, "http://etcd:2379/v3/kv/range")
+        self.assertEqual(body, dict(key=_b64("airfield/instances/a"), range_end=_b64("airfield/instances/a0")))
+
+    def test_ids_are_listed_without_values(self):
+        self._respond(dict(kvs=[dict(key=_b64("airfield/instances/a/configuration"))]))
+        self.assertEqual(self.under_test.get_key_names("instances"), ["airfield/instances/a/configuration"])
+        self.assertTrue(self._request()[1]["keys_only"])
+
+    def test_transactions_compare_revisions(self):
+        self._respond(dict(header=dict(revision="9")))
+        self.assertFalse(self.under_test.txn([check_op("instances/a/runtime_head", 7), check_op("notebook_names/x", None),
+                                              set_op("deleted_instances/a/metadata", "{}"), delete_op("instances/a", recursive=True)]))
+        url, body = self._request()
+        self.assertEqual(url, "http://etcd:2379/v3/kv/txn")
+        self.assertEqual(body["compare"], [
+            dict(key=_b64("airfield/instances/a/runtime_head"), target="MOD", result="EQUAL", mod_revision="7"),
+            dict(key=_b64("airfield/notebook_names/x"), target="CREATE", result="EQUAL", create_revision="0")])
+        self.assertEqual(body["success"], [
+            dict(request_put=dict(key=_b64("airfield/deleted_instances/a/metadata"), value=_b64("{}"))),
+            dict(request_delete_range=dict(key=_b64("airfield/instances/a"))),
+            dict(request_delete_range=dict(key=_b64("airfield/instances/a/"), range_end=_b64("airfield/instances/a0")))])
+
+    def test_cas_uses_mod_revision(self):
+        self._respond(dict(kvs=[_kv("airfield/restores/a", "{}", revision=12)]))
+        self._respond(dict(succeeded=True))
+        value, index = self.under_test.get_key_with_index("restores/a")
+        self.assertEqual((value, index), ("{}", 12))
+        self.assertTrue(self.under_test.put_key_cas("restores/a", "{}", index))
+        self.assertEqual(self._request(1)[1]["compare"][0]["mod_revision"], "12")
+
+    def test_watch_returns_changes_after_the_index(self):
+        response = mock.MagicMock()
+        response.__enter__.return_value.iter_lines.return_value = [
+            json.dumps(dict(result=dict(created=True))),
+            json.dumps(dict(result=dict(events=[dict(kv=_kv("airfield/instances/a/metadata", "{}", 11)),
+                                                dict(type="DELETE", kv=dict(key=_b64("airfield/instances/b/metadata"), mod_revision="11"))])))]
+        self.responses.append(response)
+        entries, index, complete = self.under_test.watch_keys("instances", 10, 30)
+        self.assertEqual(entries, {"airfield/instances/a/metadata": "{}", "airfield/instances/b/metadata": None})
+        self.assertEqual((index, complete), (11, False))
+        self.assertEqual(self._request()[1]["create_request"]["start_revision"], "11")
+
+    def test_watch_of_compacted_revision(self):
+        response = mock.MagicMock()
+        response.__enter__.return_value.iter_lines.return_value = [
+            json.dumps(dict(result=dict(canceled=True, compact_revision="50")))]
+        self.responses.append(response)
+        with self.assertRaises(KVWatchGapException):
+            self.under_test.watch_keys("instances", 10, 30)
+
+    def test_watch_that_cannot_be_created_fails(self):
+        self.session.post.side_effect = requests.exceptions.ConnectionError("refused")
+        with self.assertRaises(TechnicalException):
+            self.under_test.watch_keys("instances", 10, 30)
+
+
+class _IdleWatchHandler(BaseHTTPRequestHandler):
+    """Confirms the watch and then keeps the stream open without events like etcd does"""
+    protocol_version = "HTTP/1.1"
+    release = threading.Event()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        line = json.dumps(dict(result=dict(header=dict(revision="10"), created=True))).encode("utf-8") + b"\n"
+        self.wfile.write("{:x}\r\n".format(len(line)).encode("ascii") + line + b"\r\n")
+        self.wfile.flush()
+        self.release.wait(5)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Etcd3IdleWatchTest(unittest.TestCase):
+    def setUp(self):
+        logging.silence()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _IdleWatchHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        _IdleWatchHandler.release.clear()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(_IdleWatchHandler.release.set)
+        with mock.patch("airfield.adapter.etcd3.config.ETCD3_ENDPOINT", "127.0.0.1:{}".format(self.server.server_port)):
+            self.under_test = Etcd3Adapter()
+        self.addCleanup(self.under_test._session.close)
+
+    def test_idle_stream_is_no_change(self):
+        self.assertEqual(self.under_test.watch_keys("instances", 10, 0.2), (dict(), 10, False))
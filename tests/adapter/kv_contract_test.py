@@ -0,0 +1,120 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from airfield.adapter.consul import ConsulAdapter
+from airfield.adapter.etcd import EtcdAdapter
+from airfield.adapter.etcd3 import Etcd3Adapter
+from airfield.adapter.kv import set_op, check_op, delete_op
+from airfield.adapter.sqlite import SqliteAdapter
+
+
+class KVBackendContract:
+    """
+    Behaviour every backend of the KVAdapter has to provide. The subclasses create the backend in setUpClass,
+    backends that need a server only run if its endpoint is given in the environment.
+    """
+    backend = None
+
+    def setUp(self):
+        self.addCleanup(self.backend.delete_key, "contract", True)
+
+    def _key(self, key):
+        return self.backend.backend_key("contract/" + key)
+
+    def test_put_and_get(self):
+        self.assertIsNone(self.backend.get_key("contract/missing"))
+        self.backend.put_key("contract/a", '{"name": "ärger"}')
+        self.assertEqual(self.backend.get_key("contract/a"), '{"name": "ärger"}')
+        self.backend.put_key("contract/a", "2")
+        self.assertEqual(self.backend.get_key("contract/a"), "2")
+
+    def test_get_keys_below_a_key(self):
+        self.backend.put_key("contract/a/x", "1")
+        self.backend.put_key("contract/a/y", "2")
+        self.backend.put_key("contract/b/z", "3")
+        self.assertEqual(sorted(self.backend.get_keys("contract/a")), [(self._key("a/x"), "1"), (self._key("a/y"), "2")])
+        self.assertEqual(len(list(self.backend.get_keys("contract"))), 3)
+        self.assertEqual(list(self.backend.get_keys("contract/c")), [])
+
+    def test_compare_and_swap(self):
+        self.assertEqual(self.backend.get_key_with_index("contract/a"), (None, None))
+        self.assertTrue(self.backend.put_key_cas("contract/a", "1", None))
+        self.assertFalse(self.backend.put_key_cas("contract/a", "2", None))
+        value, index = self.backend.get_key_with_index("contract/a")
+        self.assertEqual(value, "1")
+        self.assertTrue(self.backend.put_key_cas("contract/a", "2", index))
+        self.assertFalse(self.backend.put_key_cas("contract/a", "3", index))
+        self.assertEqual(self.backend.get_key("contract/a"), "2")
+
+    def test_delete(self):
+        self.backend.put_key("contract/a", "1")
+        self.backend.put_key("contract/b/x", "2")
+        self.backend.put_key("contract/b/y", "3")
+        self.assertTrue(self.backend.delete_key("contract/a"))
+        self.assertFalse(self.backend.delete_key("contract/a"))
+        self.assertIsNone(self.backend.get_key("contract/a"))
+        self.backend.delete_key("contract/b", recursive=True)
+        self.assertEqual(list(self.backend.get_keys("contract")), [])
+
+    def test_transaction_is_applied_as_a_whole(self):
+        self.backend.put_key("contract/a", "1")
+        self.backend.put_key("contract/b/x", "2")
+        _, index = self.backend.get_key_with_index("contract/a")
+        self.assertFalse(self.backend.txn([check_op("contract/a", index), check_op("contract/c", None),
+                                           check_op("contract/b/x", None), set_op("contract/c", "3")]))
+        self.assertIsNone(self.backend.get_key("contract/c"))
+        self.assertTrue(self.backend.txn([check_op("contract/a", index), check_op("contract/c", None), set_op("contract/c", "3"),
+                                          set_op("contract/a", "4"), delete_op("contract/b", recursive=True)]))
+        self.assertEqual(sorted(self.backend.get_keys("contract")), [(self._key("a"), "4"), (self._key("c"), "3")])
+
+    def test_watch(self):
+        self.backend.put_key("contract/a", "1")
+        entries, index, complete = self.backend.watch_keys("contract", None, 1)
+        self.assertEqual((entries, complete), ({self._key("a"): "1"}, True))
+        self.backend.put_key("contract/b", "2")
+        for _ in range(3):
+            entries, index, complete = self.backend.watch_keys("contract", index, 5)
+            if self._key("b") in entries:
+                break
+        self.assertEqual(entries[self._key("b")], "2")
+
+
+class SqliteContractTest(KVBackendContract, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.backend = SqliteAdapter(os.path.join(cls.directory.name, "airfield.db"))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+
+@unittest.skipUnless(os.getenv("AIRFIELD_TEST_CONSUL_ENDPOINT"), "AIRFIELD_TEST_CONSUL_ENDPOINT is not set")
+class ConsulContractTest(KVBackendContract, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with mock.patch("airfield.adapter.consul.config.CONSUL_ENDPOINT", os.getenv("AIRFIELD_TEST_CONSUL_ENDPOINT")):
+            cls.backend = ConsulAdapter()
+
+
+@unittest.skipUnless(os.getenv("AIRFIELD_TEST_ETCD_ENDPOINT"), "AIRFIELD_TEST_ETCD_ENDPOINT is not set")
+class EtcdContractTest(KVBackendContract, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with mock.patch("airfield.adapter.etcd.config.ETCD_ENDPOINT", os.getenv("AIRFIELD_TEST_ETCD_ENDPOINT")):
+            cls.backend = EtcdAdapter()
+
+    def test_transaction_is_applied_as_a_whole(self):
+        # etcd v2 has no transactions, without concurrent writers applying the operations in order has the same result
+        with mock.patch.object(self.backend, "txn", self.backend.apply_sequentially, create=True):
+            super().test_transaction_is_applied_as_a_whole()
+
+
+@unittest.skipUnless(os.getenv("AIRFIELD_TEST_ETCD3_ENDPOINT"), "AIRFIELD_TEST_ETCD3_ENDPOINT is not set")
+class Etcd3ContractTest(KVBackendContract, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with mock.patch("airfield.adapter.etcd3.config.ETCD3_ENDPOINT", os.getenv("AIRFIELD_TEST_ETCD3_ENDPOINT")):
+            cls.backend = Etcd3Adapter()
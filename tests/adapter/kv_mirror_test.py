@@ -0,0 +1,140 @@
+import threading
+import time
+import unittest
+from unittest import mock
+from airfield.adapter.kv import KVAdapter
+from airfield.util.exception import KVWatchGapException, TechnicalException
+
+
+class _WatchedBackend:
+    """Answers watches like consul blocking queries, writes of other workers are done with write_remote"""
+    def __init__(self):
+        self.data = dict()
+        self.index = 1
+        self.reads = 0
+        self.hold_events = threading.Event()
+        self.fail = None
+        self._changed = threading.Condition()
+
+    def backend_key(self, key):
+        return "airfield/" + key
+
+    def get_key(self, key):
+        self.reads += 1
+        return self.data.get(self.backend_key(key))
+
+    def get_keys(self, key):
+        self.reads += 1
+        return [(sub_key, value) for sub_key, value in self.data.items() if sub_key.startswith(self.backend_key(key))]
+
+    def get_key_with_index(self, key):
+        return self.data.get(self.backend_key(key)), self.index
+
+    def put_key(self, key, value):
+        self.write_remote(key, value)
+
+    def put_key_cas(self, key, value, index):
+        self.write_remote(key, value)
+        return True
+
+    def delete_key(self, key, recursive=False):
+        with self._changed:
+            for sub_key in [sub_key for sub_key in self.data if sub_key == self.backend_key(key)
+                            or recursive and sub_key.startswith(self.backend_key(key) + "/")]:
+                del self.data[sub_key]
+            self._notify()
+        return True
+
+    def write_remote(self, key, value):
+        with self._changed:
+            self.data[self.backend_key(key)] = value
+            self._notify()
+
+    def _notify(self):
+        self.index += 1
+        if not self.hold_events.is_set():
+            self._changed.notify_all()
+
+    def release_events(self):
+        with self._changed:
+            self.hold_events.clear()
+            self._changed.notify_all()
+
+    def watch_keys(self, key, index, wait_seconds):
+        with self._changed:
+            if self.fail is not None:
+                fail, self.fail = self.fail, None
+                raise fail
+            if index is not None:
+                self._changed.wait_for(lambda: self.index > index and not self.hold_events.is_set(), timeout=0.2)
+            prefix = self.backend_key(key)
+            return {sub_key: value for sub_key, value in self.data.items() if sub_key.startswith(prefix + "/")}, self.index, True
+
+
+def _wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("Condition not reached")
+
+
+@mock.patch("airfield.adapter.kv_mirror.config.KV_MIRROR_RECONNECT_SECONDS", 0.01)
+class KVMirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = _WatchedBackend()
+        self.backend.write_remote("instances/a/configuration", '{"type": "zeppelin"}')
+        self.under_test = KVAdapter(self.backend, mirror_prefixes=["instances"])
+        self.addCleanup(self.under_test._mirror.stop)
+        _wait_for(lambda: self.under_test._mirror.serves("instances"))
+
+    def test_reads_are_served_from_memory(self):
+        self.assertEqual(self.under_test.get_key("instances/a/configuration"), dict(type="zeppelin"))
+        self.assertEqual(list(self.under_test.get_keys("instances/a")), [("airfield/instances/a/configuration", dict(type="zeppelin"))])
+        self.assertIsNone(self.under_test.get_key("instances/b/configuration"))
+        self.assertEqual(self.backend.reads, 0)
+        # Keys outside of the mirrored subtrees are read from the store
+        self.under_test.get_key("notebooks/1")
+        self.assertEqual(self.backend.reads, 1)
+
+    def test_remote_changes_are_followed(self):
+        self.backend.write_remote("instances/b/configuration", '{"type": "jupyter"}')
+        self.backend.delete_key("instances/a", recursive=True)
+        _wait_for(lambda: self.under_test.get_key("instances/a/configuration") is None)
+        _wait_for(lambda: self.under_test.get_key("instances/b/configuration") == dict(type="jupyter"))
+
+    def test_own_writes_are_read_before_the_watch_delivers_them(self):
+        self.backend.hold_events.set()
+        self.under_test.put_key("instances/b/configuration", dict(type="jupyter"))
+        self.under_test.delete_key("instances/a", recursive=True)
+        self.assertEqual(self.under_test.get_key("instances/b/configuration"), dict(type="jupyter"))
+        self.assertEqual([key for key, _ in self.under_test.get_keys("instances")], ["airfield/instances/b/configuration"])
+        self.backend.release_events()
+        _wait_for(lambda: not self.under_test._mirror._pending)
+        self.assertEqual([key for key, _ in self.under_test.get_keys("instances")], ["airfield/instances/b/configuration"])
+
+    def test_change_listeners_get_changed_keys(self):
+        changed = list()
+        self.assertTrue(self.under_test.add_change_listener("instances", changed.append))
+        self.assertFalse(self.under_test.add_change_listener("notebooks", changed.append))
+        self.backend.write_remote("instances/b/configuration", '{"type": "jupyter"}')
+        _wait_for(lambda: changed == ["instances/b/configuration"])
+        # The watch returns the whole subtree again, but only the deleted key changed
+        self.backend.delete_key("instances/a", recursive=True)
+        _wait_for(lambda: len(changed) == 2)
+        self.assertEqual(changed, ["instances/b/configuration", "instances/a/configuration"])
+
+    def test_gap_resyncs(self):
+        self.backend.fail = KVWatchGapException("cleared")
+        self.backend.write_remote("instances/b/configuration", '{"type": "jupyter"}')
+        _wait_for(lambda: self.under_test.get_key("instances/b/configuration") == dict(type="jupyter"))
+        self.assertTrue(self.under_test._mirror.serves("instances"))
+
+    def test_reads_go_to_the_store_while_out_of_sync(self):
+        self.backend.fail = TechnicalException("down")
+        with mock.patch("airfield.adapter.kv_mirror.config.KV_MIRROR_RECONNECT_SECONDS", 0.5):
+            self.backend.write_remote("instances/b/configuration", '{"type": "jupyter"}')
+            _wait_for(lambda: not self.under_test._mirror.serves("instances"))
+            self.assertEqual(self.under_test.get_key("instances/b/configuration"), dict(type="jupyter"))
+            self.assertEqual(self.backend.reads, 1)
+        _wait_for(lambda: self.under_test._mirror.serves("instances"))
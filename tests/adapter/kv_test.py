@@ -0,0 +1,252 @@
+import base64
+import json
+import os
+import unittest
+from unittest import mock
+from airfield.adapter import kv_codec
+from airfield.adapter.kv import KVAdapter, CHUNKS_KEY, CHUNKED_HEADER, set_op, check_op, delete_op, copy_raw_keys
+from airfield.util.exception import TechnicalException
+
+
+class _SequentialBackend:
+    """Stores the encoded strings like etcd v2 does, without transactions"""
+    def __init__(self):
+        self.data = dict()
+
+    def backend_key(self, key):
+        return key
+
+    def get_key(self, key):
+        return self.data.get(key)
+
+    def get_keys(self, key):
+        for sub_key, value in self.data.items():
+            if sub_key.startswith(key):
+                yield sub_key, value
+
+    def get_key_with_index(self, key):
+        return self.data.get(key), (1 if key in self.data else None)
+
+    def put_key(self, key, value):
+        self.data[key] = value
+
+    def put_key_cas(self, key, value, index):
+        if (1 if key in self.data else None) != index:
+            return False
+        self.data[key] = value
+        return True
+
+    def delete_key(self, key, recursive=False):
+        for sub_key in [sub_key for sub_key in self.data if sub_key == key or (recursive and sub_key.startswith(key))]:
+            del self.data[sub_key]
+
+    def apply_sequentially(self, ops):
+        if any(op["verb"] == "check" and (1 if op["key"] in self.data else None) != op["index"] for op in ops):
+            return False
+        for op in ops:
+            if op["verb"] == "set":
+                self.put_key(op["key"], op["value"])
+            elif op["verb"] == "delete":
+                self.delete_key(op["key"], op["recursive"])
+        return True
+
+
+class _RawBackend(_SequentialBackend):
+    """Stores the encoded strings like consul and etcd v3 do"""
+    def txn(self, ops):
+        return self.apply_sequentially(ops)
+
+
+_notebook = dict(name="note", paragraphs=[dict(text="%spark\nval df = spark.read.parquet(\"/data\")\ndf.show()",
+                                              results=dict(code="SUCCESS")) for _ in range(200)])
+
+
+class CopyRawKeysTest(unittest.TestCase):
+    def test_values_are_copied_unchanged(self):
+        source, target = _RawBackend(), _RawBackend()
+        source.data = {"instances/a/configuration": "Zxyz", "kv_chunks/notebooks/1/g/0": "abc", "notebooks/1": "C{}"}
+        target.data = {"notebooks/1": "old"}
+        self.assertEqual(copy_raw_keys(source, target), (2, 1))
+        self.assertEqual(target.data["notebooks/1"], "old")
+        self.assertEqual(copy_raw_keys(source, target, overwrite=True, batch_size=2), (3, 0))
+        self.assertEqual(target.data, source.data)
+
+    def test_batches_are_limited_by_operations_and_bytes(self):
+        source, target = _RawBackend(), _RawBackend()
+        source.data = {"small/{}".format(index): "x" for index in range(5)}
+        source.data.update({"medium/1": "x" * 600, "medium/2": "x" * 600, "large": "x" * 3000})
+        with mock.patch.object(target, "txn", wraps=target.txn) as txn:
+            self.assertEqual(copy_raw_keys(source, target, overwrite=True, batch_size=3, batch_bytes=2000), (8, 0))
+        self.assertEqual(target.data, source.data)
+        self.assertEqual([[op["key"] for op in call[0][0]] for call in txn.call_args_list],
+                         [["small/0", "small/1", "small/2"], ["small/3", "small/4", "medium/1"], ["medium/2"]])
+
+
+class KVAdapterWithoutTransactionsTest(unittest.TestCase):
+    @mock.patch("airfield.adapter.kv.logger")
+    def test_operations_are_applied_sequentially_with_a_warning(self, logger):
+        under_test = KVAdapter(_SequentialBackend())
+        self.assertIn("_SequentialBackend has no transactions", logger.warning.call_args[0][0])
+        self.assertTrue(under_test.txn([check_op("a", None), set_op("a", dict(x=1))]))
+        self.assertFalse(under_test.txn([check_op("a", None), set_op("a", dict(x=2))]))
+        self.assertEqual(under_test.get_key("a"), dict(x=1))
+
+
+@mock.patch("airfield.adapter.kv_codec.config.KV_COMPRESSION_THRESHOLD", 4096)
+class KVAdapterCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = _RawBackend()
+        self.under_test = KVAdapter(self.backend)
+
+    def test_small_values_are_plain(self):
+        self.under_test.put_key("small", dict(a=1))
+        self.assertEqual(self.backend.data["small"], json.dumps(dict(a=1)))
+        self.assertEqual(self.under_test.get_key("small"), dict(a=1))
+
+    def test_large_values_are_compressed(self):
+        self.under_test.put_key("notebooks/1", _notebook)
+        raw = self.backend.data["notebooks/1"]
+        self.assertTrue(raw.startswith(kv_codec.COMPRESSED_HEADER))
+        self.assertLess(len(raw) * 5, len(json.dumps(_notebook)))
+        self.assertEqual(self.under_test.get_key("notebooks/1"), _notebook)
+        self.assertEqual(list(self.under_test.get_keys("notebooks")), [("notebooks/1", _notebook)])
+
+    def test_plain_values_stay_readable(self):
+        self.backend.data["legacy"] = json.dumps(_notebook, indent=4)
+        self.assertEqual(self.under_test.get_key("legacy"), _notebook)
+        self.assertIsNone(self.under_test.get_key("missing"))
+
+    def test_incompressible_values_are_plain(self):
+        value = base64.b85encode(os.urandom(8192)).decode("ascii")
+        self.under_test.put_key("random", value)
+        self.assertEqual(self.backend.data["random"], json.dumps(value))
+
+    def test_compression_can_be_disabled(self):
+        with mock.patch("airfield.adapter.kv_codec.config.KV_COMPRESSION_THRESHOLD", 0):
+            self.under_test.put_key("notebooks/1", _notebook)
+        self.assertEqual(self.backend.data["notebooks/1"], json.dumps(_notebook))
+
+    def test_cas_is_encoded(self):
+        self.under_test.put_key_cas("notebooks/1", _notebook, None)
+        self.assertTrue(self.backend.data["notebooks/1"].startswith(kv_codec.COMPRESSED_HEADER))
+        self.assertEqual(self.under_test.get_key_with_index("notebooks/1"), (_notebook, 1))
+
+
+@mock.patch("airfield.adapter.kv.config.KV_CHUNK_SIZE", 1000)
+@mock.patch("airfield.adapter.kv_codec.config.KV_COMPRESSION_THRESHOLD", 0)
+class KVAdapterChunkTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = _RawBackend()
+        self.under_test = KVAdapter(self.backend)
+
+    def _chunk_keys(self):
+        return [key for key in self.backend.data if key.startswith(CHUNKS_KEY)]
+
+    def _chunk_keys_of(self, key):
+        """Returns the keys of the chunks referenced by the current manifest of the key"""
+        manifest = json.loads(self.backend.data[key][1:])
+        return [chunk_key for chunk_key in self._chunk_keys()
+                if chunk_key.startswith("{}/{}/{}/".format(CHUNKS_KEY, key, manifest["generation"]))]
+
+    def test_large_values_are_chunked(self):
+        self.under_test.put_key("notebooks/1", _notebook)
+        self.assertTrue(self.backend.data["notebooks/1"].startswith(CHUNKED_HEADER))
+        self.assertGreater(len(self._chunk_keys()), 1)
+        self.assertTrue(all(len(self.backend.data[key]) <= 1000 for key in self._chunk_keys()))
+        self.assertEqual(self.under_test.get_key("notebooks/1"), _notebook)
+        self.assertEqual(list(self.under_test.get_keys("notebooks")), [("notebooks/1", _notebook)])
+
+    def test_small_values_are_deleted_without_chunk_requests(self):
+        self.under_test.put_key("notebooks/1", dict(a=1))
+        with mock.patch.object(self.backend, "delete_key", wraps=self.backend.delete_key) as delete_key:
+            self.under_test.delete_key("notebooks/1")
+        delete_key.assert_called_once_with("notebooks/1", recursive=False)
+
+    def test_writes_do_not_read_the_previous_value(self):
+        self.under_test.put_key("notebooks/1", _notebook)
+        with mock.patch.object(self.backend, "get_key", wraps=self.backend.get_key) as get_key:
+            self.under_test.put_key("notebooks/1", dict(_notebook, name="other"))
+            self.assertTrue(self.under_test.put_key_cas("notebooks/1", dict(a=1), 1))
+            self.assertTrue(self.under_test.txn([set_op("notebooks/1", _notebook), delete_op("notebook_index/1")]))
+            self.under_test.delete_key("notebooks/1")
+        get_key.assert_not_called()
+
+    def test_garbage_collection_removes_replaced_chunks(self):
+        self.under_test.put_key("notebooks/1", _notebook)
+        self.under_test.put_key("notebooks/2", _notebook)
+        self.under_test.put_key("notebooks/1", dict(_notebook, name="other"))
+        self.under_test.put_key_cas("notebooks/2", dict(a=1), 1)
+        current_chunks = self._chunk_keys_of("notebooks/1")
+        self.assertEqual(self.under_test.collect_chunk_garbage(0), 2)
+        self.assertEqual(self._chunk_keys(), current_chunks)
+        self.assertEqual(self.under_test.get_key("notebooks/1")["name"], "other")
+        self.under_test.delete_key("notebooks/1")
+        self.assertEqual(self.under_test.collect_chunk_garbage(0), 1)
+        self.assertEqual(self._chunk_keys(), [])
+
+    def test_garbage_collection_keeps_recent_chunks(self):
+        self.under_test.put_key("notebooks/1", _notebook)
+        self.under_test.put_key("notebooks/1", dict(a=1))
+        self.assertEqual(self.under_test.collect_chunk_garbage(60), 0)
+        self.assertNotEqual(self._chunk_keys(), [])
+        self.assertEqual(self.under_test.collect_chunk_garbage(0), 1)
+        self.assertEqual(self._chunk_keys(), [])
+
+    def test_garbage_collection_of_chunks_without_creation_time(self):
+        self.backend.data["{}/notebooks/1/{}/0".format(CHUNKS_KEY, "0" * 32)] = "x"
+        self.assertEqual(self.under_test.collect_chunk_garbage(60), 1)
+        self.assertEqual(self._chunk_keys(), [])
+
+    def test_delete_removes_chunks(self):
+        self.under_test.put_key("notebooks/1", _notebook)
+        self.under_test.put_key("notebooks/2", _notebook)
+        self.under_test.put_key("notebooks/10", _notebook)
+        self.under_test.delete_key("notebooks/1")
+        self.assertIsNone(self.under_test.get_key("notebooks/1"))
+        self.assertEqual(self.under_test.get_key("notebooks/2"), _notebook)
+        self.assertEqual(self.under_test.get_key("notebooks/10"), _notebook)
+        self.under_test.delete_key("notebooks", recursive=True)
+        self.assertEqual(self.backend.data, dict())
+
+    def test_corrupt_chunks_are_detected(self):
+        self.under_test.put_key("notebooks/1", _notebook)
+        first_chunk = sorted(self._chunk_keys())[0]
+        self.backend.data[first_chunk] = "x" + self.backend.data[first_chunk][1:]
+        with self.assertRaises(TechnicalException):
+            self.under_test.get_key("notebooks/1")
+        del self.backend.data[first_chunk]
+        with self.assertRaises(TechnicalException):
+            self.under_test.get_key("notebooks/1")
+
+    def test_failed_cas_removes_new_chunks(self):
+        self.under_test.put_key_cas("notebooks/1", _notebook, None)
+        chunks = self._chunk_keys()
+        self.assertFalse(self.under_test.put_key_cas("notebooks/1", dict(_notebook, name="other"), None))
+        self.assertEqual(self._chunk_keys(), chunks)
+        self.assertTrue(self.under_test.put_key_cas("notebooks/1", dict(_notebook, name="other"), 1))
+        self.assertTrue(set(chunks).isdisjoint(self._chunk_keys_of("notebooks/1")))
+        self.assertEqual(self.under_test.get_key_with_index("notebooks/1")[0]["name"], "other")
+
+    def test_transactions_chunk_large_values(self):
+        self.under_test.put_key("notebooks/1", _notebook)
+        previous_chunks = self._chunk_keys()
+        self.assertTrue(self.under_test.txn([check_op("notebooks/1", 1), set_op("notebooks/1", dict(_notebook, name="other")),
+                                             set_op("notebook_index/1", dict(name="other"))]))
+        self.assertTrue(set(previous_chunks).isdisjoint(self._chunk_keys_of("notebooks/1")))
+        self.assertEqual(self.under_test.get_key("notebooks/1")["name"], "other")
+        self.assertTrue(self.under_test.txn([delete_op("notebooks/1"), delete_op("notebook_index/1")]))
+        self.under_test.collect_chunk_garbage(0)
+        self.assertEqual(self.backend.data, dict())
+
+    def test_transactions_chunk_values_beyond_the_request_limit(self):
+        value = "x" * 900
+        with mock.patch("airfield.adapter.kv.TXN_MAX_BYTES", 2000), \
+                mock.patch("airfield.adapter.kv_codec.config.KV_COMPRESSION_THRESHOLD", 4096):
+            self.assertTrue(self.under_test.txn([set_op("a", value), set_op("b", value), delete_op("c")]))
+        self.assertFalse(self.backend.data["a"].startswith(CHUNKED_HEADER))
+        self.assertTrue(self.backend.data["b"].startswith(CHUNKED_HEADER))
+        self.assertEqual((self.under_test.get_key("a"), self.under_test.get_key("b")), (value, value))
+
+    def test_failed_transaction_removes_new_chunks(self):
+        self.assertFalse(self.under_test.txn([check_op("notebooks/1", 1), set_op("notebooks/1", _notebook)]))
+        self.assertEqual(self.backend.data, dict())
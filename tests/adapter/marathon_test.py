@@ -0,0 +1,76 @@
+import unittest
+from unittest import mock
+import requests
+from airfield.adapter.marathon import MarathonAdapter, InstanceState
+from airfield.settings import config
+from airfield.util import logging
+
+
+def _app(app_id, healthy=0, running=0, unhealthy=0, staged=0, deployments=None):
+    return dict(id=app_id, tasksHealthy=healthy, tasksRunning=running, tasksUnhealthy=unhealthy, tasksStaged=staged,
+                deployments=deployments or [])
+
+
+def _response(status_code, data=None):
+    response = mock.MagicMock()
+    response.ok = status_code < 400
+    response.status_code = status_code
+    response.json.return_value = data
+    return response
+
+
+class MarathonAdapterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        logging.silence()
+        with mock.patch("airfield.adapter.marathon.retrieve_auth", return_value=("http://marathon", None)):
+            cls.under_test = MarathonAdapter()
+
+    def test_get_instance_statuses(self):
+        group = dict(id="/airfield-zeppelin", apps=[
+            _app("/airfield-zeppelin/a", healthy=1, running=1),
+            _app("/airfield-zeppelin/b"),
+            _app("/airfield-zeppelin/c", deployments=[dict(id="1")]),
+        ], groups=[dict(id="/airfield-zeppelin/sub", apps=[_app("/airfield-zeppelin/sub/d", staged=1)])])
+        with mock.patch.object(self.under_test._session, "request", return_value=_response(200, group)) as request:
+            statuses = self.under_test.get_instance_statuses(["airfield-zeppelin"])
+        self.assertEqual(request.call_count, 1)
+        self.assertIn("/groups/airfield-zeppelin?", request.call_args[0][1])
+        self.assertEqual(statuses, {
+            "airfield-zeppelin/a": InstanceState.HEALTHY,
+            "airfield-zeppelin/b": InstanceState.STOPPED,
+            "airfield-zeppelin/c": InstanceState.DEPLOYING,
+            "airfield-zeppelin/sub/d": InstanceState.STAGING,
+        })
+
+    def test_get_instance_statuses_of_absolute_group(self):
+        group = dict(id="/team", apps=[_app("/team/a", healthy=1, running=1)], groups=[])
+        with mock.patch.object(self.under_test._session, "request", return_value=_response(200, group)) as request:
+            statuses = self.under_test.get_instance_statuses(["/team"])
+        self.assertIn("/groups/team?", request.call_args[0][1])
+        self.assertEqual(statuses, {"team/a": InstanceState.HEALTHY})
+
+    def test_get_instance_statuses_group_errors(self):
+        responses = [_response(404), _response(401), _response(500)]
+        with mock.patch.object(self.under_test._session, "request", side_effect=responses):
+            statuses = self.under_test.get_instance_statuses(["missing", "forbidden", "broken"])
+        self.assertEqual(statuses, {
+            "forbidden": InstanceState.UNAUTHORIZED,
+            "broken": InstanceState.CONNECTION_ERROR,
+        })
+
+    def test_requests_use_timeouts(self):
+        with mock.patch.object(self.under_test._session, "request", return_value=_response(200, dict(app=_app("a")))) as request:
+            self.under_test.get_instance_status("airfield-zeppelin/a")
+        self.assertEqual(request.call_args[1]["timeout"], (config.MARATHON_CONNECT_TIMEOUT, config.MARATHON_READ_TIMEOUT))
+
+    def test_unreachable_marathon(self):
+        with mock.patch.object(self.under_test._session, "request", side_effect=requests.exceptions.ConnectTimeout()):
+            self.assertEqual(self.under_test.get_instance_status("airfield-zeppelin/a"), InstanceState.CONNECTION_ERROR)
+            self.assertEqual(self.under_test.get_instance_ip_address_and_port("airfield-zeppelin/a"), (None, None))
+            self.assertFalse(self.under_test.stop_instance("airfield-zeppelin/a"))
+
+    def test_session_is_pooled(self):
+        adapter = self.under_test._session.get_adapter("https://leader.mesos")
+        self.assertEqual(adapter._pool_maxsize, config.MARATHON_POOL_SIZE)
+        self.assertEqual(adapter.max_retries.method_whitelist, frozenset(["GET"]))
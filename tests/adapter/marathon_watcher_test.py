@@ -0,0 +1,217 @@
+import json
+import queue
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from airfield.adapter.marathon import MarathonAdapter, InstanceState
+from airfield.adapter.marathon_watcher import MarathonStateWatcher, parse_event_stream
+from airfield.util import logging
+
+
+def _app(app_id, healthy=0, host="10.0.0.1", port=31000):
+    tasks = [dict(host=host, ports=[port])] if healthy else []
+    return dict(id="/" + app_id, tasksHealthy=healthy, tasksRunning=healthy, tasksUnhealthy=0, tasksStaged=0,
+                deployments=[], tasks=tasks)
+
+
+class _FakeMarathon:
+    """Serves the marathon group/app endpoints from a dict and streams queued events"""
+    def __init__(self):
+        self.apps = dict()
+        self.events = queue.Queue()
+        self.requests = list()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                path = self.path.split("?")[0][len("/service/marathon/v2/"):]
+                fake.requests.append(path)
+                if path == "events":
+                    return self._stream_events()
+                if path.startswith("groups/"):
+                    group_id = path[len("groups/"):]
+                    apps = [app for app_id, app in fake.apps.items() if app_id.startswith(group_id + "/")]
+                    return self._respond(200, dict(id="/" + group_id, apps=apps, groups=[]))
+                app = fake.apps.get(path[len("apps/"):])
+                if app is None:
+                    return self._respond(404, dict(message="not found"))
+                return self._respond(200, dict(app=app))
+
+            def do_PATCH(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._respond(200, dict(deploymentId="1"))
+
+            def _respond(self, status, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream_events(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self._write_chunk(b"event: event_stream_attached\ndata: {}\n\n")
+                while True:
+                    event = fake.events.get()
+                    if event is None:
+                        return
+                    event_type, data = event
+                    self._write_chunk("event: {}\ndata: {}\n\n".format(event_type, json.dumps(data)).encode("utf-8"))
+
+            def _write_chunk(self, data):
+                # marathon streams events with chunked transfer encoding, each event is delivered on its own
+                self.wfile.write("{:x}\r\n".format(len(data)).encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def close(self):
+        self.events.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class MarathonStateWatcherTest(unittest.TestCase):
+    def setUp(self):
+        logging.silence()
+        self.marathon = _FakeMarathon()
+        self.marathon.apps["airfield-zeppelin/a"] = _app("airfield-zeppelin/a", healthy=1)
+        self.marathon.apps["other/b"] = _app("other/b", healthy=1)
+        patches = [
+            mock.patch("airfield.adapter.marathon.retrieve_auth", return_value=(self.marathon.url, None)),
+            mock.patch("airfield.adapter.marathon.config.MARATHON_WATCHER_ENABLED", True),
+            mock.patch("airfield.adapter.marathon.config.DCOS_GROUPS_MAPPING", dict()),
+            mock.patch("airfield.adapter.marathon_watcher.config.MARATHON_WATCHER_RECONNECT_SECONDS", 0.01),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.under_test = MarathonAdapter()
+        self.assertTrue(_wait_for(lambda: self.under_test._watcher.synced))
+
+    def tearDown(self):
+        self.under_test._watcher.stop()
+        self.marathon.close()
+
+    def test_reads_are_served_from_memory(self):
+        self.marathon.requests.clear()
+        self.assertEqual(self.under_test.get_instance_status("airfield-zeppelin/a"), InstanceState.HEALTHY)
+        self.assertEqual(self.under_test.get_instance_status("airfield-zeppelin/missing"), InstanceState.NOT_FOUND)
+        self.assertEqual(self.under_test.get_instance_ip_address_and_port("airfield-zeppelin/a"), ("10.0.0.1", 31000))
+        self.assertEqual(self.under_test.get_instance_statuses(["airfield-zeppelin"]),
+                         {"airfield-zeppelin/a": InstanceState.HEALTHY})
+        self.assertEqual(self.marathon.requests, [])
+
+    def test_events_refresh_apps(self):
+        self.marathon.apps["airfield-zeppelin/a"] = _app("airfield-zeppelin/a", healthy=0)
+        self.marathon.events.put(("status_update_event", dict(appId="/airfield-zeppelin/a", taskStatus="TASK_KILLED")))
+        self.assertTrue(_wait_for(lambda: self.under_test.get_instance_status("airfield-zeppelin/a") == InstanceState.STOPPED))
+        self.assertEqual(self.under_test.get_instance_ip_address_and_port("airfield-zeppelin/a"), (None, None))
+
+        self.marathon.apps["airfield-zeppelin/c"] = _app("airfield-zeppelin/c", healthy=1, host="10.0.0.2")
+        plan = dict(steps=[dict(actions=[dict(action="StartApplication", app="/airfield-zeppelin/c")])])
+        self.marathon.events.put(("deployment_success", dict(plan=plan)))
+        self.assertTrue(_wait_for(lambda: self.under_test.get_instance_status("airfield-zeppelin/c") == InstanceState.HEALTHY))
+
+    def test_ignores_foreign_apps(self):
+        self.marathon.requests.clear()
+        self.marathon.events.put(("status_update_event", dict(appId="/other/b", taskStatus="TASK_KILLED")))
+        self.marathon.events.put(("status_update_event", dict(appId="/airfield-zeppelin/a", taskStatus="TASK_RUNNING")))
+        self.assertTrue(_wait_for(lambda: "apps/airfield-zeppelin/a" in self.marathon.requests))
+        self.assertNotIn("apps/other/b", self.marathon.requests)
+
+    def test_state_listeners_see_changes(self):
+        changes = list()
+        self.assertTrue(self.under_test.add_state_listener(lambda app_id, state: changes.append((app_id, state))))
+        self.marathon.apps["airfield-zeppelin/a"] = _app("airfield-zeppelin/a", healthy=0)
+        self.marathon.events.put(("status_update_event", dict(appId="/airfield-zeppelin/a", taskStatus="TASK_KILLED")))
+        self.assertTrue(_wait_for(lambda: len(changes) == 1))
+        self.under_test._watcher.refresh("airfield-zeppelin/a")
+        self.marathon.apps["airfield-zeppelin/a"] = _app("airfield-zeppelin/a", healthy=1)
+        self.marathon.events.put(("health_status_changed_event", dict(appId="/airfield-zeppelin/a", alive=True)))
+        self.assertTrue(_wait_for(lambda: len(changes) == 2))
+        self.assertEqual(changes, [("airfield-zeppelin/a", InstanceState.STOPPED), ("airfield-zeppelin/a", InstanceState.HEALTHY)])
+
+    def test_writes_refresh_immediately(self):
+        self.marathon.apps["airfield-zeppelin/a"] = _app("airfield-zeppelin/a", healthy=0)
+        self.under_test.stop_instance("airfield-zeppelin/a")
+        self.assertEqual(self.under_test.get_instance_status("airfield-zeppelin/a"), InstanceState.STOPPED)
+
+
+class MarathonStateWatcherOrderingTest(unittest.TestCase):
+    def setUp(self):
+        logging.silence()
+        self.adapter = mock.MagicMock()
+        self.under_test = MarathonStateWatcher(self.adapter, ["airfield-zeppelin"])
+        self.under_test._stream_attached = True
+
+    def test_resync_keeps_apps_refreshed_meanwhile(self):
+        stale = [_app("airfield-zeppelin/a", healthy=0), _app("airfield-zeppelin/b", healthy=1)]
+
+        def get_group_apps(group_id):
+            # An event refreshes the apps while the resync is waiting for marathon
+            self.under_test.refresh("airfield-zeppelin/a")
+            self.under_test.refresh("airfield-zeppelin/b")
+            return stale
+        self.adapter.get_app.side_effect = lambda app_id: _app(app_id, healthy=1) if app_id.endswith("a") else None
+        self.adapter.get_group_apps.side_effect = get_group_apps
+        self.assertTrue(self.under_test.resync())
+        self.assertEqual(self.under_test.get_app("airfield-zeppelin/a")["tasksHealthy"], 1)
+        self.assertIsNone(self.under_test.get_app("airfield-zeppelin/b"))
+
+    def test_refresh_older_than_resync_is_dropped(self):
+        def get_app(app_id):
+            # The resync starts and finishes while the refresh is waiting for marathon
+            self.assertTrue(self.under_test.resync())
+            return _app(app_id, healthy=0)
+        self.adapter.get_app.side_effect = get_app
+        self.adapter.get_group_apps.return_value = [_app("airfield-zeppelin/a", healthy=1)]
+        self.under_test.refresh("airfield-zeppelin/a")
+        self.assertEqual(self.under_test.get_app("airfield-zeppelin/a")["tasksHealthy"], 1)
+
+    def test_resync_of_previous_attachment_does_not_sync(self):
+        def get_group_apps(group_id):
+            # The stream is detached and attached again while the resync is waiting for marathon
+            self.under_test._attachment += 1
+            return list()
+        self.adapter.get_group_apps.side_effect = get_group_apps
+        self.assertTrue(self.under_test.resync())
+        self.assertFalse(self.under_test.synced)
+        self.adapter.get_group_apps.side_effect = None
+        self.adapter.get_group_apps.return_value = list()
+        self.assertTrue(self.under_test.resync())
+        self.assertTrue(self.under_test.synced)
+
+
+class ParseEventStreamTest(unittest.TestCase):
+    def test_parse_event_stream(self):
+        lines = ["event: status_update_event", 'data: {"appId": "/a"}', "", ": comment", "", "event: broken",
+                 "data: {", "", "data: {\"x\": 1}", ""]
+        self.assertEqual(list(parse_event_stream(lines)),
+                         [("status_update_event", {"appId": "/a"}), (None, {"x": 1})])
@@ -0,0 +1,81 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+from urllib3.exceptions import EmptyPoolError
+from airfield.adapter.proxy_pool import ProxyPoolRegistry
+
+
+class ProxyPoolRegistryTest(unittest.TestCase):
+    def test_reuses_session_per_host(self):
+        under_test = ProxyPoolRegistry()
+        session = under_test.session("a", "10.0.0.1:8080")
+        self.assertIs(under_test.session("a", "10.0.0.1:8080"), session)
+        self.assertIsNot(under_test.session("b", "10.0.0.2:8080"), session)
+
+    def test_drops_pool_when_task_moves(self):
+        under_test = ProxyPoolRegistry()
+        session = under_test.session("a", "10.0.0.1:8080")
+        with mock.patch.object(session, "close") as close:
+            moved = under_test.session("a", "10.0.0.3:8080")
+            close.assert_called_once()
+        self.assertIsNot(moved, session)
+        self.assertIsNot(under_test.session("a", "10.0.0.1:8080"), session)
+
+    @mock.patch("airfield.adapter.proxy_pool.config.PROXY_MAX_UPSTREAM_POOLS", 2)
+    def test_limits_number_of_pools(self):
+        under_test = ProxyPoolRegistry()
+        first = under_test.session("a", "10.0.0.1:8080")
+        under_test.session("b", "10.0.0.2:8080")
+        under_test.session("c", "10.0.0.3:8080")
+        self.assertEqual(len(under_test._pools), 2)
+        self.assertIsNot(under_test.session("a", "10.0.0.1:8080"), first)
+
+    @mock.patch("airfield.adapter.proxy_pool.time.monotonic")
+    def test_closes_idle_pools(self, monotonic):
+        monotonic.return_value = 0
+        under_test = ProxyPoolRegistry()
+        idle = under_test.session("a", "10.0.0.1:8080")
+        monotonic.return_value = 10000
+        under_test.session("b", "10.0.0.2:8080")
+        self.assertNotIn("10.0.0.1:8080", under_test._pools)
+        self.assertIsNot(under_test.session("a", "10.0.0.1:8080"), idle)
+
+    def test_drop_instance(self):
+        under_test = ProxyPoolRegistry()
+        session = under_test.session("a", "10.0.0.1:8080")
+        under_test.drop_instance("a")
+        self.assertIsNot(under_test.session("a", "10.0.0.1:8080"), session)
+
+    def test_does_not_share_upstream_cookies(self):
+        received_cookies = list()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                received_cookies.append(self.headers.get("Cookie"))
+                self.send_response(200)
+                self.send_header("Set-Cookie", "JSESSIONID=alice-session; Path=/")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        host = "127.0.0.1:{}".format(server.server_port)
+        session = ProxyPoolRegistry().session("a", host)
+        session.get("http://{}/".format(host), headers=dict(Cookie="x=alice"))
+        session.get("http://{}/".format(host))
+        self.assertEqual(received_cookies, ["x=alice", None])
+
+    @mock.patch("airfield.adapter.proxy_pool.config.PROXY_UPSTREAM_POOL_SIZE", 1)
+    @mock.patch("airfield.adapter.proxy_pool.config.PROXY_UPSTREAM_POOL_TIMEOUT_SECONDS", 0.01)
+    def test_limits_connections_per_upstream(self):
+        session = ProxyPoolRegistry().session("a", "10.0.0.1:8080")
+        pool = session.get_adapter("http://10.0.0.1:8080/").get_connection("http://10.0.0.1:8080/")
+        pool._get_conn()
+        with self.assertRaises(EmptyPoolError):
+            pool._get_conn()
@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+from unittest import mock
+from airfield.adapter.kv import KVAdapter
+from airfield.adapter.sqlite import SqliteAdapter
+from airfield.storage.instance import InstanceStore
+
+
+def _increment(path, count):
+    backend = SqliteAdapter(path)
+    for _ in range(count):
+        while True:
+            value, index = backend.get_key_with_index("counter")
+            if backend.put_key_cas("counter", str(int(value or 0) + 1), index):
+                break
+
+
+def _configuration(group=None, delete_at=None):
+    return dict(type="zeppelin", admin=dict(group=group, admins=list()), delete_at=delete_at)
+
+
+class SqliteAdapterTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "airfield.db")
+        self.backend = SqliteAdapter(self.path)
+        self.instance_store = InstanceStore(KVAdapter(self.backend))
+        self.instance_store.insert_instance("a", _configuration("analytics", 1000), dict(created_by="alice"))
+        self.instance_store.insert_instance("b", _configuration("analytics"), dict(created_by="bob"))
+        self.instance_store.insert_instance("c", _configuration(None, 3000), dict(created_by="alice"))
+
+    def test_instances_are_filtered_with_secondary_indexes(self):
+        self.assertEqual(sorted(self.backend.find_instance_ids("instances", created_by="alice")), ["a", "c"])
+        with mock.patch.object(self.backend, "get_keys", wraps=self.backend.get_keys) as get_keys:
+            self.assertEqual(list(self.instance_store.find_instances(created_by="alice", group="analytics")), ["a"])
+            self.assertEqual(sorted(self.instance_store.find_instances(delete_before=5000)), ["a", "c"])
+            self.assertEqual(self.instance_store.find_instances(delete_before=500), dict())
+        # Only the candidates were read
+        self.assertEqual(sorted(call[0][0] for call in get_keys.call_args_list), ["instances/a", "instances/a", "instances/c"])
+
+    def test_indexes_follow_changes(self):
+        self.instance_store.update_instance_configuration("b", _configuration("analytics", 2000))
+        self.instance_store.delete_instance("a")
+        self.assertEqual(list(self.instance_store.find_instances(delete_before=2500)), ["b"])
+        self.assertEqual(list(self.instance_store.find_instances(deleted=True, created_by="alice")), ["a"])
+        self.backend.delete_key("deleted_instances", recursive=True)
+        self.assertEqual(self.backend.find_instance_ids("deleted_instances"), [])
+
+    def test_unindexable_values_are_always_candidates(self):
+        self.backend.put_key("instances/b/metadata", "C{}")
+        self.assertEqual(sorted(self.backend.find_instance_ids("instances", created_by="alice")), ["a", "b", "c"])
+
+    def test_compare_and_swap_across_processes(self):
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=_increment, args=(self.path, 50)) for _ in range(2)]
+        for process in processes:
+            process.start()
+        _increment(self.path, 50)
+        for process in processes:
+            process.join()
+        self.assertEqual(self.backend.get_key("counter"), "150")
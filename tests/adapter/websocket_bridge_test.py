@@ -0,0 +1,103 @@
+import unittest
+from unittest import mock
+import gevent
+from gevent.queue import Queue
+from websocket import ABNF
+from airfield.adapter.websocket_bridge import WebsocketBridge
+from airfield.util import logging
+
+
+class _ClientMock:
+    OPCODE_PING = 0x09
+
+    def __init__(self):
+        self.incoming = Queue()
+        self.sent = list()
+        self.pings = 0
+        self.closed = False
+
+    def receive(self):
+        return self.incoming.get()
+
+    def send(self, message, binary=None):
+        self.sent.append(message)
+
+    def send_frame(self, message, opcode):
+        self.pings += 1
+
+    def close(self):
+        self.closed = True
+
+
+class _UpstreamMock:
+    def __init__(self, answer_pings=True):
+        self.incoming = Queue()
+        self.sent = list()
+        self.closed = False
+        self._answer_pings = answer_pings
+
+    def recv_data_frame(self, control_frame=False):
+        return self.incoming.get()
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def send_binary(self, message):
+        self.sent.append(message)
+
+    def ping(self):
+        if self._answer_pings:
+            self.incoming.put((ABNF.OPCODE_PONG, ABNF(opcode=ABNF.OPCODE_PONG, data=b"")))
+
+    def close(self):
+        self.closed = True
+
+
+def _frame(opcode, data):
+    return opcode, ABNF(opcode=opcode, data=data)
+
+
+class WebsocketBridgeTest(unittest.TestCase):
+    def setUp(self):
+        logging.silence()
+        self.client = _ClientMock()
+        self.upstream = _UpstreamMock()
+
+    def test_relays_both_directions_until_client_closes(self):
+        bridge = gevent.spawn(WebsocketBridge("abc", self.client, self.upstream).run)
+        self.client.incoming.put('{"msg": 1}')
+        self.client.incoming.put(b"\x00\x01")
+        self.upstream.incoming.put(_frame(ABNF.OPCODE_TEXT, b'{"reply": 1}'))
+        self.upstream.incoming.put(_frame(ABNF.OPCODE_BINARY, b"\x02"))
+        gevent.sleep(0.01)
+        self.client.incoming.put(None)
+        bridge.join(timeout=1)
+        self.assertTrue(bridge.dead)
+        self.assertEqual(self.upstream.sent, ['{"msg": 1}', b"\x00\x01"])
+        self.assertEqual(self.client.sent, ['{"reply": 1}', b"\x02"])
+        self.assertTrue(self.upstream.closed)
+        self.assertTrue(self.client.closed)
+
+    def test_upstream_close_ends_bridge(self):
+        bridge = gevent.spawn(WebsocketBridge("abc", self.client, self.upstream).run)
+        self.upstream.incoming.put(_frame(ABNF.OPCODE_CLOSE, b""))
+        bridge.join(timeout=1)
+        self.assertTrue(bridge.dead)
+        self.assertTrue(self.client.closed)
+
+    @mock.patch("airfield.adapter.websocket_bridge.config.WEBSOCKET_PING_INTERVAL_SECONDS", 0.01)
+    @mock.patch("airfield.adapter.websocket_bridge.config.WEBSOCKET_IDLE_TIMEOUT_SECONDS", 0.05)
+    def test_idle_bridge_is_closed(self):
+        bridge = gevent.spawn(WebsocketBridge("abc", self.client, self.upstream).run)
+        bridge.join(timeout=1)
+        self.assertTrue(bridge.dead)
+        self.assertTrue(self.client.pings > 0)
+        self.assertTrue(self.upstream.closed)
+
+    @mock.patch("airfield.adapter.websocket_bridge.config.WEBSOCKET_PING_INTERVAL_SECONDS", 0.01)
+    def test_unresponsive_upstream_is_closed(self):
+        upstream = _UpstreamMock(answer_pings=False)
+        bridge = gevent.spawn(WebsocketBridge("abc", self.client, upstream).run)
+        bridge.join(timeout=1)
+        self.assertTrue(bridge.dead)
+        self.assertTrue(upstream.closed)
@@ -0,0 +1,31 @@
+import unittest
+from unittest import mock
+from airfield.adapter.zeppelin import ZeppelinAdapter, ZeppelinException
+
+
+def _response(status_code, body=None):
+    response = mock.MagicMock(status_code=status_code, ok=status_code < 400, text="error")
+    response.json.return_value = dict(body=body)
+    return response
+
+
+class ZeppelinAdapterTest(unittest.TestCase):
+    def setUp(self):
+        self.under_test = ZeppelinAdapter("http://zeppelin.local")
+        self.under_test.session = mock.MagicMock()
+        self.under_test.session.post.return_value = _response(200)
+
+    def test_login_again_after_expired_session(self):
+        self.under_test.login("admin", "secret")
+        self.under_test.session.request.side_effect = [_response(403), _response(200, [dict(id="a", name="A")])]
+        self.assertEqual(self.under_test.list_notebooks(), [dict(id="a", name="A")])
+        self.assertEqual(self.under_test.session.post.call_count, 2)
+        self.under_test.session.post.assert_called_with("http://zeppelin.local/api/login",
+                                                        data={"userName": "admin", "password": "secret"})
+
+    def test_no_login_without_credentials(self):
+        self.under_test.session.request.return_value = _response(401)
+        with self.assertRaises(ZeppelinException):
+            self.under_test.list_notebooks()
+        self.under_test.session.post.assert_not_called()
+        self.assertEqual(self.under_test.session.request.call_count, 1)
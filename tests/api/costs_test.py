@@ -0,0 +1,126 @@
+import random
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from airfield.adapter.kv import KVAdapter
+from airfield.adapter.marathon import MarathonAdapter
+from airfield.service.cost_report import CostReportService
+from airfield.storage.instance import InstanceStore
+from airfield.util import dependency_injection as di
+from airfield.util import logging
+from tests.mocks.kv import InMemoryKVAdapter
+from tests.mocks.marathon_adapter import MarathonAdapterMock
+
+
+def _ts(*args):
+    return datetime(*args).timestamp()
+
+
+def _store_instance(kv, instance_id, user, group, runtimes, deleted=False):
+    base_key = "deleted_instances" if deleted else "instances"
+    kv.put_key("{}/{}/configuration".format(base_key, instance_id), dict(type="zeppelin", admin=dict(group=group)))
+    kv.put_key("{}/{}/metadata".format(base_key, instance_id), dict(created_by=user))
+    closed = [runtime for runtime in runtimes if runtime["stopped_at"] is not None]
+    open_runtime = runtimes[-1] if runtimes and runtimes[-1]["stopped_at"] is None else None
+    kv.put_key("{}/{}/runtime_head".format(base_key, instance_id), dict(next_seq=len(closed), open=open_runtime))
+    for seq, runtime in enumerate(closed):
+        kv.put_key("runtime_log/{}/{:010d}".format(instance_id, seq), runtime)
+
+
+def _runtime(started_at, stopped_at, cores=1, memory=1024):
+    return dict(started_at=started_at, stopped_at=stopped_at, cores=cores, memory=memory)
+
+
+@mock.patch("airfield.service.cost_report.config.COST_CORE_PER_MINUTE", 1.0)
+@mock.patch("airfield.service.cost_report.config.COST_GB_PER_MINUTE", 0.0)
+class CostReportApiTest(unittest.TestCase):
+    def setUp(self):
+        logging.silence()
+        di.test_setup_clear_registry()
+        self.kv_mock = InMemoryKVAdapter()
+        di.register(MarathonAdapter, MarathonAdapterMock())
+        di.register(KVAdapter, self.kv_mock)
+        from airfield.app import create_app
+        self.app = create_app()
+        self.app.testing = True
+        self.client = self.app.test_client()
+        # alice: one hour on the 1st, one hour spanning midnight into the 2nd, bob: deleted instance with 2 cores
+        _store_instance(self.kv_mock, "a1", "alice", "team-a", [
+            _runtime(_ts(2020, 6, 1, 10), _ts(2020, 6, 1, 11)),
+            _runtime(_ts(2020, 6, 1, 23, 30), _ts(2020, 6, 2, 0, 30)),
+        ])
+        _store_instance(self.kv_mock, "b1", "bob", "team-b", [
+            _runtime(_ts(2020, 5, 31, 23), _ts(2020, 6, 1, 1), cores=2),
+        ], deleted=True)
+
+    def tearDown(self):
+        di.test_setup_clear_registry()
+
+    def test_report_by_user(self):
+        response = self.client.get("/api/costs/report?start=2020-06-01&end=2020-06-03&group_by=user")
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["columns"], ["user"])
+        self.assertEqual([(row["user"], row["running_time_seconds"], row["cost"]) for row in data["rows"]],
+                         [("alice", 7200.0, 120.0), ("bob", 3600.0, 120.0)])
+        self.assertEqual(data["total_cost"], 240.0)
+
+    def test_report_by_group_and_day(self):
+        response = self.client.get("/api/costs/report?start=2020-06-01&end=2020-06-03&group_by=group,day")
+        rows = [(row["group"], row["day"], row["core_minutes"]) for row in response.get_json()["rows"]]
+        self.assertEqual(rows, [("team-a", "2020-06-01", 90.0), ("team-a", "2020-06-02", 30.0),
+                                ("team-b", "2020-06-01", 120.0)])
+
+    def test_report_by_week(self):
+        response = self.client.get("/api/costs/report?start=2020-05-30&end=2020-06-10&group_by=week")
+        rows = [(row["week"], row["core_minutes"]) for row in response.get_json()["rows"]]
+        # 2020-05-25 and 2020-06-01 are mondays
+        self.assertEqual(rows, [("2020-05-25", 120.0), ("2020-06-01", 240.0)])
+
+    def test_open_runtime_counts_until_now(self):
+        _store_instance(self.kv_mock, "c1", "carol", None, [_runtime(_ts(2020, 6, 2, 12), None)])
+        report = di.get(CostReportService).create_report(datetime(2020, 6, 2), datetime(2020, 6, 3), ["user"],
+                                                         now=_ts(2020, 6, 2, 13))
+        self.assertEqual({row["user"]: row["core_minutes"] for row in report["rows"]}, {"alice": 30.0, "carol": 60.0})
+
+    def test_csv(self):
+        response = self.client.get("/api/costs/report?start=2020-06-01&end=2020-06-03&group_by=user&format=csv")
+        self.assertEqual(response.mimetype, "text/csv")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], "user,core_minutes,gb_minutes,running_time_seconds,cost")
+        self.assertEqual(lines[1], "alice,120.0,120.0,7200.0,120.0")
+        self.assertEqual(len(lines), 3)
+
+    def test_dates_with_offset(self):
+        start = datetime(2020, 6, 1).astimezone().isoformat()
+        end = datetime(2020, 6, 3).astimezone(timezone(timedelta(hours=2))).isoformat()
+        response = self.client.get("/api/costs/report", query_string=dict(start=start, end=end, group_by="user"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["total_cost"], 240.0)
+        # The default end of the window is a naive datetime
+        self.assertEqual(self.client.get("/api/costs/report", query_string=dict(start="2020-06-01T00:00:00+02:00")).status_code, 200)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get("/api/costs/report?group_by=day,week").status_code, 400)
+        self.assertEqual(self.client.get("/api/costs/report?group_by=foo").status_code, 400)
+        self.assertEqual(self.client.get("/api/costs/report?start=yesterday").status_code, 400)
+        self.assertEqual(self.client.get("/api/costs/report?start=2020-06-02&end=2020-06-01").status_code, 400)
+
+    def test_matches_per_runtime_calculation(self):
+        random.seed(42)
+        start, end = datetime(2020, 6, 3), datetime(2020, 6, 20)
+        expected = dict()
+        for index in range(200):
+            user = "user{}".format(index % 7)
+            runtimes = list()
+            for _ in range(10):
+                started_at = _ts(2020, 6, 1) + random.uniform(0, 20 * 86400)
+                runtime = _runtime(started_at, started_at + random.uniform(0, 3 * 86400), cores=random.randint(1, 8))
+                runtimes.append(runtime)
+                seconds = max(0.0, min(runtime["stopped_at"], end.timestamp()) - max(started_at, start.timestamp()))
+                expected[user] = expected.get(user, 0.0) + seconds * runtime["cores"] / 60
+            _store_instance(self.kv_mock, "r{}".format(index), user, None, runtimes)
+        report = di.get(CostReportService).create_report(start, end, ["user"])
+        for row in report["rows"]:
+            if row["user"] in expected:
+                self.assertAlmostEqual(row["core_minutes"], expected[row["user"]], places=3)
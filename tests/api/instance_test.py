@@ -73,6 +73,70 @@ class InstanceApiTest(unittest.TestCase):
         self.assertEqual("foobar", instance["details"]["comment"])
         self.assertEqual("2000-01-01T00:00:00", instance["details"]["delete_at"])
 
+    def test_get_instances_fetches_status_per_group(self):
+        self.marathon_adapter_mock.value_get_instance_status(InstanceState.HEALTHY)
+        for _ in range(3):
+            self.client.post("/api/instance", json=dict(configuration=dict()))
+        data = self.client.get("/api/instance").get_json()["instances"]
+        self.assertEqual(len(data), 3)
+        self.assertTrue(all(instance["status"] == "HEALTHY" for instance in data))
+        self.assertEqual(self.marathon_adapter_mock.value_get_instance_statuses(), [["airfield-zeppelin"]])
+
+    @mock.patch("airfield.service.instance.config.DCOS_GROUPS_MAPPING", dict(team="/team"))
+    def test_get_instances_in_absolute_group(self):
+        self.marathon_adapter_mock.value_get_instance_status(InstanceState.HEALTHY)
+        instance_id = self.client.post("/api/instance", json=dict(configuration=dict(admin=dict(group="team")))).get_json()["instance_id"]
+        self.assertEqual(self.marathon_adapter_mock.value_deploy_instance()["id"], "/team/{}".format(instance_id))
+        # Marathon reports the app ids without the leading slash
+        self.marathon_adapter_mock._deployed_app_ids = ["team/{}".format(instance_id)]
+        data = self.client.get("/api/instance").get_json()["instances"]
+        self.assertEqual(data[0]["status"], "HEALTHY")
+        self.assertEqual(self.marathon_adapter_mock.value_get_instance_statuses(), [["team"]])
+
+    def test_get_instances_single_kv_read(self):
+        self.marathon_adapter_mock.value_get_instance_status(InstanceState.HEALTHY)
+        for _ in range(3):
+            self.client.post("/api/instance", json=dict(configuration=dict()))
+        with mock.patch.object(self.kv_mock, "get_keys", wraps=self.kv_mock.get_keys) as get_keys, \
+                mock.patch.object(self.kv_mock, "get_key", wraps=self.kv_mock.get_key) as get_key:
+            data = self.client.get("/api/instance").get_json()["instances"]
+        self.assertEqual(len(data), 3)
+        self.assertEqual(get_keys.call_count, 1)
+        self.assertEqual(get_key.call_count, 0)
+
+    def test_resolve_instance_endpoint_cached(self):
+        from airfield.service.instance import InstanceService
+        self.marathon_adapter_mock.value_get_instance_status(InstanceState.HEALTHY)
+        instance_id = self.client.post("/api/instance", json=dict(configuration=dict())).get_json()["instance_id"]
+        instance_service = di.get(InstanceService)
+        with mock.patch.object(self.kv_mock, "get_keys", wraps=self.kv_mock.get_keys) as get_keys:
+            for _ in range(3):
+                endpoint = instance_service.resolve_instance_endpoint(instance_id)
+            self.assertEqual(get_keys.call_count, 1)
+            self.assertEqual(endpoint, dict(type="zeppelin", admins=["anonymous"], url="127.0.0.1:0"))
+            self.client.post("/api/instance/{}/restart".format(instance_id))
+            get_keys.reset_mock()
+            instance_service.resolve_instance_endpoint(instance_id)
+            self.assertEqual(get_keys.call_count, 1)
+
+    def test_resolve_instance_endpoint_follows_changes_of_other_workers(self):
+        from airfield.service.instance import InstanceService
+        listeners = list()
+        with mock.patch.object(self.kv_mock, "add_change_listener",
+                               side_effect=lambda prefix, listener: listeners.append(listener) or True):
+            instance_service = InstanceService()
+        di.register(InstanceService, instance_service)
+        self.marathon_adapter_mock.value_get_instance_status(InstanceState.HEALTHY)
+        instance_id = self.client.post("/api/instance", json=dict(configuration=dict())).get_json()["instance_id"]
+        self.assertEqual(instance_service.resolve_instance_endpoint(instance_id)["admins"], ["anonymous"])
+        configuration = self.kv_mock.get_key("instances/{}/configuration".format(instance_id))
+        configuration["admin"]["admins"] = ["bob"]
+        self.kv_mock.put_key("instances/{}/configuration".format(instance_id), configuration)
+        self.assertEqual(instance_service.resolve_instance_endpoint(instance_id)["admins"], ["anonymous"])
+        # Reported by the key-value mirror
+        listeners[0]("instances/{}/configuration".format(instance_id))
+        self.assertEqual(instance_service.resolve_instance_endpoint(instance_id)["admins"], ["bob", "anonymous"])
+
     def test_get_instance_credentials(self):
         configuration = dict(
             configuration=dict(usermanagement=dict(enabled=True, users=dict(admin="notsecure", random=None))))
@@ -1,3 +1,4 @@
+import time
 import unittest
 from unittest import mock
 from airfield.util import dependency_injection as di
@@ -55,7 +56,7 @@ class NotebookApiTest(unittest.TestCase):
     def test_import_notebook(self):
         configuration = dict(configuration=dict())
         instance_id = self.client.post("/api/instance", json=configuration).get_json()["instance_id"]
-        self.zeppelin_instance_mock.export_notebook.return_value = ("abcd", {"name": "abcd"}), 200
+        self.zeppelin_instance_mock.export_notebook.return_value = ("abcd", {"name": "abcd"})
         response = self.client.post("/api/notebook", json=dict(instance_id=instance_id, notebook_id="abcd"))
         self.assertEqual(response.status_code, 200)
         self.zeppelin_instance_mock.export_notebook.assert_called_once()
@@ -73,26 +74,159 @@ class NotebookApiTest(unittest.TestCase):
         self.assertEqual(response.get_json()["notebooks"], notebooks)
 
     def test_backup_restore_notebooks(self):
-        notebooks = [{"name": "ABCD", "id": "abcd"}]
         self.zeppelin_instance_mock.is_import_possible.return_value = True
-        self.zeppelin_instance_mock.get_instance_notebooks.return_value = notebooks
-        self.zeppelin_instance_mock.export_notebook.return_value = ("ABCD", {"name": "ABCD", "id": "abcd", "paragraphs": []})
+        self.zeppelin_instance_mock.export_notebooks.return_value = [
+            dict(id="abcd", name="ABCD", status="ok", notebook={"name": "ABCD", "id": "abcd", "paragraphs": []})]
+        self.zeppelin_instance_mock.import_notebooks.return_value = [dict(id="abcd", name="ABCD", status="ok")]
         configuration = dict(configuration=dict())
         instance_id = self.client.post("/api/instance", json=configuration).get_json()["instance_id"]
 
         response = self.client.post("/api/instance/{}/notebook/backup".format(instance_id))
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["status"], "finished")
 
         response = self.client.post("/api/instance/{}/notebook/restore".format(instance_id))
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._restore_status(instance_id), "queued")
         self.scheduler_mock.run()
-        self.zeppelin_instance_mock.import_notebook.assert_called_once()
+        self.zeppelin_instance_mock.import_notebooks.assert_called_once_with(instance_id, [{"name": "ABCD", "id": "abcd", "paragraphs": []}])
+        response = self.client.get("/api/instance/{}/notebook/restore".format(instance_id)).get_json()
+        self.assertEqual(response["status"], "done")
+        self.assertEqual(response["results"], [dict(id="abcd", name="ABCD", status="ok")])
+        self.assertNotIn("lease", response)
+
+    def test_restore_starts_when_instance_turns_healthy(self):
+        self.zeppelin_instance_mock.is_import_possible.return_value = True
+        self.zeppelin_instance_mock.import_notebooks.return_value = list()
+        configuration = dict(configuration=dict())
+        instance_id = self.client.post("/api/instance", json=configuration).get_json()["instance_id"]
+        self.kv_mock.put_key("instances/{}/notebooks".format(instance_id), list())
+        self.client.post("/api/instance/{}/notebook/restore".format(instance_id))
+        self.marathon_adapter_mock.notify_state("airfield-zeppelin/{}".format(instance_id), InstanceState.DEPLOYING)
+        self.assertEqual(self._restore_status(instance_id), "queued")
+        self.marathon_adapter_mock.notify_state("airfield-zeppelin/{}".format(instance_id), InstanceState.HEALTHY)
+        deadline = time.monotonic() + 5
+        while self._restore_status(instance_id) != "done" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self._restore_status(instance_id), "done")
+
+    def test_backups_share_notebook_bodies(self):
+        notebook = {"name": "ABCD", "id": "abcd", "paragraphs": [{"text": "%md x", "dateUpdated": "May 1"}]}
+        self.zeppelin_instance_mock.export_notebooks.side_effect = lambda instance_id: [
+            dict(id="abcd", name="ABCD", status="ok", notebook=notebook)]
+        configuration = dict(configuration=dict())
+        first_id = self.client.post("/api/instance", json=configuration).get_json()["instance_id"]
+        second_id = self.client.post("/api/instance", json=configuration).get_json()["instance_id"]
+        self.client.post("/api/instance/{}/notebook/backup".format(first_id))
+        self.client.post("/api/instance/{}/notebook/backup".format(first_id))
+        notebook["paragraphs"][0]["dateUpdated"] = "May 2"
+        self.client.post("/api/instance/{}/notebook/backup".format(second_id))
+        self.assertEqual(len(list(self.kv_mock.get_keys("notebook_blobs"))), 1)
+        self.assertEqual(self.kv_mock.get_key("instances/{}/notebooks".format(second_id)),
+                         self.kv_mock.get_key("instances/{}/notebooks".format(first_id)))
+
+    def test_backups_are_incremental(self):
+        notebook = {"name": "ABCD", "id": "abcd", "paragraphs": [{"text": "%md x"}]}
+        self.zeppelin_instance_mock.export_notebooks.side_effect = lambda instance_id: [
+            dict(id="abcd", name="ABCD", status="ok", notebook=notebook)]
+        configuration = dict(configuration=dict())
+        instance_id = self.client.post("/api/instance", json=configuration).get_json()["instance_id"]
+        response = self.client.post("/api/instance/{}/notebook/backup".format(instance_id)).get_json()
+        self.assertTrue(response["notebooks"][0]["changed"])
+        with mock.patch.object(self.kv_mock, "put_key", wraps=self.kv_mock.put_key) as put_key:
+            response = self.client.post("/api/instance/{}/notebook/backup".format(instance_id)).get_json()
+        self.assertFalse(response["notebooks"][0]["changed"])
+        put_key.assert_not_called()
+
+        notebook["paragraphs"][0]["text"] = "%md y"
+        self.zeppelin_instance_mock.export_notebooks.side_effect = lambda instance_id: [
+            dict(id="abcd", name="ABCD", status="ok", notebook=notebook),
+            dict(id="efgh", name=None, status="failed", error="timeout")]
+        response = self.client.post("/api/instance/{}/notebook/backup".format(instance_id)).get_json()
+        self.assertTrue(response["notebooks"][0]["changed"])
+        self.assertEqual(len(self.kv_mock.get_key("instances/{}/notebooks".format(instance_id))), 1)
+
+    def test_failed_exports_keep_their_last_backup(self):
+        notebooks = [{"name": "ABCD", "id": "abcd", "paragraphs": []}, {"name": "EFGH", "id": "efgh", "paragraphs": []}]
+        configuration = dict(configuration=dict())
+        instance_id = self.client.post("/api/instance", json=configuration).get_json()["instance_id"]
+        key = "instances/{}/notebooks".format(instance_id)
+        # Stored before the deduplication
+        self.kv_mock.put_key(key, [notebooks[1]])
+        self.zeppelin_instance_mock.export_notebooks.return_value = [
+            dict(id="abcd", name="ABCD", status="ok", notebook=notebooks[0]),
+            dict(id="efgh", name=None, status="failed", error="timeout")]
+        response = self.client.post("/api/instance/{}/notebook/backup".format(instance_id)).get_json()
+        self.assertEqual(response["status"], "incomplete")
+        self.assertEqual(sorted(item["id"] for item in self.kv_mock.get_key(key)), ["abcd", "efgh"])
+
+        self.zeppelin_instance_mock.export_notebooks.return_value = [
+            dict(id="abcd", name=None, status="failed", error="timeout"),
+            dict(id="efgh", name="EFGH", status="ok", notebook=notebooks[1])]
+        self.client.post("/api/instance/{}/notebook/backup".format(instance_id))
+        snapshot = self.kv_mock.get_key(key)
+        self.assertEqual(sorted(item["id"] for item in snapshot), ["abcd", "efgh"])
+        self.assertTrue(all("ref" in item for item in snapshot))
+
+    def test_unknown_restore_status(self):
+        response = self.client.get("/api/instance/abc/notebook/restore")
+        self.assertEqual(response.status_code, 404)
+
+    def _restore_status(self, instance_id):
+        return self.client.get("/api/instance/{}/notebook/restore".format(instance_id)).get_json()["status"]
+
+    def test_failed_notebooks_are_reported_and_retried(self):
+        notebooks = [{"name": "ABCD", "id": "abcd", "paragraphs": []}, {"name": "EFGH", "id": "efgh", "paragraphs": []}]
+        self.zeppelin_instance_mock.is_import_possible.return_value = True
+        self.zeppelin_instance_mock.export_notebooks.return_value = [
+            dict(id="abcd", name="ABCD", status="ok", notebook=notebooks[0]),
+            dict(id="efgh", name="EFGH", status="ok", notebook=notebooks[1]),
+            dict(id="ijkl", name=None, status="failed", error="Internal Server Error")]
+        configuration = dict(configuration=dict())
+        instance_id = self.client.post("/api/instance", json=configuration).get_json()["instance_id"]
+
+        response = self.client.post("/api/instance/{}/notebook/backup".format(instance_id)).get_json()
+        self.assertEqual(response["status"], "incomplete")
+        self.assertEqual([result["status"] for result in response["notebooks"]], ["ok", "ok", "failed"])
+        self.assertNotIn("notebook", response["notebooks"][0])
+
+        self.client.post("/api/instance/{}/notebook/restore".format(instance_id))
+        self.zeppelin_instance_mock.import_notebooks.return_value = [
+            dict(id="abcd", name="ABCD", status="ok"), dict(id="efgh", name="EFGH", status="failed", error="timeout")]
+        self.scheduler_mock.run()
+        self.assertEqual(self._restore_status(instance_id), "queued")
+        self.zeppelin_instance_mock.import_notebooks.return_value = [dict(id="efgh", name="EFGH", status="ok")]
+        self.scheduler_mock.run()
+        self.zeppelin_instance_mock.import_notebooks.assert_called_with(instance_id, [notebooks[1]])
+        self.scheduler_mock.run()
+        self.assertEqual(self.zeppelin_instance_mock.import_notebooks.call_count, 2)
+        response = self.client.get("/api/instance/{}/notebook/restore".format(instance_id)).get_json()
+        self.assertEqual(response["status"], "done")
+        self.assertEqual([result["id"] for result in response["results"]], ["abcd", "efgh"])
     
+    def test_missing_notebooks_fail_the_restore(self):
+        self.zeppelin_instance_mock.is_import_possible.return_value = True
+        self.zeppelin_instance_mock.export_notebooks.return_value = [
+            dict(id="abcd", name="ABCD", status="ok", notebook={"name": "ABCD", "id": "abcd", "paragraphs": []}),
+            dict(id="efgh", name="EFGH", status="ok", notebook={"name": "EFGH", "id": "efgh", "paragraphs": []})]
+        self.zeppelin_instance_mock.import_notebooks.return_value = [dict(id="abcd", name="ABCD", status="ok")]
+        configuration = dict(configuration=dict())
+        instance_id = self.client.post("/api/instance", json=configuration).get_json()["instance_id"]
+        self.client.post("/api/instance/{}/notebook/backup".format(instance_id))
+        ref = self.kv_mock.get_key("instances/{}/notebooks".format(instance_id))[1]["ref"]
+        self.kv_mock.delete_key("notebook_blobs/{}".format(ref), recursive=True)
+
+        self.client.post("/api/instance/{}/notebook/restore".format(instance_id))
+        self.scheduler_mock.run()
+        self.zeppelin_instance_mock.import_notebooks.assert_called_once_with(instance_id, [{"name": "ABCD", "id": "abcd", "paragraphs": []}])
+        response = self.client.get("/api/instance/{}/notebook/restore".format(instance_id)).get_json()
+        self.assertEqual(response["status"], "failed")
+        self.assertEqual([(result["id"], result["status"]) for result in response["results"]], [("abcd", "ok"), ("efgh", "failed")])
+
     def test_cancel_restore_notebooks(self):
-        notebooks = [{"name": "ABCD", "id": "abcd"}]
         self.zeppelin_instance_mock.is_import_possible.return_value = True
-        self.zeppelin_instance_mock.get_instance_notebooks.return_value = notebooks
-        self.zeppelin_instance_mock.export_notebook.return_value = ("ABCD", {"name": "ABCD", "id": "abcd", "paragraphs": []})
+        self.zeppelin_instance_mock.export_notebooks.return_value = [
+            dict(id="abcd", name="ABCD", status="ok", notebook={"name": "ABCD", "id": "abcd", "paragraphs": []})]
         configuration = dict(configuration=dict())
         instance_id = self.client.post("/api/instance", json=configuration).get_json()["instance_id"]
 
@@ -103,6 +237,51 @@ class NotebookApiTest(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.client.delete("/api/instance/{}/notebook/restore".format(instance_id))
         self.scheduler_mock.run()
-        self.zeppelin_instance_mock.import_notebook.assert_not_called()
+        self.zeppelin_instance_mock.import_notebooks.assert_not_called()
+
+  
+
+@mock.patch("airfield.service.notebook.config.NOTEBOOK_AUTO_BACKUP_INTERVAL_SECONDS", 3600)
+class NotebookAutoBackupTest(unittest.TestCase):
+    setUp = NotebookApiTest.setUp
+    tearDown = NotebookApiTest.tearDown
+
+    def _create_instance(self, state=InstanceState.HEALTHY):
+        self.marathon_adapter_mock.value_get_instance_status(state)
+        configuration = dict(configuration=dict(type="zeppelin"))
+        instance_id = self.client.post("/api/instance", json=configuration).get_json()["instance_id"]
+        # Creates the notebook service, which registers its jobs
+        self.client.get("/api/notebook")
+        return instance_id
+
+    def test_auto_backup_keeps_missing_notebooks(self):
+        notebooks = [{"name": "ABCD", "id": "abcd", "paragraphs": []}, {"name": "EFGH", "id": "efgh", "paragraphs": []}]
+        self.zeppelin_instance_mock.export_notebooks.side_effect = lambda instance_id: [
+            dict(id=notebook["id"], name=notebook["name"], status="ok", notebook=notebook) for notebook in notebooks]
+        instance_id = self._create_instance()
+        self.scheduler_mock.run()
+        self.assertEqual([item["id"] for item in self.kv_mock.get_key("instances/{}/notebooks".format(instance_id))],
+                         ["abcd", "efgh"])
+
+        # Not due again within the interval
+        self.scheduler_mock.run()
+        self.assertEqual(self.zeppelin_instance_mock.export_notebooks.call_count, 1)
+
+        self.kv_mock.delete_key("notebook_backups/{}".format(instance_id))
+        notebooks.pop()
+        self.scheduler_mock.run()
+        self.assertEqual(self.zeppelin_instance_mock.export_notebooks.call_count, 2)
+        self.assertEqual(len(self.kv_mock.get_key("instances/{}/notebooks".format(instance_id))), 2)
 
-  
\ No newline at end of file
+    def test_no_auto_backup_during_restore(self):
+        self.zeppelin_instance_mock.is_import_possible.return_value = False
+        instance_id = self._create_instance()
+        self.client.post("/api/instance/{}/notebook/restore".format(instance_id))
+        self.scheduler_mock.run()
+        self.zeppelin_instance_mock.export_notebooks.assert_not_called()
+
+    def test_no_auto_backup_of_stopped_instances(self):
+        instance_id = self._create_instance(InstanceState.STOPPED)
+        self.scheduler_mock.run()
+        self.zeppelin_instance_mock.export_notebooks.assert_not_called()
+        self.assertIsNone(self.kv_mock.get_key("notebook_backups/{}".format(instance_id)))
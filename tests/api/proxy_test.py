@@ -0,0 +1,119 @@
+import hashlib
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from airfield.util import dependency_injection as di
+from airfield.adapter.marathon import MarathonAdapter
+from airfield.adapter.kv import KVAdapter
+from airfield.adapter.proxy_pool import ProxyPoolRegistry
+from airfield.util import logging
+from tests.mocks.marathon_adapter import MarathonAdapterMock
+from tests.mocks.kv import InMemoryKVAdapter
+
+
+_BODY = b"0123456789abcdef" * 64 * 1024
+
+
+class _UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    client_ports = list()
+
+    def do_GET(self):
+        self.client_ports.append(self.client_address[1])
+        self._respond(_BODY)
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            data = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:-2]
+                if not size:
+                    break
+                data += chunk
+        else:
+            data = self.rfile.read(int(self.headers["Content-Length"]))
+        self._respond(hashlib.sha256(data).hexdigest().encode("utf-8"))
+
+    def _respond(self, body):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Upstream", "notebook")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ProxyApiTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.upstream = ThreadingHTTPServer(("127.0.0.1", 0), _UpstreamHandler)
+        threading.Thread(target=cls.upstream.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.upstream.shutdown()
+        cls.upstream.server_close()
+
+    def setUp(self):
+        logging.silence()
+        di.test_setup_clear_registry()
+        di.register(MarathonAdapter, MarathonAdapterMock())
+        di.register(KVAdapter, InMemoryKVAdapter())
+        from airfield.app import create_app
+        self.app = create_app()
+        self.app.testing = True
+        self.client = self.app.test_client()
+        self.instance_service = mock.MagicMock()
+        self.instance_service.resolve_instance_endpoint.return_value = dict(
+            type="zeppelin", admins=[], url="127.0.0.1:{}".format(self.upstream.server_port))
+        for name, value in [("instance_service", self.instance_service), ("pool_registry", ProxyPoolRegistry())]:
+            patcher = mock.patch("airfield.api.proxy.{}".format(name), value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        di.test_setup_clear_registry()
+
+    def test_proxy_streams_response(self):
+        with mock.patch("airfield.api.proxy.config.PROXY_CHUNK_SIZE", 4096):
+            response = self.client.get("/proxy/abc/notebook/file", buffered=False)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.headers["X-Upstream"], "notebook")
+            self.assertEqual(len(next(response.response)), 4096)
+            self.assertEqual(response.get_data(), _BODY[4096:])
+
+    def test_proxy_streams_request_body(self):
+        data = b"x" * 300 * 1024
+        response = self.client.post("/proxy/abc/api/upload", data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), hashlib.sha256(data).hexdigest().encode("utf-8"))
+
+    def test_proxy_buffered_mode(self):
+        with mock.patch("airfield.api.proxy.config.PROXY_STREAMING_ENABLED", False):
+            response = self.client.get("/proxy/abc/notebook/file")
+            self.assertEqual(response.get_data(), _BODY)
+
+    def test_upstream_websocket_serializes_writes(self):
+        from airfield.api.proxy import websocket_proxy_body
+        with mock.patch("airfield.api.proxy.websocket.WebSocket") as websocket_class, \
+                mock.patch("airfield.api.proxy.WebsocketBridge") as bridge:
+            websocket_proxy_body(mock.MagicMock(), instance_id="abc")
+        websocket_class.assert_called_once_with(enable_multithread=True)
+        bridge.return_value.run.assert_called_once()
+
+    def test_proxy_connection_error_invalidates_endpoint(self):
+        self.instance_service.resolve_instance_endpoint.return_value = dict(type="zeppelin", admins=[], url="127.0.0.1:1")
+        response = self.client.get("/proxy/abc/notebook/file")
+        self.assertEqual(response.status_code, 502)
+        self.instance_service.invalidate_instance_endpoint.assert_called_once_with("abc")
+
+    def test_proxy_reuses_upstream_connections(self):
+        _UpstreamHandler.client_ports.clear()
+        for _ in range(3):
+            self.assertEqual(self.client.get("/proxy/abc/notebook/file").get_data(), _BODY)
+        self.assertEqual(len(_UpstreamHandler.client_ports), 3)
+        self.assertEqual(len(set(_UpstreamHandler.client_ports)), 1)
@@ -0,0 +1,51 @@
+"""
+Runs the control-plane benchmarks: python -m tests.benchmark --output results.json [--baseline previous.json]
+Exits with 1 if the results regressed against the baseline.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from datetime import datetime
+from . import fleet
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m tests.benchmark", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=fleet.SIZES, help="Fleet sizes to benchmark")
+    parser.add_argument("--repetitions", type=int, default=5, help="Measured runs per operation")
+    parser.add_argument("--output", help="File to write the results to as JSON")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument("--latency-threshold", type=float, default=0.5,
+                        help="Allowed relative growth of the median duration, e.g. 0.5 for 50%%")
+    parser.add_argument("--min-latency", type=float, default=0.001,
+                        help="Growth of the median duration in seconds that is always allowed")
+    args = parser.parse_args()
+
+    results = fleet.run(args.sizes, args.repetitions)
+    for size, operations in results.items():
+        for name, result in operations.items():
+            print("{:>6} instances  {:28} median {:9.4f}s  calls {}".format(
+                size, name, result["median_seconds"], ", ".join("{}={}".format(call, count) for call, count in sorted(result["calls"].items()))))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(dict(created_at=datetime.now().isoformat(), commit=_commit(), results=results), output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = fleet.compare(json.load(baseline)["results"], results, args.latency_threshold, args.min_latency)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
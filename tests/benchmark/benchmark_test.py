@@ -0,0 +1,32 @@
+import unittest
+from tests.benchmark import fleet
+
+
+def _result(median_seconds, **calls):
+    return dict(median_seconds=median_seconds, min_seconds=median_seconds, calls=calls)
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_run_counts_backend_calls(self):
+        results = fleet.run([10], repetitions=1)
+        self.assertEqual(set(results["10"]), {"get_instances", "get_instance", "get_instance_configurations",
+                                              "cleanup_run", "get_notebooks"})
+        self.assertEqual(results["10"]["get_instances"]["calls"]["marathon.get_instance_statuses"], 1)
+        self.assertGreater(results["10"]["get_notebooks"]["calls"]["kv.get_keys"], 0)
+
+    def test_compare_reports_more_calls(self):
+        baseline = {"100": dict(get_instances=_result(0.01, **{"kv.get_keys": 1}))}
+        results = {"100": dict(get_instances=_result(0.01, **{"kv.get_keys": 1, "kv.get_key": 100}))}
+        self.assertEqual(fleet.compare(baseline, results), ["100 instances, get_instances: 100 calls of kv.get_key (was 0)"])
+
+    def test_compare_reports_slower_operations_beyond_the_thresholds(self):
+        baseline = {"100": dict(get_instances=_result(0.01), get_instance=_result(0.0001))}
+        results = {"100": dict(get_instances=_result(0.02), get_instance=_result(0.0003))}
+        # The growth of get_instance is below the absolute minimum
+        self.assertEqual(len(fleet.compare(baseline, results)), 1)
+        self.assertEqual(fleet.compare(baseline, results, latency_threshold=1.5), [])
+
+    def test_compare_skips_new_sizes_and_operations(self):
+        baseline = {"10": dict(get_instances=_result(0.01))}
+        results = {"10": dict(get_instances=_result(0.01), get_notebooks=_result(1)), "100": dict(get_instances=_result(1))}
+        self.assertEqual(fleet.compare(baseline, results), [])
@@ -0,0 +1,159 @@
+"""
+Benchmarks of the control-plane operations against fleets of different sizes. The fleet is seeded into the
+in-memory key-value mock and the marathon mock, both are wrapped to count the backend calls of every operation.
+"""
+
+import copy
+import random
+import statistics
+import time
+import uuid
+from collections import Counter
+from unittest import mock
+from airfield.adapter.kv import KVAdapter
+from airfield.adapter.marathon import MarathonAdapter, InstanceState
+from airfield.configuration.service import ConfigurationService
+from airfield.service.cleanup import InstanceCleanupService
+from airfield.service.instance import InstanceService
+from airfield.service.notebook_zeppelin import ZeppelinNotebookService
+from airfield.service.scheduler import SchedulerService
+from airfield.settings import config
+from airfield.storage.instance import InstanceStore
+from airfield.storage.notebook import NotebookStore
+from airfield.storage.notebook_blob import NotebookBlobStore
+from airfield.util import dependency_injection as di
+from airfield.util import logging
+from tests.mocks.kv import InMemoryKVAdapter
+from tests.mocks.marathon_adapter import MarathonAdapterMock
+from tests.mocks.scheduler import SchedulerServiceMock
+
+
+SIZES = [10, 100, 1000, 10000]
+# Share of the instances that have a delete_at time (in the future, so the cleanup does not change the fleet)
+DELETE_AT_SHARE = 0.1
+
+
+class CallCounter:
+    """Wraps an adapter and counts the calls of its public methods as <name>.<method>"""
+    def __init__(self, target, name, counts):
+        self._target = target
+        self._name = name
+        self._counts = counts
+
+    def __getattr__(self, attribute):
+        value = getattr(self._target, attribute)
+        if not callable(value) or attribute.startswith("_"):
+            return value
+
+        def counted(*args, **kwargs):
+            self._counts["{}.{}".format(self._name, attribute)] += 1
+            return value(*args, **kwargs)
+        return counted
+
+
+class Fleet:
+    """The services of one airfield worker on top of mocks that are seeded with the given number of instances"""
+    def __init__(self, size):
+        logging.silence()
+        di.test_setup_clear_registry()
+        self.calls = Counter()
+        kv_mock = InMemoryKVAdapter()
+        marathon_mock = MarathonAdapterMock()
+        marathon_mock.value_get_instance_status(InstanceState.HEALTHY)
+        self.instance_ids = _seed_instances(kv_mock, marathon_mock, size)
+        _seed_notebooks(kv_mock, size)
+        di.register(KVAdapter, CallCounter(kv_mock, "kv", self.calls))
+        di.register(MarathonAdapter, CallCounter(marathon_mock, "marathon", self.calls))
+        di.register(SchedulerService, SchedulerServiceMock())
+        di.register(ZeppelinNotebookService, mock.MagicMock())
+        self.instance_service = di.get(InstanceService)
+        self.cleanup_service = di.get(InstanceCleanupService)
+        self.notebook_store = di.get(NotebookStore)
+
+    def operations(self):
+        """Returns the benchmarked operations by name"""
+        return dict(
+            get_instances=self.instance_service.get_instances,
+            get_instance=lambda: self.instance_service.get_instance(random.choice(self.instance_ids)),
+            get_instance_configurations=self.instance_service.get_instance_configurations,
+            cleanup_run=self.cleanup_service._run,
+            get_notebooks=self.notebook_store.get_notebooks,
+        )
+
+    def close(self):
+        di.test_setup_clear_registry()
+
+
+def run(sizes=None, repetitions=5):
+    """
+    Runs every operation once to warm up caches and then the given number of times against each fleet size.
+    Returns the results by size and operation: the median and minimum duration and the backend calls of one run.
+    """
+    results = dict()
+    for size in sizes or SIZES:
+        fleet = Fleet(size)
+        try:
+            results[str(size)] = {name: _measure(operation, fleet.calls, repetitions)
+                                  for name, operation in fleet.operations().items()}
+        finally:
+            fleet.close()
+    return results
+
+
+def compare(baseline, results, latency_threshold=0.5, min_latency_seconds=0.001):
+    """
+    Returns the regressions of the results against a baseline: every backend call count that grew, and every
+    median duration that grew by more than the threshold (relative) and the minimum (absolute).
+    Sizes and operations that are missing in either of them are skipped.
+    """
+    regressions = list()
+    for size, operations in results.items():
+        for name, result in operations.items():
+            before = baseline.get(size, dict()).get(name)
+            if before is None:
+                continue
+            for call, count in sorted(result["calls"].items()):
+                if count > before["calls"].get(call, 0):
+                    regressions.append("{} instances, {}: {} calls of {} (was {})".format(
+                        size, name, count, call, before["calls"].get(call, 0)))
+            if result["median_seconds"] > before["median_seconds"] * (1 + latency_threshold) and \
+                    result["median_seconds"] - before["median_seconds"] > min_latency_seconds:
+                regressions.append("{} instances, {}: median {:.4f}s (was {:.4f}s)".format(
+                    size, name, result["median_seconds"], before["median_seconds"]))
+    return regressions
+
+
+def _measure(operation, calls, repetitions):
+    operation()
+    durations = list()
+    for _ in range(repetitions):
+        calls.clear()
+        started = time.perf_counter()
+        operation()
+        durations.append(time.perf_counter() - started)
+    return dict(median_seconds=statistics.median(durations), min_seconds=min(durations), calls=dict(calls))
+
+
+def _seed_instances(kv_mock, marathon_mock, size):
+    random.seed(size)
+    template = ConfigurationService().prepare_configuration(dict())
+    instance_store = InstanceStore(kv_mock)
+    instance_ids = list()
+    now = time.time()
+    for index in range(size):
+        instance_id = uuid.uuid4().hex[:9]
+        configuration = copy.deepcopy(template)
+        configuration["comment"] = "Instance {}".format(index)
+        configuration["delete_at"] = now + 24 * 60 * 60 if random.random() < DELETE_AT_SHARE else None
+        instance_store.insert_instance(instance_id, configuration, dict(created_by="user{}".format(index % 50), created_at=now))
+        instance_store.start_runtime(instance_id, dict(cores=2, memory=4096))
+        marathon_mock._deployed_app_ids.append("{}/{}".format(config.MARATHON_APP_GROUP, instance_id))
+        instance_ids.append(instance_id)
+    return instance_ids
+
+
+def _seed_notebooks(kv_mock, size):
+    notebook_store = NotebookStore(kv_mock, NotebookBlobStore(kv_mock))
+    for index in range(size):
+        notebook = dict(name="Notebook {}".format(index), paragraphs=[dict(text="%spark\nsc.version {}".format(index))])
+        notebook_store.store_notebook(str(uuid.uuid4()), notebook["name"], notebook, "user{}".format(index % 50))
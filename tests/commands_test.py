@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+from airfield.adapter.etcd import EtcdAdapter
+from airfield.adapter.etcd3 import Etcd3Adapter
+from airfield.adapter.marathon import MarathonAdapter
+from airfield.util import dependency_injection as di
+from airfield.util import logging
+from tests.mocks.marathon_adapter import MarathonAdapterMock
+
+
+class CommandsTest(unittest.TestCase):
+    def setUp(self):
+        logging.silence()
+        for name in ["ETCD_ENDPOINT", "ETCD3_ENDPOINT"]:
+            patcher = mock.patch("airfield.settings.config." + name, "etcd:2379")
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        di.test_setup_clear_registry()
+        di.register(MarathonAdapter, MarathonAdapterMock())
+        # The key-value adapter is not mocked, so the app creates the etcd v3 adapter like in production
+        from airfield.app import create_app
+        self.app = create_app()
+        self.runner = self.app.test_cli_runner()
+
+    def tearDown(self):
+        di.test_setup_clear_registry()
+
+    @mock.patch("airfield.commands.copy_raw_keys", return_value=(3, 1))
+    def test_migrate_etcd_v3(self, copy_raw_keys):
+        result = self.runner.invoke(args=["migrate-etcd-v3"])
+        self.assertIsNone(result.exception)
+        self.assertIn("Copied 3 keys, skipped 1 existing keys.", result.output)
+        source, target = copy_raw_keys.call_args[0]
+        self.assertIsInstance(source, EtcdAdapter)
+        self.assertIs(target, di.get(Etcd3Adapter))
+        self.assertEqual(copy_raw_keys.call_args[1], dict(overwrite=False))
+
+    @mock.patch("airfield.commands.run_benchmark")
+    def test_benchmark_kv(self, run_benchmark):
+        run_benchmark.return_value = dict(list_instances=dict(median_ms=1.5, p95_ms=2.5))
+        result = self.runner.invoke(args=["benchmark-kv", "--backend", "etcd3", "--backend", "etcd",
+                                          "--instances", "10", "--reads", "5"])
+        self.assertIsNone(result.exception)
+        self.assertEqual([(call[0][0]._kv.__class__, call[0][1], call[0][2]) for call in run_benchmark.call_args_list],
+                         [(Etcd3Adapter, 10, 5), (EtcdAdapter, 10, 5)])
+        self.assertEqual(len(result.output.splitlines()), 2)
+
+    def test_adapters_can_be_created_more_than_once(self):
+        self.assertIsNot(Etcd3Adapter(), Etcd3Adapter())
+        self.assertIsNot(EtcdAdapter(), EtcdAdapter())
@@ -1,8 +1,12 @@
+import copy
+
 
 class InMemoryKVAdapter:
     """ Dummy in-memory key-value store to be used as mock for KVAdapter"""
     def __init__(self):
         self._data = {}
+        self._indexes = {}
+        self._index = 0
 
     def get_key(self, key):
         root, key = self._navigate(key)
@@ -14,9 +18,32 @@ class InMemoryKVAdapter:
             if sub_key.startswith(key):
                 yield sub_key, root.get(sub_key)
 
+    def get_key_names(self, key):
+        return [sub_key for sub_key, _ in self.get_keys(key)]
+
+    def find_instance_ids(self, base_key, created_by=None, group=None, delete_before=None):
+        # Like the backends without secondary indexes
+        return None
+
+    def get_key_with_index(self, key):
+        root, key = self._navigate(key)
+        if key not in root:
+            return None, None
+        return copy.deepcopy(root[key]), self._indexes[key]
+
     def put_key(self, key, value):
         root, key = self._navigate(key)
         root[key] = value
+        self._index += 1
+        self._indexes[key] = self._index
+
+    def put_key_cas(self, key, value, index):
+        root, key = self._navigate(key)
+        current_index = self._indexes[key] if key in root else None
+        if current_index != index:
+            return False
+        self.put_key(key, copy.deepcopy(value))
+        return True
 
     def delete_key(self, key, recursive=False):
         root, key = self._navigate(key)
@@ -24,6 +51,27 @@ class InMemoryKVAdapter:
             if sub_key.startswith(key):
                 root.pop(sub_key)
 
+    def txn(self, ops):
+        for op in ops:
+            if op["verb"] == "check":
+                root, key = self._navigate(op["key"])
+                if (self._indexes[key] if key in root else None) != op["index"]:
+                    return False
+        for op in ops:
+            if op["verb"] == "set":
+                self.put_key(op["key"], copy.deepcopy(op["value"]))
+            elif op["verb"] == "delete":
+                self.delete_key(op["key"], recursive=op["recursive"])
+        return True
+
+    def add_change_listener(self, prefix, listener):
+        # Like the KVAdapter without mirror
+        return False
+
+    def collect_chunk_garbage(self, grace_seconds):
+        # Values are kept in memory without chunks
+        return 0
+
     def _navigate(self, key):
         root = self._data
         return root, key
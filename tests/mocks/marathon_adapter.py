@@ -2,8 +2,23 @@
 
 
 class MarathonAdapterMock:
+    def __init__(self):
+        self._deployed_app_ids = list()
+        self._value_get_instance_statuses = list()
+        self._state_listeners = list()
+
+    def add_state_listener(self, listener):
+        self._state_listeners.append(listener)
+        return True
+
+    def notify_state(self, app_id, state):
+        for listener in self._state_listeners:
+            listener(app_id, state)
+
     def deploy_instance(self, app_definition):
         self._value_deploy_instance = app_definition
+        if app_definition["id"] not in self._deployed_app_ids:
+            self._deployed_app_ids.append(app_definition["id"])
     
     def value_deploy_instance(self):
         return self._value_deploy_instance
@@ -14,6 +29,14 @@ class MarathonAdapterMock:
     def value_get_instance_status(self, value):
         self._value_get_instance_status = value
 
+    def get_instance_statuses(self, group_ids):
+        self._value_get_instance_statuses.append(group_ids)
+        return {app_id: self._value_get_instance_status for app_id in self._deployed_app_ids
+                if app_id.rsplit("/", 1)[0] in group_ids}
+
+    def value_get_instance_statuses(self):
+        return self._value_get_instance_statuses
+
     def delete_instance(self, app_id):
         self._value_delete_instance = app_id
         return True
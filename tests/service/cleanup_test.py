@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+from airfield.adapter.kv import KVAdapter
+from airfield.adapter.marathon import MarathonAdapter
+from airfield.adapter.sqlite import SqliteAdapter
+from airfield.service.cleanup import InstanceCleanupService
+from airfield.service.scheduler import SchedulerService
+from airfield.storage.instance import InstanceStore
+from airfield.util import dependency_injection as di
+from airfield.util import logging
+from tests.mocks.kv import InMemoryKVAdapter
+from tests.mocks.marathon_adapter import MarathonAdapterMock
+from tests.mocks.scheduler import SchedulerServiceMock
+
+
+class InstanceCleanupServiceTest(unittest.TestCase):
+    def setUp(self):
+        logging.silence()
+        di.test_setup_clear_registry()
+        self.addCleanup(di.test_setup_clear_registry)
+        self.marathon_adapter_mock = MarathonAdapterMock()
+        di.register(MarathonAdapter, self.marathon_adapter_mock)
+        di.register(SchedulerService, SchedulerServiceMock())
+
+    def _run_cleanup(self, kv_adapter):
+        di.register(KVAdapter, kv_adapter)
+        instance_store = InstanceStore(kv_adapter)
+        now = datetime.now()
+        for instance_id, delete_at in [("overdue", now - timedelta(days=1)), ("future", now + timedelta(days=1)), ("forever", None)]:
+            configuration = dict(type="zeppelin", admin=dict(group=None),
+                                 delete_at=delete_at.timestamp() if delete_at else None)
+            instance_store.insert_instance(instance_id, configuration, dict(created_by="foo"))
+        di.get(InstanceCleanupService)._run()
+        return instance_store
+
+    def _assert_only_overdue_instance_deleted(self, instance_store):
+        self.assertEqual(sorted(instance_store.get_instance_ids()), ["forever", "future"])
+        self.assertEqual(list(instance_store.get_instance_ids(deleted=True)), ["overdue"])
+        self.assertEqual(self.marathon_adapter_mock._value_delete_instance, "airfield-zeppelin/overdue")
+
+    @mock.patch("airfield.service.cleanup.config.INSTANCE_CLEANUP_DELETE_ENABLED", True)
+    def test_deletes_overdue_instances(self):
+        self._assert_only_overdue_instance_deleted(self._run_cleanup(InMemoryKVAdapter()))
+
+    @mock.patch("airfield.service.cleanup.logger")
+    def test_only_logs_overdue_instances_by_default(self, logger):
+        instance_store = self._run_cleanup(InMemoryKVAdapter())
+        self.assertEqual(sorted(instance_store.get_instance_ids()), ["forever", "future", "overdue"])
+        self.assertEqual(list(instance_store.get_instance_ids(deleted=True)), [])
+        self.assertFalse(hasattr(self.marathon_adapter_mock, "_value_delete_instance"))
+        self.assertIn("overdue", logger.info.call_args[0][0])
+
+    @mock.patch("airfield.service.cleanup.config.INSTANCE_CLEANUP_DELETE_ENABLED", True)
+    def test_deletes_overdue_instances_with_secondary_indexes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self._assert_only_overdue_instance_deleted(self._run_cleanup(KVAdapter(SqliteAdapter(os.path.join(directory, "kv.db")))))
@@ -0,0 +1,85 @@
+import unittest
+from unittest import mock
+from airfield.adapter.kv import KVAdapter
+from airfield.adapter.marathon import MarathonAdapter
+from airfield.service.costs import CostLedgerService
+from airfield.storage.instance import InstanceStore
+from airfield.util import dependency_injection as di
+from airfield.util import logging
+from tests.mocks.kv import InMemoryKVAdapter
+from tests.mocks.marathon_adapter import MarathonAdapterMock
+
+
+_cost_factors = dict(cores=2, memory=2048)
+
+
+@mock.patch("airfield.service.costs.config.COST_CORE_PER_MINUTE", 1.0)
+@mock.patch("airfield.service.costs.config.COST_GB_PER_MINUTE", 0.5)
+class CostLedgerServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.kv_mock = InMemoryKVAdapter()
+        self.instance_store = InstanceStore(self.kv_mock)
+        self.under_test = CostLedgerService(self.instance_store)
+        self.instance_store.insert_instance("abc", dict(type="zeppelin"), dict(created_by="foo"))
+
+    def _run(self, started_at, stopped_at):
+        with mock.patch("airfield.storage.instance.datetime") as datetime:
+            datetime.now.return_value.timestamp.return_value = started_at
+            self.instance_store.start_runtime("abc", _cost_factors)
+            if stopped_at is not None:
+                datetime.now.return_value.timestamp.return_value = stopped_at
+                self.instance_store.finish_runtime("abc")
+
+    def test_costs_from_totals(self):
+        self._run(0, 600)
+        self._run(1000, None)
+        data = self.instance_store.get_instance("abc")
+        with mock.patch.object(self.kv_mock, "get_keys") as get_keys:
+            costs = self.under_test.calculate_costs("abc", data, now=1300)
+        get_keys.assert_not_called()
+        # 15 minutes with 2 cores and 2 GB
+        self.assertEqual(costs, dict(cost=15 * 2 * 1.0 + 15 * 2 * 0.5, running_time_seconds=900))
+
+    def test_runtimes_longer_than_a_day(self):
+        self._run(0, 2 * 86400 + 60)
+        costs = self.under_test.calculate_costs("abc", self.instance_store.get_instance("abc"))
+        self.assertEqual(costs["running_time_seconds"], 2 * 86400 + 60)
+
+    def test_costs_per_hour(self):
+        self.assertEqual(self.under_test.calculate_costs_per_hour(_cost_factors), 60 * 2 * 1.0 + 60 * 2 * 0.5)
+
+    def test_recompute(self):
+        self._run(0, 600)
+        self.kv_mock.put_key("instances/abc/runtime_head", dict(next_seq=1, open=None))
+        self.assertEqual(self.under_test.calculate_costs("abc", self.instance_store.get_instance("abc"))["cost"], 30.0)
+        self.assertEqual(self.under_test.recompute(), 1)
+        head = self.kv_mock.get_key("instances/abc/runtime_head")
+        self.assertEqual(head["totals"], dict(core_minutes=20.0, gb_minutes=20.0, running_seconds=600.0))
+
+    def test_recompute_migrates_legacy_deleted_instances(self):
+        self.kv_mock.put_key("deleted_instances/xyz/configuration", dict(type="zeppelin"))
+        self.kv_mock.put_key("deleted_instances/xyz/runtimes", [dict(started_at=0, stopped_at=60, cores=1, memory=1024)])
+        self.assertEqual(self.under_test.recompute(deleted=True), 1)
+        self.assertIsNone(self.kv_mock.get_key("deleted_instances/xyz/runtimes"))
+        self.assertEqual(self.instance_store.get_runtimes("xyz", deleted=True),
+                         [dict(started_at=0, stopped_at=60, cores=1, memory=1024)])
+
+
+class RecomputeCostsCommandTest(unittest.TestCase):
+    def setUp(self):
+        logging.silence()
+        di.test_setup_clear_registry()
+        self.kv_mock = InMemoryKVAdapter()
+        di.register(MarathonAdapter, MarathonAdapterMock())
+        di.register(KVAdapter, self.kv_mock)
+        from airfield.app import create_app
+        self.app = create_app()
+
+    def tearDown(self):
+        di.test_setup_clear_registry()
+
+    def test_recompute_costs(self):
+        InstanceStore(self.kv_mock).insert_instance("abc", dict(type="zeppelin"), dict(created_by="foo"))
+        result = self.app.test_cli_runner().invoke(args=["recompute-costs"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Recomputed the cost totals of 1 instances.", result.output)
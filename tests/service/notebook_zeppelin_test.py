@@ -0,0 +1,78 @@
+import unittest
+from unittest import mock
+from airfield.adapter.zeppelin import ZeppelinException
+from airfield.service.notebook_zeppelin import ZeppelinNotebookService
+from airfield.util import logging
+
+
+class ZeppelinNotebookServiceTest(unittest.TestCase):
+    def setUp(self):
+        logging.silence()
+        self.instance_service = mock.MagicMock()
+        self.instance_service.resolve_instance_endpoint.return_value = dict(type="zeppelin", admins=[], url="zeppelin.local")
+        self.instance_service.get_instance_credentials.return_value = dict(admin="secret")
+        self.under_test = ZeppelinNotebookService(self.instance_service)
+        patcher = mock.patch("airfield.service.notebook_zeppelin.ZeppelinAdapter")
+        self.adapter_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.zeppelin = self.adapter_class.return_value
+
+    def test_export_notebooks_uses_one_session(self):
+        self.zeppelin.list_notebooks.return_value = [dict(id="a", name="A"), dict(id="b", name="B"),
+                                                     dict(id="t", name="Zeppelin Tutorial/Basics")]
+        self.zeppelin.export_notebook.side_effect = lambda notebook_id: dict(id=notebook_id, name=notebook_id.upper())
+        results = self.under_test.export_notebooks("abc")
+        self.assertEqual(results, [dict(id="a", name="A", notebook=dict(id="a", name="A"), status="ok"),
+                                   dict(id="b", name="B", notebook=dict(id="b", name="B"), status="ok")])
+        self.adapter_class.assert_called_once_with("http://zeppelin.local")
+        self.zeppelin.login.assert_called_once_with("admin", "secret")
+        self.instance_service.resolve_instance_endpoint.assert_called_once_with("abc")
+
+    def test_failures_do_not_abort_the_export(self):
+        def export(notebook_id):
+            if notebook_id == "b":
+                raise ZeppelinException("Internal Server Error")
+            return dict(id=notebook_id, name=notebook_id.upper())
+        self.zeppelin.export_notebook.side_effect = export
+        results = self.under_test.export_notebooks("abc", ["a", "b", "c"])
+        self.assertEqual([result["status"] for result in results], ["ok", "failed", "ok"])
+        self.assertEqual(results[1], dict(id="b", name=None, status="failed", error="Internal Server Error"))
+
+    def test_import_notebooks(self):
+        self.instance_service.get_instance_credentials.return_value = []
+        self.zeppelin.import_notebook.side_effect = [None, ZeppelinException("conflict")]
+        notebooks = [dict(id="a", name="A")]
+        results = self.under_test.import_notebooks("abc", notebooks)
+        self.assertEqual(results, [dict(id="a", name="A", status="ok")])
+        self.zeppelin.login.assert_not_called()
+        results = self.under_test.import_notebooks("abc", notebooks)
+        self.assertEqual(results, [dict(id="a", name="A", status="failed", error="conflict")])
+        self.assertEqual(self.under_test.import_notebooks("abc", list()), list())
+
+    def test_sessions_are_reused(self):
+        self.zeppelin.list_notebooks.return_value = [dict(id="a", name="A")]
+        self.zeppelin.base_host = "http://zeppelin.local"
+        self.under_test.get_instance_notebooks("abc")
+        self.under_test.get_instance_notebooks("abc")
+        self.adapter_class.assert_called_once()
+        self.zeppelin.login.assert_called_once()
+        self.instance_service.get_instance_credentials.assert_called_once()
+        self.assertEqual(self.zeppelin.list_notebooks.call_count, 2)
+
+    def test_sessions_are_dropped_when_the_instance_changes(self):
+        self.zeppelin.base_host = "http://zeppelin.local"
+        self.under_test.get_instance_notebooks("abc")
+        listener = self.instance_service.add_invalidation_listener.call_args[0][0]
+        listener("abc")
+        self.zeppelin.close.assert_called_once()
+        self.under_test.get_instance_notebooks("abc")
+        self.assertEqual(self.adapter_class.call_count, 2)
+        self.instance_service.resolve_instance_endpoint.return_value = dict(type="zeppelin", admins=[], url="other.local")
+        self.under_test.get_instance_notebooks("abc")
+        self.adapter_class.assert_called_with("http://other.local")
+        self.assertEqual(self.zeppelin.close.call_count, 2)
+
+    def test_import_is_not_possible_without_endpoint(self):
+        self.instance_service.resolve_instance_endpoint.return_value = dict(type="zeppelin", admins=[], url=None)
+        self.assertFalse(self.under_test.is_import_possible("abc"))
+        self.adapter_class.assert_not_called()
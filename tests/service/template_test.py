@@ -0,0 +1,69 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from airfield.service.instance_zeppelin import ZeppelinInstanceService
+from airfield.service.template import TemplateRegistry
+from tests.mocks.marathon_adapter import MarathonAdapterMock
+
+
+_configuration = {
+    "notebook": {"cores": 1, "memory": 1024},
+    "spark": {"executor_memory": 1024, "executor_cores": 1, "cores_max": 2, "python_version": "python3"},
+    "libraries": {"python": [], "r": []},
+    "usermanagement": {"enabled": True, "users": {"admin": "secret"}},
+}
+
+
+class TemplateRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "app.json")
+        self._write({"id": None, "env": {}})
+        self.under_test = TemplateRegistry()
+
+    def _write(self, data, mtime=None):
+        with open(self.path, "w") as f:
+            json.dump(data, f)
+        if mtime is not None:
+            os.utime(self.path, ns=(mtime, mtime))
+
+    def test_hands_out_copies(self):
+        first = self.under_test.get_app_definition(self.path)
+        first["env"]["FOO"] = "bar"
+        self.assertEqual(self.under_test.get_app_definition(self.path), {"id": None, "env": {}})
+
+    def test_parses_once(self):
+        with mock.patch("airfield.service.template.json.loads", wraps=json.loads) as loads:
+            self.under_test.get_app_definition(self.path)
+            self.under_test.get_app_definition(self.path)
+            self.under_test.render_batch(self.path, [(1,), (2,)], lambda app, i: app)
+        loads.assert_called_once()
+
+    def test_reloads_on_change(self):
+        self._write({"id": "a"}, mtime=1_000_000_000)
+        self.assertEqual(self.under_test.get_app_definition(self.path), {"id": "a"})
+        self._write({"id": "b"}, mtime=2_000_000_000)
+        self.assertEqual(self.under_test.get_app_definition(self.path), {"id": "b"})
+
+    def test_render_batch(self):
+        def render(app, app_id, value):
+            app["id"] = app_id
+            app["env"]["VALUE"] = value
+            return app
+        result = self.under_test.render_batch(self.path, [("a", "1"), ("b", "2")], render)
+        self.assertEqual(result, [{"id": "a", "env": {"VALUE": "1"}}, {"id": "b", "env": {"VALUE": "2"}}])
+
+
+class ZeppelinTemplateTest(unittest.TestCase):
+    def test_batch_matches_single_generation(self):
+        under_test = ZeppelinInstanceService(MarathonAdapterMock(), TemplateRegistry())
+        single = under_test.generate_marathon_configuration("airfield-zeppelin/a", _configuration)
+        batch = under_test.generate_marathon_configurations([("airfield-zeppelin/a", _configuration),
+                                                             ("airfield-zeppelin/b", _configuration)])
+        self.assertEqual(batch[0], single)
+        self.assertEqual(batch[1]["id"], "airfield-zeppelin/b")
+        self.assertIn("admin", single["env"]["ZEPPELIN_SHIRO_CONF"])
+        self.assertIsNot(batch[0]["env"], batch[1]["env"])
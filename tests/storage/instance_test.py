@@ -0,0 +1,108 @@
+import unittest
+from unittest import mock
+from airfield.storage.instance import InstanceStore
+from airfield.util.exception import ConflictError, InstanceRunningTimeException
+from tests.mocks.kv import InMemoryKVAdapter
+
+
+_cost_factors = dict(cores=2, memory=2048)
+
+
+class InstanceStoreRuntimeTest(unittest.TestCase):
+    def setUp(self):
+        self.kv_mock = InMemoryKVAdapter()
+        self.under_test = InstanceStore(self.kv_mock)
+        self.under_test.insert_instance("abc", dict(type="zeppelin"), dict(created_by="foo"))
+
+    def test_runtimes_are_appended(self):
+        for _ in range(3):
+            self.under_test.start_runtime("abc", _cost_factors)
+            self.under_test.finish_runtime("abc")
+        self.under_test.start_runtime("abc", _cost_factors)
+
+        runtimes = self.under_test.get_runtimes("abc")
+        self.assertEqual(len(runtimes), 4)
+        self.assertTrue(all(runtime["stopped_at"] is not None for runtime in runtimes[:3]))
+        self.assertIsNone(runtimes[3]["stopped_at"])
+        log_keys = sorted(key for key, _ in self.kv_mock.get_keys("runtime_log/abc"))
+        self.assertEqual(log_keys, ["runtime_log/abc/{:010d}".format(seq) for seq in range(3)])
+
+    def test_open_runtime_read_without_history(self):
+        self.under_test.start_runtime("abc", _cost_factors)
+        with mock.patch.object(self.kv_mock, "get_keys", wraps=self.kv_mock.get_keys) as get_keys:
+            data = self.under_test.get_instance("abc")
+        get_keys.assert_called_once_with("instances/abc")
+        self.assertEqual(data["runtime_head"]["open"]["cores"], 2)
+        self.assertNotIn("runtimes", data)
+
+    def test_invalid_transitions(self):
+        with self.assertRaises(InstanceRunningTimeException):
+            self.under_test.finish_runtime("abc")
+        self.under_test.start_runtime("abc", _cost_factors)
+        with self.assertRaises(InstanceRunningTimeException):
+            self.under_test.start_runtime("abc", _cost_factors)
+
+    def test_concurrent_update_is_retried(self):
+        self.under_test.start_runtime("abc", _cost_factors)
+        put_key_cas = self.kv_mock.put_key_cas
+        calls = list()
+
+        def conflicting_put_key_cas(key, value, index):
+            calls.append(key)
+            if len(calls) == 1:
+                # Another worker finishes the runtime between our read and our write
+                InstanceStore(self.kv_mock).finish_runtime("abc")
+            return put_key_cas(key, value, index)
+
+        with mock.patch.object(self.kv_mock, "put_key_cas", side_effect=conflicting_put_key_cas):
+            with self.assertRaises(InstanceRunningTimeException):
+                self.under_test.finish_runtime("abc")
+        self.assertEqual(len(self.under_test.get_runtimes("abc")), 1)
+
+    def test_gives_up_after_repeated_conflicts(self):
+        with mock.patch.object(self.kv_mock, "put_key_cas", return_value=False):
+            with self.assertRaises(ConflictError):
+                self.under_test.start_runtime("abc", _cost_factors)
+
+    def test_migrates_legacy_runtimes(self):
+        legacy_runtimes = [dict(started_at=1, stopped_at=2, cores=1, memory=1024),
+                           dict(started_at=3, stopped_at=None, cores=1, memory=1024)]
+        self.kv_mock.delete_key("instances/abc/runtime_head")
+        self.kv_mock.put_key("instances/abc/runtimes", legacy_runtimes)
+        self.assertEqual(self.under_test.get_runtimes("abc"), legacy_runtimes)
+        self.assertEqual(self.under_test.get_instance("abc")["runtime_head"]["open"], legacy_runtimes[1])
+
+        self.under_test.finish_runtime("abc")
+        self.assertIsNone(self.kv_mock.get_key("instances/abc/runtimes"))
+        runtimes = self.under_test.get_runtimes("abc")
+        self.assertEqual(len(runtimes), 2)
+        self.assertEqual(runtimes[0], legacy_runtimes[0])
+        self.assertIsNotNone(runtimes[1]["stopped_at"])
+
+    def test_deleted_instance_keeps_runtimes(self):
+        self.under_test.start_runtime("abc", _cost_factors)
+        self.under_test.finish_runtime("abc")
+        self.under_test.delete_instance("abc")
+        self.assertEqual(len(self.under_test.get_runtimes("abc", deleted=True)), 1)
+        self.assertEqual(self.under_test.get_all_instances(deleted=True, with_runtimes=True)["abc"]["runtimes"],
+                         self.under_test.get_runtimes("abc", deleted=True))
+
+    def test_delete_is_retried_if_runtimes_change(self):
+        self.under_test.start_runtime("abc", _cost_factors)
+        txn = self.kv_mock.txn
+        calls = list()
+
+        def conflicting_txn(ops):
+            calls.append(ops)
+            if len(calls) == 1:
+                # Another worker finishes the runtime between reading and moving the instance
+                InstanceStore(self.kv_mock).finish_runtime("abc")
+            return txn(ops)
+
+        with mock.patch.object(self.kv_mock, "txn", side_effect=conflicting_txn):
+            self.under_test.delete_instance("abc")
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.under_test.get_instance("abc"), dict())
+        runtimes = self.under_test.get_runtimes("abc", deleted=True)
+        self.assertEqual(len(runtimes), 1)
+        self.assertIsNotNone(runtimes[0]["stopped_at"])
@@ -0,0 +1,84 @@
+import unittest
+from unittest import mock
+from airfield.storage.notebook_blob import NotebookBlobStore, BLOB_KEY
+from tests.mocks.kv import InMemoryKVAdapter
+
+
+def _notebook(text="%spark\nsc.version", **paragraph_fields):
+    return dict(id="2F1", name="Spark", info=dict(isRunning=False),
+                paragraphs=[dict(text=text, config=dict(), **paragraph_fields)])
+
+
+class NotebookBlobStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.kv_mock = InMemoryKVAdapter()
+        self.under_test = NotebookBlobStore(self.kv_mock)
+        patcher = mock.patch("airfield.storage.notebook_blob.datetime")
+        self.datetime = patcher.start()
+        self.addCleanup(patcher.stop)
+        self._now(1000)
+
+    def _now(self, timestamp):
+        self.datetime.now.return_value.timestamp.return_value = timestamp
+
+    def _blob_keys(self):
+        return [key for key, _ in self.kv_mock.get_keys(BLOB_KEY)]
+
+    def test_identical_notebooks_are_stored_once(self):
+        first = self.under_test.put_notebook("instances/a/notebooks", _notebook(status="FINISHED", dateUpdated="May 1"))
+        second = self.under_test.put_notebook("instances/b/notebooks", _notebook(results=dict(code="SUCCESS")))
+        third = self.under_test.put_notebook("instances/b/notebooks", _notebook(text="%sh ls"))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, third)
+        self.assertEqual(len(self._blob_keys()), 2)
+        self.assertEqual(self.under_test.get_notebook(first), dict(id="2F1", name="Spark", paragraphs=[
+            dict(text="%spark\nsc.version", config=dict())]))
+
+    def test_released_notebooks_are_collected_after_grace_period(self):
+        ref = self.under_test.put_notebook("notebooks/1", _notebook())
+        self.kv_mock.put_key("notebooks/1", dict(ref=ref))
+        self.under_test.put_notebook("notebooks/2", _notebook())
+        self.under_test.release("notebooks/1", [ref])
+        self._now(5000)
+        self.assertEqual(self.under_test.collect_garbage(60), 0)
+        self.under_test.release("notebooks/2", [ref])
+        self.assertEqual(self.under_test.collect_garbage(60), 0)
+        self._now(5061)
+        self.assertEqual(self.under_test.collect_garbage(60), 1)
+        self.assertEqual(self._blob_keys(), [])
+        self.assertIsNone(self.under_test.get_notebook(ref))
+
+        # Stored again after the collection under a new generation
+        self.assertEqual(self.under_test.put_notebook("notebooks/3", _notebook()), ref)
+        self.assertEqual(self.under_test.get_notebook(ref)["name"], "Spark")
+        self._now(6000)
+        self.under_test.collect_garbage(60)
+        self.assertEqual(len(self._blob_keys()), 1)
+
+    def test_holders_without_reference_are_dropped(self):
+        ref = self.under_test.put_notebook("instances/a/notebooks", _notebook())
+        self.kv_mock.put_key("instances/a/notebooks", [dict(ref=ref, id="2F1", name="Spark")])
+        self.under_test.put_notebook("instances/b/notebooks", _notebook())
+        self._now(2000)
+        self.assertEqual(self.under_test.collect_garbage(60), 0)
+        # The holder of a deleted instance is gone
+        self.kv_mock.delete_key("instances/a", recursive=True)
+        self.assertEqual(self.under_test.collect_garbage(60), 0)
+        self._now(2061)
+        self.assertEqual(self.under_test.collect_garbage(60), 1)
+
+    def test_reference_is_only_registered_after_the_body_was_stored(self):
+        with mock.patch.object(self.kv_mock, "put_key", side_effect=OSError("unavailable")):
+            with self.assertRaises(OSError):
+                self.under_test.put_notebook("instances/a/notebooks", _notebook())
+        ref = self.under_test.put_notebook("instances/b/notebooks", _notebook())
+        self.assertEqual(self.under_test.get_notebook(ref)["name"], "Spark")
+
+    def test_body_of_a_lost_race_is_deleted(self):
+        results = [False]
+        put_key_cas = self.kv_mock.put_key_cas
+        # Another worker registered the notebook between the read and the first compare-and-swap
+        with mock.patch.object(self.kv_mock, "put_key_cas", side_effect=lambda *args: results.pop() if results else put_key_cas(*args)):
+            ref = self.under_test.put_notebook("instances/a/notebooks", _notebook())
+        self.assertEqual(len(self._blob_keys()), 1)
+        self.assertEqual(self.under_test.get_notebook(ref)["name"], "Spark")
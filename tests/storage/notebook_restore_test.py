@@ -0,0 +1,42 @@
+import unittest
+from unittest import mock
+from airfield.storage.notebook_restore import NotebookRestoreStore, QUEUED, RUNNING, DONE
+from tests.mocks.kv import InMemoryKVAdapter
+
+
+class NotebookRestoreStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.kv_mock = InMemoryKVAdapter()
+        self.under_test = NotebookRestoreStore(self.kv_mock)
+        patcher = mock.patch("airfield.storage.notebook_restore.datetime")
+        self.datetime = patcher.start()
+        self.addCleanup(patcher.stop)
+        self._now(1000)
+
+    def _now(self, timestamp):
+        self.datetime.now.return_value.timestamp.return_value = timestamp
+
+    def test_only_one_worker_claims(self):
+        self.under_test.enqueue("abc")
+        self.assertEqual(self.under_test.claim("abc", "worker-1", 60)["status"], RUNNING)
+        self.assertIsNone(self.under_test.claim("abc", "worker-2", 60))
+        self.assertIsNone(self.under_test.release("abc", "worker-2", DONE))
+        self.assertEqual(self.under_test.release("abc", "worker-1", DONE, results=["x"])["status"], DONE)
+        self.assertIsNone(self.under_test.claim("abc", "worker-2", 60))
+        self.assertEqual(self.under_test.get_restore("abc")["results"], ["x"])
+
+    def test_expired_lease_is_taken_over(self):
+        self.under_test.enqueue("abc")
+        self.under_test.claim("abc", "worker-1", 60)
+        self._now(1061)
+        restore = self.under_test.claim("abc", "worker-2", 60)
+        self.assertEqual(restore["lease"], dict(owner="worker-2", expires_at=1121))
+        self.assertEqual(restore["attempts"], 2)
+        self.assertIsNone(self.under_test.release("abc", "worker-1", QUEUED))
+
+    def test_canceled_restore_cannot_be_claimed(self):
+        self.under_test.enqueue("abc")
+        self.under_test.enqueue("def")
+        self.under_test.delete_restore("abc")
+        self.assertIsNone(self.under_test.claim("abc", "worker-1", 60))
+        self.assertEqual([restore["instance_id"] for restore in self.under_test.get_restores()], ["def"])
@@ -0,0 +1,58 @@
+import unittest
+from unittest import mock
+from airfield.storage.notebook import NotebookStore
+from airfield.storage.notebook_blob import NotebookBlobStore
+from tests.mocks.kv import InMemoryKVAdapter
+
+
+class NotebookStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.kv_mock = InMemoryKVAdapter()
+        self.under_test = NotebookStore(self.kv_mock, NotebookBlobStore(self.kv_mock))
+
+    def _migrate(self):
+        # A fresh store migrates (zero notebooks) on first use
+        self.under_test.get_notebooks()
+
+    def test_listing_does_not_read_bodies(self):
+        self._migrate()
+        self.under_test.store_notebook("1", "first", {"paragraphs": ["x" * 1000]}, "alice")
+        self.under_test.store_notebook("2", "second", {"paragraphs": []}, "bob")
+        with mock.patch.object(self.kv_mock, "get_keys", wraps=self.kv_mock.get_keys) as get_keys:
+            notebooks = self.under_test.get_notebooks()
+        get_keys.assert_called_once_with("notebook_index")
+        self.assertEqual(sorted((notebook["id"], notebook["name"], notebook["creator"]) for notebook in notebooks),
+                         [("1", "first", "alice"), ("2", "second", "bob")])
+        self.assertGreater(notebooks[0]["size"] if notebooks[0]["id"] == "1" else notebooks[1]["size"], 1000)
+        self.assertEqual(self.under_test.get_notebooks(instance_type="jupyter"), [])
+
+    def test_find_by_name(self):
+        self._migrate()
+        self.under_test.store_notebook("1", "a/b c", {}, "alice")
+        with mock.patch.object(self.kv_mock, "get_keys") as get_keys:
+            self.assertEqual(self.under_test.find_notebook("zeppelin", "a/b c"), "1")
+            self.assertIsNone(self.under_test.find_notebook("zeppelin", "other"))
+            self.assertIsNone(self.under_test.find_notebook("jupyter", "a/b c"))
+        get_keys.assert_not_called()
+
+    def test_overwrite_with_new_name(self):
+        self.under_test.store_notebook("1", "old", {}, "alice")
+        self.under_test.store_notebook("1", "new", {}, "alice")
+        self.assertIsNone(self.under_test.find_notebook("zeppelin", "old"))
+        self.assertEqual(self.under_test.find_notebook("zeppelin", "new"), "1")
+        self.assertEqual([notebook["name"] for notebook in self.under_test.get_notebooks()], ["new"])
+
+    def test_delete(self):
+        self.under_test.store_notebook("1", "first", {}, "alice")
+        self.under_test.delete_notebook("1")
+        self.assertIsNone(self.under_test.find_notebook("zeppelin", "first"))
+        self.assertEqual(self.under_test.get_notebooks(), [])
+        self.assertIsNone(self.under_test.get_notebook("1"))
+
+    def test_migrates_existing_notebooks_once(self):
+        self.kv_mock.put_key("notebooks/1", dict(type="zeppelin", name="legacy", data={}, creator="alice"))
+        self.assertEqual(self.under_test.find_notebook("zeppelin", "legacy"), "1")
+        self.assertEqual([notebook["name"] for notebook in self.under_test.get_notebooks()], ["legacy"])
+        with mock.patch.object(NotebookStore, "migrate_index") as migrate_index:
+            NotebookStore(self.kv_mock, NotebookBlobStore(self.kv_mock)).get_notebooks()
+        migrate_index.assert_not_called()
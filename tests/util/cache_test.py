@@ -0,0 +1,45 @@
+import unittest
+from unittest import mock
+from airfield.util.cache import TTLCache
+
+
+class TTLCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        under_test = TTLCache("test", 2, 60)
+        under_test.put("a", 1)
+        under_test.put("b", 2)
+        self.assertEqual(under_test.get("a"), 1)
+        under_test.put("c", 3)
+        self.assertIsNone(under_test.get("b"))
+        self.assertEqual(under_test.get("a"), 1)
+        self.assertEqual(under_test.get("c"), 3)
+
+    @mock.patch("airfield.util.cache.time.monotonic")
+    def test_entries_expire(self, monotonic):
+        monotonic.return_value = 100
+        under_test = TTLCache("test", 10, 30)
+        under_test.put("a", 1)
+        monotonic.return_value = 129
+        self.assertEqual(under_test.get("a"), 1)
+        monotonic.return_value = 130
+        self.assertIsNone(under_test.get("a"))
+        self.assertEqual(len(under_test), 0)
+
+    @mock.patch("airfield.util.cache.time.monotonic")
+    def test_sliding_expiry(self, monotonic):
+        monotonic.return_value = 100
+        under_test = TTLCache("test", 10, 30, sliding=True)
+        under_test.put("a", 1)
+        monotonic.return_value = 120
+        self.assertEqual(under_test.get("a"), 1)
+        monotonic.return_value = 145
+        self.assertEqual(under_test.get("a"), 1)
+        monotonic.return_value = 180
+        self.assertIsNone(under_test.get("a"))
+
+    def test_pop(self):
+        under_test = TTLCache("test", 10, 30)
+        under_test.put("a", 1)
+        self.assertEqual(under_test.pop("a"), 1)
+        self.assertIsNone(under_test.pop("a"))
+        self.assertIsNone(under_test.get("a"))